@@ -0,0 +1,134 @@
+"""
+NsfwNovelWriter 的 asyncio 版本：模型调用使用 ainvoke/astream，保存通过 persist.asave 交给后台线程，
+一个事件循环即可同时驱动多本小说（或同一本小说的多个节）的生成，不必为每个请求占用一个线程。
+
+提示词和结果写回与同步版本共用（NsfwNovelWriter._xxx_messages / _apply_xxx）。
+模型返回完整结果之后才写回 state，因此被取消（task.cancel()）或超时（asyncio.TimeoutError）的调用不会留下半成品。
+"""
+import asyncio
+from typing import AsyncGenerator, Callable
+
+from core import NsfwNovelWriter, MODEL_OPTIONS, DESIGN_SECTIONS_WORKERS, json_method
+from domains import *
+from persist import asave
+from jsonstream import ContentDeltaParser
+
+# 单次模型调用（含重试）的默认超时（秒），None 表示不限
+REQUEST_TIMEOUT = 300
+# 流式生成时两个片段之间的最长间隔（秒），超过视为连接已卡住
+STREAM_IDLE_TIMEOUT = 60
+
+
+class AsyncNsfwNovelWriter(NsfwNovelWriter):
+    """
+    与 NsfwNovelWriter 接口相同，生成方法为协程（write_content 为异步生成器）。
+    timeout 限制每次模型调用的总时长，stream_idle_timeout 限制流式生成中两个片段的间隔。
+    """
+
+    def __init__(self, model_name=MODEL_OPTIONS[0], timeout: float | None = REQUEST_TIMEOUT,
+                 stream_idle_timeout: float | None = STREAM_IDLE_TIMEOUT):
+        super().__init__(model_name)
+        self.timeout = timeout
+        self.stream_idle_timeout = stream_idle_timeout
+
+    async def _ainvoke(self, llm, messages):
+        async with asyncio.timeout(self.timeout):
+            return await llm.ainvoke(messages)
+
+    async def design_overall(self, plot_requirements: str, writing_requirements: str):
+        """
+        生成小说概要（先推断语言，再生成概要和角色列表）。
+        """
+        inferred_language = (await self._ainvoke(self.design_model.with_retry(),
+                                                 self._language_messages(plot_requirements, writing_requirements))).content
+        llm = self.design_model.with_structured_output(NSFWOverallDesign, method=json_method).with_retry()
+        result: NSFWOverallDesign = await self._ainvoke(llm, self._overall_messages(plot_requirements, writing_requirements, inferred_language))
+        self._apply_overall(plot_requirements, writing_requirements, inferred_language, result)
+        await asave(self.state)
+
+    async def design_chapters(self, chapter_count=None, user_feedback: str | None = None):
+        """
+        生成章概要并更新 state.chapters，参数同 NsfwNovelWriter.design_chapters。
+        """
+        llm = self.design_model.with_structured_output(NSFWChapterResponse, method=json_method).with_retry()
+        self._apply_chapters(await self._ainvoke(llm, self._chapters_messages(chapter_count, user_feedback)))
+        await asave(self.state)
+
+    async def design_sections(self, chapter_index: int, section_count: int | None = None, user_feedback: str | None = None):
+        """
+        生成指定章的节概要，参数同 NsfwNovelWriter.design_sections。
+        """
+        chapter = self.state.chapters[chapter_index]
+        self._apply_sections(chapter, await self._arequest_sections(chapter, section_count, user_feedback))
+        await asave(self.state)
+
+    async def _arequest_sections(self, chapter: NSFWChapter, section_count: int | None = None,
+                                 user_feedback: str | None = None) -> NSFWSectionResponse:
+        llm = self.design_model.with_structured_output(NSFWSectionResponse, method=json_method).with_retry()
+        return await self._ainvoke(llm, self._sections_messages(chapter, section_count, user_feedback))
+
+    async def design_sections_batch(self, chapter_indexes: list[int] | None = None, section_count: int | None = None,
+                                    max_workers: int = DESIGN_SECTIONS_WORKERS,
+                                    progress_callback: Callable[[int, int, int, Exception | None], None] | None = None) -> dict[int, Exception]:
+        """
+        同时为多章生成节概要，最多 max_workers 个请求并发，语义同 NsfwNovelWriter.design_sections_batch。
+        """
+        if chapter_indexes is None:
+            chapter_indexes = list(range(len(self.state.chapters)))
+        chapters = {idx: self.state.chapters[idx] for idx in chapter_indexes}
+        errors: dict[int, Exception] = {}
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def request(idx: int):
+            async with semaphore:
+                try:
+                    return idx, await self._arequest_sections(chapters[idx], section_count), None
+                except Exception as e:
+                    return idx, None, e
+
+        for done, future in enumerate(asyncio.as_completed([request(idx) for idx in chapters]), 1):
+            idx, result, error = await future
+            if error is None:
+                self._apply_sections(chapters[idx], result)
+                await asave(self.state)
+            else:
+                errors[idx] = error
+            if progress_callback:
+                progress_callback(idx, done, len(chapters), error)
+        return errors
+
+    async def write_content(self, chapter_index: int, section_index: int,
+                            user_feedback: str | None = None) -> AsyncGenerator[str, None]:
+        """
+        流式生成指定节的正文，逐次产出当前已生成的完整正文。生成结束后才写回 state 并保存；
+        调用方提前停止迭代（aclose）、取消或超时时 state 保持不变。
+        """
+        section = self.state.chapters[chapter_index].sections[section_index]
+        llm = self.model.bind(response_format={"type": "json_object"}).with_retry()
+        parser = ContentDeltaParser('content')
+        content = ''
+        # 生成器在调用方的任务中分段执行，不能用跨越 yield 的 asyncio.timeout，改为按截止时间限制每次等待
+        loop = asyncio.get_running_loop()
+        deadline = None if self.timeout is None else loop.time() + self.timeout
+        stream = llm.astream(self._content_messages(chapter_index, section_index, user_feedback))
+        try:
+            while True:
+                waits = [t for t in (self.stream_idle_timeout, deadline and deadline - loop.time()) if t is not None]
+                try:
+                    chunk = await asyncio.wait_for(anext(stream), min(waits) if waits else None)
+                except StopAsyncIteration:
+                    break
+                delta = parser.feed(chunk.content)
+                if delta:
+                    content += delta
+                    yield content
+        finally:
+            await stream.aclose()
+        self._apply_content(section, parser.finish())
+        await asave(self.state)
+
+    async def export_markdown(self) -> str:
+        """
+        导出 markdown；正文可能需要延迟加载，放到线程池中执行。
+        """
+        return await asyncio.to_thread(super().export_markdown)
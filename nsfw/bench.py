@@ -0,0 +1,377 @@
+"""
+持久化等模块的微基准测试，不访问 LLM。
+
+用法：
+    python nsfw/bench.py save [--chapters 20] [--sections 8] [--content 3000] [--rounds 200]
+    python nsfw/bench.py search [--novels 10000] [--queries 200]
+    python nsfw/bench.py history [--chapters 20] [--sections 8] [--edits 200]
+    python nsfw/bench.py compress [--chapters 20] [--sections 8] [--content 1500] [--rounds 10]
+    python nsfw/bench.py load [--chapters 25] [--sections 8] [--content 1500] [--rounds 20]
+    python nsfw/bench.py stream [--content 4000] [--chunk 4] [--rounds 5]
+    python nsfw/bench.py bind [--chapters 50] [--sections 10] [--rounds 20]
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+
+from domains import *
+import persist
+
+
+def make_novel(chapters: int, sections: int, content_len: int) -> NSFWNovel:
+    """
+    构造一个有完整正文和角色状态的合成小说。
+    """
+    names = ["林晚", "苏澈", "沈月"]
+    novel = NSFWNovel(
+        plot_requirements="基准测试用情节要求",
+        writing_requirements="基准测试用写作要求",
+        title="基准测试小说",
+        overview="概要" * 200,
+        language="Chinese",
+        characters=[NSFWCharacter(name=n, description="角色描述" * 20) for n in names],
+    )
+    for cidx in range(chapters):
+        chapter = NSFWChapter(title=f"第{cidx+1}章", overview="章概要" * 50)
+        for sidx in range(sections):
+            chapter.sections.append(NSFWSection(
+                title=f"第{sidx+1}节",
+                overview="节概要" * 30,
+                content=("正文" * content_len)[:content_len],
+                after_state={n: NSFWCharacterState(clothing="衣着", psychological="心理", physiological="生理") for n in names},
+            ))
+        novel.chapters.append(chapter)
+    return novel
+
+
+def _legacy_save(novel: NSFWNovel, db_path: str):
+    # 连接池改造之前 persist.save 的实现，作为对照
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS nsfw_novel (
+        id TEXT PRIMARY KEY,
+        state_json TEXT,
+        create_time TEXT,
+        update_time TEXT,
+        version INTEGER
+    )''')
+    now = datetime.now().isoformat()
+    state_json = novel.model_dump_json()
+    c.execute('SELECT id FROM nsfw_novel WHERE id=?', (novel.uuid,))
+    row = c.fetchone()
+    if row:
+        c.execute('UPDATE nsfw_novel SET state_json=?, update_time=?, version=version+1 WHERE id=?',
+                    (state_json, now, novel.uuid))
+    else:
+        c.execute('INSERT INTO nsfw_novel (id, state_json, create_time, update_time, version) VALUES (?, ?, ?, ?, ?)',
+                    (novel.uuid, state_json, now, now, 1))
+    conn.commit()
+    conn.close()
+
+
+def _timeit(fn, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return time.perf_counter() - start
+
+
+def bench_save(args):
+    novel = make_novel(args.chapters, args.sections, args.content)
+    original_db = persist.DB_PATH
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_db = os.path.join(tmp, 'legacy.db')
+        pooled_db = os.path.join(tmp, 'pooled.db')
+        # 每轮修改一节的正文后保存，模拟 write_content/bind_state 之后的保存
+        section = novel.chapters[-1].sections[-1]
+        def edit():
+            section.content = section.content[1:] + section.content[0]
+        legacy = _timeit(lambda: (edit(), _legacy_save(novel, legacy_db)), args.rounds)
+        persist.set_db_path(pooled_db)
+        persist.save(novel)
+        pooled = _timeit(lambda: (edit(), persist.save(novel)), args.rounds)
+        persist.set_db_path(original_db)
+    print(f"novel: {args.chapters} chapters x {args.sections} sections, {len(novel.model_dump_json())} bytes")
+    print(f"legacy save:      {args.rounds / legacy:8.1f} saves/s")
+    print(f"incremental save: {args.rounds / pooled:8.1f} saves/s")
+
+
+def _random_text(rng: random.Random, vocab: list[str], words: int) -> str:
+    return ''.join(rng.choice(vocab) for _ in range(words))
+
+
+def bench_search(args):
+    rng = random.Random(42)
+    # 随机两字词组成的词表，使各小说正文互不相同
+    chars = [chr(c) for c in range(0x4e00, 0x4e00 + 2000)]
+    vocab = [rng.choice(chars) + rng.choice(chars) for _ in range(5000)]
+    original_db = persist.DB_PATH
+    with tempfile.TemporaryDirectory() as tmp:
+        persist.set_db_path(os.path.join(tmp, 'search.db'))
+        start = time.perf_counter()
+        for i in range(args.novels):
+            novel = NSFWNovel(title=_random_text(rng, vocab, 4), overview=_random_text(rng, vocab, 60), language="Chinese",
+                              characters=[NSFWCharacter(name=rng.choice(vocab), description=_random_text(rng, vocab, 10))])
+            for _ in range(2):
+                chapter = NSFWChapter(title=_random_text(rng, vocab, 3), overview=_random_text(rng, vocab, 30))
+                chapter.sections = [NSFWSection(title=_random_text(rng, vocab, 3), overview=_random_text(rng, vocab, 20),
+                                                content=_random_text(rng, vocab, args.content)) for _ in range(3)]
+                novel.chapters.append(chapter)
+            persist.save(novel)
+        print(f"indexed {args.novels} novels ({args.novels * 6} sections) in {time.perf_counter() - start:.1f}s")
+        queries = [rng.choice(vocab) for _ in range(args.queries)] + [rng.choice(vocab)[0] for _ in range(args.queries)]
+        for label, batch in (('two-char', queries[:args.queries]), ('one-char', queries[args.queries:])):
+            hits = 0
+            start = time.perf_counter()
+            for q in batch:
+                rows, _ = persist.search_novels(q, 1, 10)
+                hits += len(rows)
+            elapsed = time.perf_counter() - start
+            print(f"{label} query: {elapsed / len(batch) * 1000:6.2f} ms/query, {hits / len(batch):.1f} results/page")
+        persist.set_db_path(original_db)
+
+
+def bench_history(args):
+    rng = random.Random(42)
+    chars = [chr(c) for c in range(0x4e00, 0x4e00 + 2000)]
+    vocab = [rng.choice(chars) + rng.choice(chars) for _ in range(5000)]
+    novel = make_novel(args.chapters, args.sections, 0)
+    sections = [s for c in novel.chapters for s in c.sections]
+    for section in sections:
+        section.content = _random_text(rng, vocab, args.content)
+    original_db = persist.DB_PATH
+    with tempfile.TemporaryDirectory() as tmp:
+        persist.set_db_path(os.path.join(tmp, 'history.db'))
+        persist.save(novel)
+        # 每次编辑重写一节正文，模拟重新生成或修改某一节
+        for _ in range(args.edits):
+            rng.choice(sections).content = _random_text(rng, vocab, args.content)
+            persist.save(novel)
+        rows = persist.list_versions(novel.uuid)
+        keyframes = [size for _, keyframe, size, _ in rows if keyframe]
+        deltas = [size for _, keyframe, size, _ in rows if not keyframe]
+        raw = len(novel.model_dump_json().encode('utf-8'))
+        print(f"novel: {len(sections)} sections, {raw} bytes as JSON, {len(rows)} versions")
+        print(f"keyframe: {len(keyframes)} x {sum(keyframes) / len(keyframes):10.0f} bytes avg")
+        print(f"delta:    {len(deltas)} x {sum(deltas) / max(len(deltas), 1):10.0f} bytes avg")
+        print(f"total:    {sum(keyframes) + sum(deltas) :10d} bytes ({(sum(keyframes) + sum(deltas)) / len(rows):.0f} bytes/version, "
+              f"full copies would take {raw * len(rows)} bytes)")
+        # 距上一个关键帧最远的版本需要应用最多的补丁
+        chain, last_keyframe = {}, None
+        for version, keyframe, _, _ in reversed(rows):
+            last_keyframe = version if keyframe else last_keyframe
+            chain[version] = version - last_keyframe
+        longest = max(chain, key=chain.get)
+        for label, version in (('keyframe', max(v for v, k, _, _ in rows if k)),
+                               (f'{chain[longest]} patches', longest),
+                               ('latest', rows[0][0])):
+            start = time.perf_counter()
+            for _ in range(args.rounds):
+                persist.restore_version(novel.uuid, version)
+            print(f"restore {label:<13} v{version}: {(time.perf_counter() - start) / args.rounds * 1000:7.2f} ms")
+        persist.set_db_path(original_db)
+
+
+def bench_compress(args):
+    rng = random.Random(42)
+    chars = [chr(c) for c in range(0x4e00, 0x4e00 + 2000)]
+    vocab = [rng.choice(chars) + rng.choice(chars) for _ in range(5000)]
+    novel = make_novel(args.chapters, args.sections, 0)
+    for section in (s for c in novel.chapters for s in c.sections):
+        section.content = _random_text(rng, vocab, args.content)
+    novel.exported_markdown = '\n'.join(s.content for c in novel.chapters for s in c.sections)
+    original_db, original_min = persist.DB_PATH, persist.COMPRESS_MIN_BYTES
+    with tempfile.TemporaryDirectory() as tmp:
+        # COMPRESS_MIN_BYTES 足够大时所有文本都以 TEXT 存储，等同于压缩之前的格式
+        for label, min_bytes in (('plain', 1 << 62), ('compressed', original_min)):
+            persist.COMPRESS_MIN_BYTES = min_bytes
+            persist.set_db_path(os.path.join(tmp, f'{label}.db'))
+            def full_save():
+                novel._persisted = None
+                persist.save(novel)
+            save = _timeit(full_save, args.rounds)
+            load = _timeit(lambda: persist.load_novel(novel.uuid), args.rounds)
+            stats = persist.storage_stats()
+            print(f"{label:<10} state_json {stats['head_bytes']:>9,d} bytes, content {stats['content_bytes']:>11,d} bytes, "
+                  f"full save {save / args.rounds * 1000:7.2f} ms, load {load / args.rounds * 1000:7.2f} ms")
+    persist.COMPRESS_MIN_BYTES = original_min
+    persist.set_db_path(original_db)
+    print(f"novel: {args.chapters * args.sections} sections, whole-JSON row would be "
+          f"{len(novel.model_dump_json().encode('utf-8')):,d} bytes (exported_markdown included)")
+
+
+def bench_load(args):
+    rng = random.Random(42)
+    chars = [chr(c) for c in range(0x4e00, 0x4e00 + 2000)]
+    vocab = [rng.choice(chars) + rng.choice(chars) for _ in range(5000)]
+    novel = make_novel(args.chapters, args.sections, 0)
+    for section in (s for c in novel.chapters for s in c.sections):
+        section.content = _random_text(rng, vocab, args.content)
+    original_db = persist.DB_PATH
+    with tempfile.TemporaryDirectory() as tmp:
+        persist.set_db_path(os.path.join(tmp, 'load.db'))
+        persist.save(novel)
+        eager = _timeit(lambda: persist.load_novel(novel.uuid), args.rounds)
+        lazy = _timeit(lambda: persist.load_novel(novel.uuid, lazy=True), args.rounds)
+        # 导入后打开一章：读取该章所有节的正文
+        first = _timeit(lambda: persist.load_novel(novel.uuid, lazy=True).chapters[0].ensure_loaded(), args.rounds)
+        persist.set_db_path(original_db)
+    print(f"novel: {args.chapters} chapters x {args.sections} sections, {args.content} words per section")
+    print(f"full load:                 {eager / args.rounds * 1000:7.2f} ms")
+    print(f"lazy load:                 {lazy / args.rounds * 1000:7.2f} ms")
+    print(f"lazy load + first chapter: {first / args.rounds * 1000:7.2f} ms")
+
+
+def bench_stream(args):
+    from langchain_core.messages import AIMessageChunk
+    from langchain_core.output_parsers import JsonOutputParser
+    from jsonstream import ContentDeltaParser
+
+    rng = random.Random(42)
+    chars = [chr(c) for c in range(0x4e00, 0x4e00 + 2000)]
+    vocab = [rng.choice(chars) + rng.choice(chars) for _ in range(5000)]
+    content = '\n\n'.join(_random_text(rng, vocab, 100) for _ in range(max(args.content // 100, 1)))
+    state = {n: {'clothing': '衣着' * 20, 'psychological': '心理' * 20, 'physiological': '生理' * 20} for n in ("林晚", "苏澈", "沈月")}
+    # 模型以 ensure_ascii=False 输出，每个流式片段约为一个 token
+    raw = json.dumps({'content': content, 'current_state': state}, ensure_ascii=False)
+    pieces = [raw[i:i + args.chunk] for i in range(0, len(raw), args.chunk)]
+
+    def structured():
+        # with_structured_output(method='json_mode') 的流式路径：每个片段都重新解析，产出完整的部分结果
+        rendered = 0
+        for partial in JsonOutputParser().transform(AIMessageChunk(content=p) for p in pieces):
+            if 'content' in partial:
+                rendered += len(partial['content'])
+        return rendered
+
+    def incremental():
+        parser = ContentDeltaParser('content')
+        rendered = 0
+        for p in pieces:
+            rendered += len(parser.feed(p))
+        assert parser.finish()['content'] == content
+        return rendered
+
+    print(f"section: {len(content):,d} chars, {len(pieces):,d} chunks of {args.chunk} chars")
+    for label, fn in (('structured', structured), ('incremental', incremental)):
+        start = time.process_time()
+        for _ in range(args.rounds):
+            rendered = fn()
+        cpu = (time.process_time() - start) / args.rounds
+        print(f"{label:<12} CPU {cpu * 1000:9.2f} ms per section, {rendered:>13,d} chars handed to the UI")
+
+
+def _widget_paths(novel: NSFWNovel) -> list[str]:
+    # 不分页时 ui.py 一次重新运行中 bind_state 绑定的全部路径
+    paths = ['plot_requirements', 'writing_requirements', 'title', 'overview']
+    for idx in range(len(novel.characters)):
+        paths += [f'characters.{idx}.name', f'characters.{idx}.description']
+    for idx, chapter in enumerate(novel.chapters):
+        paths += [f'chapters.{idx}.title', f'chapters.{idx}.overview']
+        for sidx, section in enumerate(chapter.sections):
+            prefix = f'chapters.{idx}.sections.{sidx}'
+            paths += [f'{prefix}.title', f'{prefix}.overview', f'{prefix}.content']
+            for name in section.after_state:
+                paths += [f'{prefix}.after_state.{name}.{field}' for field in ('clothing', 'psychological', 'physiological')]
+    return paths
+
+
+def bench_bind(args):
+    from glom import glom, assign
+    from paths import compile_path
+
+    novel = make_novel(args.chapters, args.sections, 1500)
+    paths = _widget_paths(novel)
+    # 编辑：同一批路径写回原值（无变化）以及写入新值
+    edits = [p for p in paths if p.endswith('.overview')]
+
+    def glom_rerun():
+        for path in paths:
+            glom(novel, path, default=None)
+
+    def compiled_rerun():
+        for path in paths:
+            compile_path(path).get(novel)
+
+    def glom_edit():
+        for path in edits:
+            assign(novel, path, glom(novel, path))
+
+    def compiled_edit():
+        return sum(compile_path(path).set(novel, compile_path(path).get(novel)) for path in edits)
+
+    print(f"novel: {args.chapters * args.sections} sections, {len(paths):,d} bound widgets per rerun")
+    for label, fn in (('glom', glom_rerun), ('compiled', compiled_rerun)):
+        print(f"{label:<9} rerun binding {_timeit(fn, args.rounds) / args.rounds * 1000:8.2f} ms")
+    for label, fn in (('glom', glom_edit), ('compiled', compiled_edit)):
+        for chapter in novel.chapters:
+            chapter.take_changed()
+            for section in chapter.sections:
+                section.take_changed()
+        elapsed = _timeit(fn, args.rounds) / args.rounds / len(edits) * 1e6
+        dirty = sum(1 for c in novel.chapters for s in c.sections if s.changed_fields)
+        print(f"{label:<9} unchanged edit {elapsed:8.2f} us, sections marked dirty: {dirty}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_save = sub.add_parser('save', help='每秒保存次数：旧实现 vs 当前实现')
+    p_save.add_argument('--chapters', type=int, default=20)
+    p_save.add_argument('--sections', type=int, default=8)
+    p_save.add_argument('--content', type=int, default=3000)
+    p_save.add_argument('--rounds', type=int, default=200)
+    p_save.set_defaults(func=bench_save)
+
+    p_search = sub.add_parser('search', help='全文检索的每次查询耗时')
+    p_search.add_argument('--novels', type=int, default=10000)
+    p_search.add_argument('--content', type=int, default=150, help='每节正文的词数')
+    p_search.add_argument('--queries', type=int, default=200)
+    p_search.set_defaults(func=bench_search)
+
+    p_history = sub.add_parser('history', help='版本历史每个版本的存储大小和恢复耗时')
+    p_history.add_argument('--chapters', type=int, default=20)
+    p_history.add_argument('--sections', type=int, default=8)
+    p_history.add_argument('--content', type=int, default=1500, help='每节正文的词数')
+    p_history.add_argument('--edits', type=int, default=200)
+    p_history.add_argument('--rounds', type=int, default=20)
+    p_history.set_defaults(func=bench_history)
+
+    p_compress = sub.add_parser('compress', help='压缩存储前后的占用空间和保存、读取耗时')
+    p_compress.add_argument('--chapters', type=int, default=20)
+    p_compress.add_argument('--sections', type=int, default=8)
+    p_compress.add_argument('--content', type=int, default=1500, help='每节正文的词数')
+    p_compress.add_argument('--rounds', type=int, default=10)
+    p_compress.set_defaults(func=bench_compress)
+
+    p_load = sub.add_parser('load', help='完整读取 vs 延迟读取一本小说的耗时')
+    p_load.add_argument('--chapters', type=int, default=25)
+    p_load.add_argument('--sections', type=int, default=8)
+    p_load.add_argument('--content', type=int, default=1500, help='每节正文的词数')
+    p_load.add_argument('--rounds', type=int, default=20)
+    p_load.set_defaults(func=bench_load)
+
+    p_stream = sub.add_parser('stream', help='流式生成一节正文时解析模型输出的 CPU 耗时：完整重解析 vs 增量解析')
+    p_stream.add_argument('--content', type=int, default=4000, help='每节正文的词数')
+    p_stream.add_argument('--chunk', type=int, default=4, help='每个流式片段的字符数')
+    p_stream.add_argument('--rounds', type=int, default=5)
+    p_stream.set_defaults(func=bench_stream)
+
+    p_bind = sub.add_parser('bind', help='不分页重新运行时绑定全部控件的耗时：glom vs 编译路径')
+    p_bind.add_argument('--chapters', type=int, default=50)
+    p_bind.add_argument('--sections', type=int, default=10)
+    p_bind.add_argument('--rounds', type=int, default=20)
+    p_bind.set_defaults(func=bench_bind)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
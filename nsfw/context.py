@@ -0,0 +1,70 @@
+"""
+提示词中公共上下文块（章概要列表、本章节概要列表、角色列表、小说表头）的渲染缓存。
+
+每个块以它依赖的字段值组成的元组为键：字段未被修改时元组中是同一批字符串对象，比较只需逐个比对引用，
+远比重新格式化整本小说的概要便宜；任何一章、一节或一个角色被修改（或增删、移动）时键不再相等，该块重新渲染。
+"""
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Hashable
+
+# 缓存的块数上限（节概要按章各占一个），超出时丢弃最早写入的块
+CONTEXT_CACHE_SIZE = 512
+
+
+class ContextCache:
+    """
+    每个 NsfwNovelWriter 一个。get 取出或渲染一个块，assembly() 统计一次提示词组装的耗时。
+    """
+
+    def __init__(self, max_entries: int = CONTEXT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits: Counter[str] = Counter()
+        self.misses: Counter[str] = Counter()
+        self.prompts = 0
+        self.assembly_seconds = 0.0
+        self._entries: dict[tuple[str, Hashable], tuple[Hashable, str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str, scope: Hashable, key: Hashable, render: Callable[[], str]) -> str:
+        """
+        返回块 (name, scope) 的渲染结果：缓存的键与 key 相等时直接使用，否则调用 render() 并缓存。
+        """
+        entry = self._entries.get((name, scope))
+        if entry is not None and entry[0] == key:
+            with self._lock:
+                self.hits[name] += 1
+            return entry[1]
+        value = render()
+        with self._lock:
+            self.misses[name] += 1
+            self._entries[(name, scope)] = (key, value)
+            if len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+        return value
+
+    @contextmanager
+    def assembly(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.prompts += 1
+                self.assembly_seconds += elapsed
+
+    @property
+    def hit_rate(self) -> float:
+        hits, misses = sum(self.hits.values()), sum(self.misses.values())
+        return hits / (hits + misses) if hits + misses else 0.0
+
+    @property
+    def average_assembly_ms(self) -> float:
+        return self.assembly_seconds / self.prompts * 1000 if self.prompts else 0.0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -1,17 +1,28 @@
 import dotenv
 import logging
+import os
+import sys
 
 dotenv.load_dotenv()
 
-from typing import Generator
+import queue
+from typing import Generator, Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from langchain_openai import ChatOpenAI
 from langchain.globals import set_debug, set_verbose
 from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
-from glom import glom
 
 from domains import *
-from persist import persist_novel_state
+from persist import persist_novel_state, merge_novel, load_novel, save_async
+from prefetch import SectionPrefetcher
+from jsonstream import ContentDeltaParser
+from context import ContextCache
+from memory import StoryMemory
+from usage import PromptCacheStats
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.llmcache import get_response_cache
 
 # 配置logging
 logging.basicConfig(filename="nsfw.log", level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s', encoding='utf-8')
@@ -54,18 +65,99 @@ MODEL_OPTIONS = [
     # 可根据需要添加更多模型
 ]
 
+# 节概要生成的系统提示词
+SECTIONS_SYSTEM_PROMPT = f"""
+You are a professional NSFW novel writer.
+{NSFW_OBJECTIVE}
+You are responsible for designing the section structure and section overviews for the current chapter.
+
+**Requirements:**
+- Return a list of sections, each as an object with `title` and `overview` fields, in a JSON object with a `sections` field.
+- Each section overview must focus on the concrete plot development within this chapter, including specific events, character conflicts, emotional changes, and minor turning points.
+- Ensure each section advances the chapter's main storyline, with a clear beginning, development, climax, and resolution for that section.
+- Emphasize how each section serves the chapter's main plot and deepens character relationships or conflicts.
+- State the participants and ways of NSFW actions in this section clearly if there are nsfw actions in this section.
+- Avoid vague or generic summaries; provide actionable, detailed frameworks for subsequent writing.
+- Do NOT include section numbers or sequence indicators in the section titles.
+
+Return your answer in the following JSON format:
+```json
+{{
+  "sections": [
+    {{"title": "The title of the first section", "overview": "A brief but complete description of the section's plot, nsfw actions (if exist) and its function in the chapter"}},
+    {{"title": "The title of the second section", "overview": "A brief but complete description of the section's plot, nsfw actions (if exist) and its function in the chapter"}}
+  ]
+}}
+```
+"""
+
+# 正文生成的系统提示词，与小说内容无关，只格式化一次
+CONTENT_SYSTEM_PROMPT = f"""
+You are a professional NSFW novel writer.
+{NSFW_OBJECTIVE}
+You are writing the full content for a single section of the novel. You must update the state of each character based on the events in this section, and ensure the writing is immersive and highly erotic while remaining logical.
+
+**Dynamic Guidance:**
+- Before writing, analyze the current section’s plot function (setup, conflict, climax, resolution, etc.) and the current state of each character.
+- If the section is a buildup, transition, or conflict, focus on emotional, psychological, and relationship development. Keep erotic content and character state changes moderate and gradual.
+- If the section is a climax or major turning point, you may intensify erotic content and allow more significant state changes.
+- Always ensure the pacing of erotic content and character state progression matches the narrative needs of the current section and the overall story arc.
+- Follow the previous section's content to maintain writing continuity, but never repeat the previous section's content.
+
+**Content Formatting Requirements:**
+- Write the full content for the current section only (do not include section or chapter titles)
+- The content must be clearly and reasonably divided into natural paragraphs, with each paragraph separated by a blank line.
+- Do not include any special characters or pinyin to replace or divide words related to NSFW content.
+
+**Characters State Updating Requirement:**
+- In the returned JSON, the `current_state` for each character must include their clothing state, psychological state, and physiological state after the events of this section.
+- For the `clothing` field, provide a natural language description, including whether the character is naked, the specific situation of nudity, the types and state of remaining clothes, the position and integrity of clothes, and any dynamic process (e.g., being stripped, clothes torn, etc.).
+- For the `psychological` field, provide a description of the character's emotional and mental state, such as embarrassment, excitement, shame, desire, or loss of control.
+- For the `physiological` field, provide a description of the character's bodily reactions, such as blushing, rapid breathing, arousal, trembling, or other physical responses.
+- For any character who does not appear or is not affected in this section, return their state as it was at the end of the previous section (or the initial state if this is the first section).
+
+Return your answer in the following JSON format:
+```json
+{{
+  "content": "<The full content of this section as a string>",
+  "current_state": {{
+    "character_name1": {{"clothing": "...", "psychological": "...", "physiological": "..."}},
+    "character_name2": {{"clothing": "...", "psychological": "...", "physiological": "..."}}
+  }}
+}}
+```
+"""
+
+# design_sections_batch 同时请求的章数上限
+DESIGN_SECTIONS_WORKERS = 4
+# write_chapters_parallel 同时生成正文的章数上限
+PARALLEL_CHAPTER_WORKERS = 4
+
 class NsfwNovelWriter:
     def __init__(self, model_name=MODEL_OPTIONS[0]):
     
+        self.memory = StoryMemory()
+        self.usage = PromptCacheStats()
+        # 设计类调用（概要、章、节）是否复用相同请求的缓存结果；正文生成始终请求模型
+        self.use_response_cache = True
+        self.prefetcher = SectionPrefetcher()
         self.set_model(model_name)
         self.state = NSFWNovel()
+        self.context = ContextCache()
         
     def set_model(self, model_name: str):
+        # 预取的正文是旧模型生成的，不再使用
+        self.prefetcher.discard()
+        self.memory.set_model(model_name)
         self.model = ChatOpenAI(
             model=model_name,
             base_url="https://openrouter.ai/api/v1",
-            callbacks=[LLMLoggingCallbackHandler()],
+            callbacks=[LLMLoggingCallbackHandler(), self.usage],
+            # 流式调用也在最后返回 token 用量
+            stream_usage=True,
             extra_body= {
+                # OpenRouter 用量统计，包含命中提示词缓存的 token 数
+                "usage": {"include": True},
                 "safety_settings": [
                     {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
                     {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
@@ -77,6 +169,41 @@ class NsfwNovelWriter:
                 }       
             }
         )
+        self.cached_model = self.model.model_copy(update={'cache': get_response_cache()})
+
+    @property
+    def design_model(self) -> ChatOpenAI:
+        return self.cached_model if self.use_response_cache else self.model
+
+    @property
+    def conflict(self):
+        """
+        后台保存时检测到的版本冲突（persist.NovelConflictError），没有冲突时为 None。
+        """
+        return self.state._conflict
+
+    def resolve_conflict(self, strategy: str = 'merge') -> list[str]:
+        """
+        解决版本冲突并重新保存：
+        - merge：以数据库中的最新版本为基础，合并本会话修改过的节（两边都改过的节以本会话为准）
+        - theirs：放弃本会话未保存的修改，改用数据库中的版本
+        - mine：用本会话的内容整体覆盖数据库中的版本
+        返回 merge 时两边都修改过的节 id。
+        """
+        conflicts = []
+        if strategy == 'merge':
+            self.state, conflicts = merge_novel(self.state)
+        elif strategy == 'theirs':
+            self.state = load_novel(self.state.uuid, lazy=True) or NSFWNovel()
+            return conflicts
+        elif strategy == 'mine':
+            self.state._persisted = None
+            self.state._version = None
+            self.state._conflict = None
+        else:
+            raise ValueError(f"Unknown conflict strategy: {strategy}")
+        save_async(self.state)
+        return conflicts
 
     @persist_novel_state
     def design_overall(self, plot_requirements: str, writing_requirements: str):
@@ -84,14 +211,24 @@ class NsfwNovelWriter:
         生成小说概要（先推断语言，再生成概要和角色列表）。
         """
         # 1. 先推断语言（直接用llm.invoke）
-        inferred_language = self.model.with_retry().invoke([
+        inferred_language = self.design_model.with_retry().invoke(self._language_messages(plot_requirements, writing_requirements)).content
+        # 2. 再生成概要和角色列表
+        llm = self.design_model.with_structured_output(NSFWOverallDesign, method=json_method).with_retry()
+        result: NSFWOverallDesign = llm.invoke(self._overall_messages(plot_requirements, writing_requirements, inferred_language))
+        self._apply_overall(plot_requirements, writing_requirements, inferred_language, result)
+
+    # 以下 _xxx_messages 只根据 state 组装提示词，_apply_xxx 把模型结果写回 state；
+    # 同步和异步（async_writer）两套方法共用，只是调用模型的方式不同
+
+    def _language_messages(self, plot_requirements: str, writing_requirements: str) -> list:
+        return [
             SystemMessage(content="""
 Determine the language for the following NSFW novel requirements.If the requirements do not specify a language, use the language in what the requirements written. Otherwise, use the language specified by the requirements. Only return the language name (e.g., Chinese, English, Japanese, etc.), do not explain.
 """),
             HumanMessage(content=f"{plot_requirements}\n{writing_requirements}")
-        ]).content
+        ]
 
-        # 2. 再生成概要和角色列表
+    def _overall_messages(self, plot_requirements: str, writing_requirements: str, inferred_language: str) -> list:
         system_message = SystemMessage(content=f"""
 You are a professional NSFW novel writer.
 {NSFW_OBJECTIVE}
@@ -118,11 +255,12 @@ Writing Requirements: {writing_requirements}
 Language you will use: {inferred_language}
 Design an overall plot for a NSFW novel based on the requirements above. The design should include a title, a clear and structured overview of the plot (with main storyline and key turning points), and a list of design ideas or key creative concepts. Then, based on the title and overview, design a list of main characters for the NSFW novel. For each character, return an object with name and description fields.
 """)
-        llm = self.model.with_structured_output(NSFWOverallDesign, method=json_method).with_retry()
-        result: NSFWOverallDesign = llm.invoke([
+        return [
             system_message,
             human_message
-        ])
+        ]
+
+    def _apply_overall(self, plot_requirements: str, writing_requirements: str, inferred_language: str, result: NSFWOverallDesign):
         self.state.plot_requirements = plot_requirements
         self.state.writing_requirements = writing_requirements
         self.state.title = result.title
@@ -138,6 +276,10 @@ Design an overall plot for a NSFW novel based on the requirements above. The des
         可指定章数，若为None则自动。
         支持用户反馈。
         """
+        llm = self.design_model.with_structured_output(NSFWChapterResponse, method=json_method).with_retry()
+        self._apply_chapters(llm.invoke(self._chapters_messages(chapter_count, user_feedback)))
+
+    def _chapters_messages(self, chapter_count=None, user_feedback: str | None = None) -> list:
         system_message = SystemMessage(content=f"""
 You are a professional NSFW novel writer.
 {NSFW_OBJECTIVE}
@@ -176,7 +318,6 @@ Plot Requirements: {self.state.plot_requirements}
 Writing Requirements: {self.state.writing_requirements}
 Based on the above information, design a summary and a list of main plots/chapters for the NSFW novel. Return a JSON object with a `chapters` field containing the list of chapters, each with a title and overview, all in the specified language.
 """)
-        llm = self.model.with_structured_output(NSFWChapterResponse, method=json_method).with_retry()
         messages = [
             system_message,
             human_message
@@ -186,9 +327,17 @@ Based on the above information, design a summary and a list of main plots/chapte
             messages.append(AIMessage(content=NSFWChapterResponse(
                 chapters=[NSFWPlot(title=c.title, overview=c.overview) for c in self.state.chapters]).model_dump_json()))
             messages.append(HumanMessage(content=user_feedback))
-
-        result: NSFWChapterResponse = llm.invoke(messages)
-        self.state.chapters = [NSFWChapter(title=plot.title, overview=plot.overview, sections=glom(self.state.chapters, f'{idx}.sections', default=[]) ) for idx, plot in enumerate(result.chapters)]
+        return messages
+
+    def _apply_chapters(self, result: NSFWChapterResponse):
+        # 复用已有的章/节对象，只更新标题和概要，保存时不必重写其下已有的正文
+        chapters = []
+        for idx, plot in enumerate(result.chapters):
+            chapter = self.state.chapters[idx] if idx < len(self.state.chapters) else NSFWChapter()
+            chapter.title = plot.title
+            chapter.overview = plot.overview
+            chapters.append(chapter)
+        self.state.chapters = chapters
 
     @persist_novel_state
     def design_sections(self, chapter_index: int, section_count: int | None = None, user_feedback: str | None = None):
@@ -197,48 +346,63 @@ Based on the above information, design a summary and a list of main plots/chapte
         可指定节数，若为None则自动。
         """
         chapter = self.state.chapters[chapter_index]
-        system_message = SystemMessage(content=f"""
-You are a professional NSFW novel writer.
-{NSFW_OBJECTIVE}
-You are responsible for designing the section structure and section overviews for the current chapter.
+        self._apply_sections(chapter, self._request_sections(chapter, section_count, user_feedback))
 
-**Requirements:**
-- Return a list of sections, each as an object with `title` and `overview` fields, in a JSON object with a `sections` field.
-- Each section overview must focus on the concrete plot development within this chapter, including specific events, character conflicts, emotional changes, and minor turning points.
-- Ensure each section advances the chapter's main storyline, with a clear beginning, development, climax, and resolution for that section.
-- Emphasize how each section serves the chapter's main plot and deepens character relationships or conflicts.
-- State the participants and ways of NSFW actions in this section clearly if there are nsfw actions in this section.
-- Avoid vague or generic summaries; provide actionable, detailed frameworks for subsequent writing.
-- Do NOT include section numbers or sequence indicators in the section titles.
+    @persist_novel_state
+    def design_sections_batch(self, chapter_indexes: list[int] | None = None, section_count: int | None = None,
+                              max_workers: int = DESIGN_SECTIONS_WORKERS,
+                              progress_callback: Callable[[int, int, int, Exception | None], None] | None = None) -> dict[int, Exception]:
+        """
+        同时为多章（默认全部章）生成节概要，最多 max_workers 个请求并发。
+        节概要只依赖小说和本章概要，各章之间互不依赖。
+        每完成一章（在调用线程中）写入该章的 sections 并调用 progress_callback(chapter_index, 已完成章数, 总章数, 异常或 None)。
+        单章失败不影响其他章，返回失败的章及其异常。
+        """
+        if chapter_indexes is None:
+            chapter_indexes = list(range(len(self.state.chapters)))
+        chapters = {idx: self.state.chapters[idx] for idx in chapter_indexes}
+        errors: dict[int, Exception] = {}
+        if not chapters:
+            return errors
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chapters))) as executor:
+            futures = {executor.submit(self._request_sections, chapter, section_count): idx for idx, chapter in chapters.items()}
+            for done, future in enumerate(as_completed(futures), 1):
+                idx = futures[future]
+                error = None
+                try:
+                    self._apply_sections(chapters[idx], future.result())
+                    # 已完成的章先交给后台保存，不必等所有章完成
+                    save_async(self.state)
+                except Exception as e:
+                    logging.exception(f"Failed to design sections for chapter {idx}")
+                    errors[idx] = error = e
+                if progress_callback:
+                    progress_callback(idx, done, len(chapters), error)
+        return errors
+
+    def _request_sections(self, chapter: NSFWChapter, section_count: int | None = None,
+                          user_feedback: str | None = None) -> NSFWSectionResponse:
+        """
+        请求一章的节概要，不修改 state，可在工作线程中调用。
+        """
+        llm = self.design_model.with_structured_output(NSFWSectionResponse, method=json_method).with_retry()
+        return llm.invoke(self._sections_messages(chapter, section_count, user_feedback))
 
-Return your answer in the following JSON format:
-```json
-{{
-  "sections": [
-    {{"title": "The title of the first section", "overview": "A brief but complete description of the section's plot, nsfw actions (if exist) and its function in the chapter"}},
-    {{"title": "The title of the second section", "overview": "A brief but complete description of the section's plot, nsfw actions (if exist) and its function in the chapter"}}
-  ]
-}}
-```
-""")
+    def _sections_messages(self, chapter: NSFWChapter, section_count: int | None = None, user_feedback: str | None = None) -> list:
+        system_message = SystemMessage(content=SECTIONS_SYSTEM_PROMPT)
         extra = ""
         if section_count:
             extra = f"\nThis chapter should have exactly {section_count} sections."
-        human_message = HumanMessage(content=f"""
-Language: {self.state.language}
-Novel Title: {self.state.title}
-User Novel-Level Plot Requirements: {self.state.plot_requirements}
-User Writing Requirements: {self.state.writing_requirements}
-Novel Overview: {self.state.overview}
+        # 整本小说共用的内容在前（各章请求逐字节相同，可命中服务端的提示词缓存），本章内容在后
+        human_message = HumanMessage(content=self._get_novel_context() + f"""
+## Current Chapter
 Chapter Title: {chapter.title}
 Chapter Overview: {chapter.overview}
-Characters: {[{'name': c.name, 'description': c.description} for c in self.state.characters]}
 {extra}
 
 
 Based on the above information, design a list of sections for this chapter. Each section should have a title and a brief overview, all in the specified language.
 """)
-        llm = self.model.with_structured_output(NSFWSectionResponse, method=json_method).with_retry()
         messages = [
             system_message,
             human_message
@@ -248,112 +412,302 @@ Based on the above information, design a list of sections for this chapter. Each
             messages.append(AIMessage(content=NSFWSectionResponse(
                 sections=[NSFWPlot(title=s.title, overview=s.overview) for s in chapter.sections]).model_dump_json()))
             messages.append(HumanMessage(content=user_feedback))
-
-        result: NSFWSectionResponse = llm.invoke(messages)
-        chapter.sections = [
-            NSFWSection(title=section.title, overview=section.overview, content=glom(chapter.sections, f'{idx}.content', default=None), after_state=glom(chapter.sections, f'{idx}.after_state', default={}))
-            for idx, section in enumerate(result.sections)
-        ]
-
-    @persist_novel_state
-    def write_content(self, chapter_index: int, section_index: int, user_feedback: str | None = None) -> Generator[str, None, None]:
+        return messages
+
+    def _apply_sections(self, chapter: NSFWChapter, result: NSFWSectionResponse):
+        # 复用已有的节对象，只更新标题和概要，保存时不必重写已有的正文
+        sections = []
+        for idx, plot in enumerate(result.sections):
+            section = chapter.sections[idx] if idx < len(chapter.sections) else NSFWSection()
+            section.title = plot.title
+            section.overview = plot.overview
+            sections.append(section)
+        chapter.sections = sections
+
+    def write_content(self, chapter_index: int, section_index: int, user_feedback: str | None = None,
+                      prefetch: bool = True) -> Generator[str, None, None]:
         """
         Generate the content for the specified chapter and section, yielding the content as a generator of strings.
         If this is the first section of the chapter and there is a previous chapter, pass the last section content of the previous chapter as context.
         The prompt uses markdown structure, and all instructions are in English. The current chapter and section overview are included in the final instruction paragraph.
         LLM should return a JSON object: {"content": "...", "current_state": {character_name: {state_info}}}
+        A matching background prefetch (same prompt) is used instead of a new request; with prefetch=True the next section is prefetched afterwards.
         """
-        chapter = self.state.chapters[chapter_index]
-        section = chapter.sections[section_index]
-        all_chapter_summaries = self._get_chapter_summaries()
-        all_section_summaries = self._get_section_summaries(chapter)
-        character_md = self._get_character_md()
-        prev_section = self._get_prev_section(chapter_index, section_index)
-        prev_content = prev_section.content if prev_section else None
-        prev_after_state = prev_section.after_state if prev_section else None
-        system_message = SystemMessage(content=f"""
-You are a professional NSFW novel writer.
-{NSFW_OBJECTIVE}
-You are writing the full content for a single section of the novel. You must update the state of each character based on the events in this section, and ensure the writing is immersive and highly erotic while remaining logical.
-
-**Dynamic Guidance:**
-- Before writing, analyze the current section’s plot function (setup, conflict, climax, resolution, etc.) and the current state of each character.
-- If the section is a buildup, transition, or conflict, focus on emotional, psychological, and relationship development. Keep erotic content and character state changes moderate and gradual.
-- If the section is a climax or major turning point, you may intensify erotic content and allow more significant state changes.
-- Always ensure the pacing of erotic content and character state progression matches the narrative needs of the current section and the overall story arc.
-- Follow the previous section's content to maintain writing continuity, but never repeat the previous section's content.
-
-**Content Formatting Requirements:**
-- Write the full content for the current section only (do not include section or chapter titles)
-- The content must be clearly and reasonably divided into natural paragraphs, with each paragraph separated by a blank line.
-- Do not include any special characters or pinyin to replace or divide words related to NSFW content.
-
-**Characters State Updating Requirement:**
-- In the returned JSON, the `current_state` for each character must include their clothing state, psychological state, and physiological state after the events of this section.
-- For the `clothing` field, provide a natural language description, including whether the character is naked, the specific situation of nudity, the types and state of remaining clothes, the position and integrity of clothes, and any dynamic process (e.g., being stripped, clothes torn, etc.).
-- For the `psychological` field, provide a description of the character's emotional and mental state, such as embarrassment, excitement, shame, desire, or loss of control.
-- For the `physiological` field, provide a description of the character's bodily reactions, such as blushing, rapid breathing, arousal, trembling, or other physical responses.
-- For any character who does not appear or is not affected in this section, return their state as it was at the end of the previous section (or the initial state if this is the first section).
+        content = ''
+        for delta in self.write_content_deltas(chapter_index, section_index, user_feedback, prefetch):
+            content += delta
+            yield content
 
-Return your answer in the following JSON format:
-```json
-{{
-  "content": "<The full content of this section as a string>",
-  "current_state": {{
-    "character_name1": {{"clothing": "...", "psychological": "...", "physiological": "..."}},
-    "character_name2": {{"clothing": "...", "psychological": "...", "physiological": "..."}}
-  }}
-}}
-```
-""")
-        human_message = HumanMessage(content=f"""
-# NSFW Novel Writing Task
-
-## Book Title
-{self.state.title}
+    def write_content_deltas(self, chapter_index: int, section_index: int, user_feedback: str | None = None,
+                             prefetch: bool = True) -> Generator[str, None, None]:
+        """
+        与 write_content 相同，但只产出正文新增的部分：模型输出由 ContentDeltaParser 增量解析，
+        current_state 在生成结束后解析一次。
+        """
+        section = self.state.chapters[chapter_index].sections[section_index]
+        messages = self._content_messages(chapter_index, section_index, user_feedback)
+        result: SectionContentDict | None = self.prefetcher.take(section, messages, self.model.model_name)
+        if result is not None:
+            yield result['content']
+        else:
+            llm = self.model.bind(response_format={"type": "json_object"}).with_retry()
+            parser = ContentDeltaParser('content')
+            for chunk in llm.stream(messages):
+                delta = parser.feed(chunk.content)
+                if delta:
+                    yield delta
+            result = parser.finish()
+        self._apply_content(section, result)
+        # 生成器在迭代结束时才写入正文，persist_novel_state 在创建生成器时就保存了，不适用
+        save_async(self.state)
+        if prefetch:
+            self._prefetch_next(chapter_index, section_index)
+
+    def _prefetch_next(self, chapter_index: int, section_index: int):
+        """
+        在后台推测生成本章的下一节（尚无正文时），结果由下一次 write_content 取用。
+        """
+        sections = self.state.chapters[chapter_index].sections
+        if section_index + 1 >= len(sections) or sections[section_index + 1].content:
+            return
+        llm = self.model.with_structured_output(SectionContentDict, method=json_method).with_retry()
+        self.prefetcher.start(sections[section_index + 1], self._content_messages(chapter_index, section_index + 1), llm.invoke,
+                              self.model.model_name)
 
-## Book Overview
-{self.state.overview}
+    def _content_messages(self, chapter_index: int, section_index: int, user_feedback: str | None = None,
+                          boundary: NSFWChapterBoundary | None = None) -> list:
+        """
+        boundary 不为 None 时（按章并行生成），本章第一节以规划的起始状态和衔接摘要代替上一章最后一节。
+        章概要、节概要和角色列表取自 self.context，组装耗时计入其统计。
+        """
+        with self.context.assembly():
+            return self._render_content_messages(chapter_index, section_index, user_feedback, boundary)
 
+    def _render_content_messages(self, chapter_index: int, section_index: int, user_feedback: str | None,
+                                 boundary: NSFWChapterBoundary | None) -> list:
+        chapter = self.state.chapters[chapter_index]
+        section = chapter.sections[section_index]
+        all_chapter_summaries = self._get_chapter_memory(chapter_index)
+        all_section_summaries = self._get_section_memory(chapter, section_index)
+        if boundary is not None and section_index == 0:
+            prev_content = f"(Summary of the end of the previous chapter) {boundary.bridge}"
+            prev_after_state = boundary.start_state
+        else:
+            prev_section = self._get_prev_section(chapter_index, section_index)
+            prev_content = self.memory.tail(prev_section.content, self.memory.prev_tail_tokens) if prev_section else None
+            prev_after_state = prev_section.after_state if prev_section else None
+        system_message = SystemMessage(content=CONTENT_SYSTEM_PROMPT)
+        # 按变化频率排列：整本小说不变的内容、本章不变的内容、每节不同的内容，
+        # 同一本小说（同一章）的请求共享尽可能长的逐字节相同前缀
+        human_message = HumanMessage(content=self._get_novel_context() + f"""
 ## All Chapter Summaries
 {all_chapter_summaries}
 
-## Characters
-{character_md}
-
 ## All Section Summaries in Current Chapter
 {all_section_summaries}
 
 ## Current Character States
 {prev_after_state}
 
-## User Writing Requirements
-{self.state.writing_requirements}
-
 {'## Previous Section Content (continue writing following but not repeating it)\n' + prev_content if prev_content else ''}
 
 ---
 
 The language must be {self.state.language}. Make the content as erotic, logical, and interesting as possible.\n\nCurrent chapter overview: {chapter.overview}\nCurrent section overview: {section.overview}\n.
 """)
-        llm = self.model.with_structured_output(SectionContentDict, method=json_method).with_retry()
         messages= [
             system_message,
             human_message
         ]
+        self.memory.last_prompt_tokens = self.memory.count(CONTENT_SYSTEM_PROMPT) + self.memory.counter.measure(human_message.content)
+        logging.info(f"Section content prompt: {self.memory.last_prompt_tokens} tokens")
         if user_feedback:
             messages.append(AIMessage(content=SectionContentResponse(
                 content=section.content, current_state=section.after_state).model_dump_json()))
             messages.append(HumanMessage(content=user_feedback))
-        result: SectionContentDict = {}
-        for streamed in llm.stream(messages):
-            if 'content' not in streamed:
-                continue
-            result = streamed
-            yield streamed['content']
+        return messages
+
+    def _apply_content(self, section: NSFWSection, result: SectionContentDict):
         section.content = result['content']
         section.after_state = {k: NSFWCharacterState(**v) for k, v in result.get('current_state', {}).items()}
 
+    @persist_novel_state
+    def write_chapters_parallel(self, chapter_indexes: list[int] | None = None, max_workers: int = PARALLEL_CHAPTER_WORKERS,
+                                progress_callback: Callable[[str, int, int, int], None] | None = None) -> dict[int, Exception]:
+        """
+        按章并行生成正文（各章已有节概要）：
+        1. 规划：一次请求预测每章开头的角色状态和与上一章的衔接摘要；
+        2. 生成：各章并发，章内仍按节顺序生成，每章第一节以规划结果代替尚未写出的上一章；
+        3. 校正：各章第一节与上一章实际结尾的状态对照，不一致时由模型改写该节开头。
+        耗时约为规划 + 最长一章 + 校正，而不是所有节之和。
+        progress_callback(stage, chapter_index, 已完成数, 总数) 在调用线程中执行，stage 为 plan/content/reconcile。
+        返回生成失败的章及其异常，失败的章不参与校正。
+        """
+        if chapter_indexes is None:
+            chapter_indexes = list(range(len(self.state.chapters)))
+        boundaries = self._plan_boundaries(chapter_indexes)
+        if progress_callback:
+            progress_callback('plan', -1, 1, 1)
+        total = sum(len(self.state.chapters[idx].sections) for idx in chapter_indexes)
+        events: queue.Queue = queue.Queue()
+        llm = self.model.with_structured_output(SectionContentDict, method=json_method).with_retry()
+
+        def write_chapter(idx: int):
+            # 同一章的节只由一个线程依次写入，不同章写入不同的对象
+            for sidx, section in enumerate(self.state.chapters[idx].sections):
+                self._apply_content(section, llm.invoke(self._content_messages(idx, sidx, boundary=boundaries.get(idx))))
+                events.put(idx)
+
+        errors: dict[int, Exception] = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chapter_indexes)))) as executor:
+            futures = {executor.submit(write_chapter, idx): idx for idx in chapter_indexes}
+            for future in futures:
+                future.add_done_callback(lambda _: events.put(None))
+            finished = done = 0
+            while finished < len(futures):
+                idx = events.get()
+                if idx is None:
+                    finished += 1
+                    continue
+                done += 1
+                save_async(self.state)
+                if progress_callback:
+                    progress_callback('content', idx, done, total)
+            for future, idx in futures.items():
+                if future.exception() is not None:
+                    logging.error(f"Failed to write chapter {idx}: {future.exception()}")
+                    errors[idx] = future.exception()
+
+        targets = [idx for idx in boundaries if idx not in errors and idx - 1 not in errors]
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(targets)))) as executor:
+            futures = {executor.submit(self._reconcile_boundary, idx, boundaries[idx]): idx for idx in targets}
+            for done, future in enumerate(as_completed(futures), 1):
+                idx = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    # 校正失败只是保留原文，不算生成失败
+                    logging.exception(f"Failed to reconcile chapter {idx}: {e}")
+                if progress_callback:
+                    progress_callback('reconcile', idx, done, len(futures))
+        return errors
+
+    def _plan_boundaries(self, chapter_indexes: list[int]) -> dict[int, NSFWChapterBoundary]:
+        """
+        为上一章也在本次生成范围内的章预测起始状态和衔接摘要，返回 {章下标: 规划}。
+        模型漏掉的章退回为以上一章概要衔接、沿用上一章已有的结尾状态。
+        """
+        targets = [idx for idx in chapter_indexes if idx > 0 and idx - 1 in chapter_indexes]
+        if not targets:
+            return {}
+        llm = self.model.with_structured_output(NSFWBoundaryPlanResponse, method=json_method).with_retry()
+        result: NSFWBoundaryPlanResponse = llm.invoke(self._boundary_plan_messages(targets))
+        planned = {b.chapter - 1: b for b in result.chapters}
+        boundaries = {}
+        for idx in targets:
+            if idx in planned:
+                boundaries[idx] = planned[idx]
+            else:
+                prev_chapter = self.state.chapters[idx - 1]
+                prev_state = prev_chapter.sections[-1].after_state if prev_chapter.sections else {}
+                boundaries[idx] = NSFWChapterBoundary(chapter=idx + 1, start_state=prev_state, bridge=prev_chapter.overview or '')
+        return boundaries
+
+    def _boundary_plan_messages(self, chapter_indexes: list[int]) -> list:
+        outlines = "\n\n".join(
+            f"### Chapter {idx+1}: {c.title or ''}\n{c.overview or ''}\n{self._get_section_summaries(c)}"
+            for idx, c in enumerate(self.state.chapters)
+        )
+        system_message = SystemMessage(content=f"""
+You are a professional NSFW novel writer.
+{NSFW_OBJECTIVE}
+The chapters of the novel will be written independently and at the same time, so the beginning of each chapter must be planned before the previous chapter is written.
+
+**Requirements:**
+- For each requested chapter, predict the state of every main character at the very beginning of that chapter, i.e. right after the last section of the previous chapter, following the chapter and section overviews.
+- The `clothing`, `psychological` and `physiological` fields follow the same conventions as the character states written for each section.
+- Write a short `bridge` (2-4 sentences) summarizing what has just happened at the end of the previous chapter, so the writer of the chapter can continue from it.
+
+Return your answer in the following JSON format:
+```json
+{{
+  "chapters": [
+    {{
+      "chapter": <the 1-based number of the chapter>,
+      "start_state": {{"character_name1": {{"clothing": "...", "psychological": "...", "physiological": "..."}}}},
+      "bridge": "..."
+    }}
+  ]
+}}
+```
+""")
+        human_message = HumanMessage(content=f"""
+Language: {self.state.language}
+Title: {self.state.title}
+Overview: {self.state.overview}
+
+## Characters
+{self._get_character_md()}
+
+## Chapter and Section Outlines
+{outlines}
+
+Predict the starting character states and the bridge for chapters {', '.join(str(idx + 1) for idx in chapter_indexes)}, all in the specified language.
+""")
+        return [system_message, human_message]
+
+    def _reconcile_boundary(self, chapter_index: int, boundary: NSFWChapterBoundary):
+        """
+        对照上一章实际结尾和本章第一节（按规划写成），不一致时改写第一节，保留该节结尾的角色状态。
+        """
+        sections = self.state.chapters[chapter_index].sections
+        prev_sections = self.state.chapters[chapter_index - 1].sections
+        if not sections or not prev_sections or not sections[0].content:
+            return
+        llm = self.model.with_structured_output(NSFWBoundaryReconcileResponse, method=json_method).with_retry()
+        result: NSFWBoundaryReconcileResponse = llm.invoke(self._reconcile_messages(prev_sections[-1], sections[0], boundary))
+        if not result.consistent and result.content:
+            sections[0].content = result.content
+
+    def _reconcile_messages(self, prev_section: NSFWSection, section: NSFWSection, boundary: NSFWChapterBoundary) -> list:
+        system_message = SystemMessage(content=f"""
+You are a professional NSFW novel editor.
+{NSFW_OBJECTIVE}
+The following section was written before the previous chapter was finished, based on predicted character states and a predicted summary. Check whether its opening is consistent with how the previous chapter actually ended.
+
+**Requirements:**
+- Compare the actual character states and the actual ending of the previous chapter with the predicted ones.
+- If the section already continues naturally from the actual ending, return `consistent` as true and `content` as null.
+- Otherwise return `consistent` as false and the revised full content of the section in `content`: revise only what is needed (mainly the opening) so that it continues smoothly from the actual ending. Keep the plot, length, style, paragraph layout and the ending of the section unchanged.
+
+Return your answer in the following JSON format:
+```json
+{{
+  "consistent": true,
+  "content": null
+}}
+```
+""")
+        human_message = HumanMessage(content=f"""
+## Actual Ending of the Previous Chapter
+{prev_section.content}
+
+## Actual Character States
+{prev_section.after_state}
+
+## Predicted Character States
+{boundary.start_state}
+
+## Predicted Summary
+{boundary.bridge}
+
+## Section To Check
+{section.content}
+
+The language must be {self.state.language}.
+""")
+        return [system_message, human_message]
+
     def _get_prev_section(self, chapter_index, section_index) -> NSFWSection | None:
         """
         获取上一节的section对象（如有），否则返回None。
@@ -365,20 +719,78 @@ The language must be {self.state.language}. Make the content as erotic, logical,
             return prev_chapter.sections[-1]
         return None
     
+    # 以下上下文块按所依赖的字段值缓存在 self.context 中，字段未修改时不重新格式化
     def _get_chapter_summaries(self):
-        return "\n".join([
-            f"- **{idx+1}. {c.title or f'Chapter {idx+1}'}**: {c.overview or ''}" for idx, c in enumerate(self.state.chapters)
-        ])
+        chapters = self.state.chapters
+        return self.context.get('chapters', None, tuple((c.title, c.overview) for c in chapters), lambda: "\n".join([
+            f"- **{idx+1}. {c.title or f'Chapter {idx+1}'}**: {c.overview or ''}" for idx, c in enumerate(chapters)
+        ]))
 
     def _get_section_summaries(self, chapter):
-        return "\n".join([
-            f"    - **{sidx+1}. {s.title or f'Section {sidx+1}'}**: {s.overview or ''}" for sidx, s in enumerate(chapter.sections)
-        ])
+        sections = chapter.sections
+        return self.context.get('sections', id(chapter), tuple((s.title, s.overview) for s in sections), lambda: "\n".join([
+            f"    - **{sidx+1}. {s.title or f'Section {sidx+1}'}**: {s.overview or ''}" for sidx, s in enumerate(sections)
+        ]))
+
+    def _get_novel_context(self):
+        """
+        节概要和正文提示词的公共开头：只包含整本小说不变的内容，生成过程中逐字节相同。
+        """
+        state = self.state
+        key = (state.language, state.title, state.overview, state.plot_requirements, state.writing_requirements,
+               tuple((c.name, c.description) for c in state.characters))
+        return self.context.get('novel', None, key, lambda: f"""
+# NSFW Novel Writing Task
+
+## Language
+{state.language}
+
+## Book Title
+{state.title}
+
+## Book Overview
+{state.overview}
+
+## Characters
+{self._get_character_md()}
+
+## User Plot Requirements
+{state.plot_requirements}
+
+## User Writing Requirements
+{state.writing_requirements}
+""")
+
+    # 正文提示词使用的滚动记忆版本：按 self.memory 的 token 预算压缩、省略离当前章（节）较远的概要
+    def _get_chapter_memory(self, chapter_index: int):
+        chapters = self.state.chapters
+        key = (tuple((c.title, c.overview) for c in chapters), self.memory.settings, self.memory.counter)
+
+        def render():
+            titles = [c.title or f'Chapter {idx+1}' for idx, c in enumerate(chapters)]
+            return self.memory.fit_lines(
+                [f"- **{idx+1}. {titles[idx]}**: {c.overview or ''}" for idx, c in enumerate(chapters)],
+                [f"- **{idx+1}. {titles[idx]}**: {self.memory.compress(c.overview)}" for idx, c in enumerate(chapters)],
+                chapter_index, self.memory.chapter_tokens, self.memory.full_window, "- ({} chapters omitted)")
+        return self.context.get('chapter_memory', chapter_index, key, render)
+
+    def _get_section_memory(self, chapter: NSFWChapter, section_index: int):
+        sections = chapter.sections
+        key = (tuple((s.title, s.overview) for s in sections), self.memory.settings, self.memory.counter)
+
+        def render():
+            titles = [s.title or f'Section {sidx+1}' for sidx, s in enumerate(sections)]
+            return self.memory.fit_lines(
+                [f"    - **{sidx+1}. {titles[sidx]}**: {s.overview or ''}" for sidx, s in enumerate(sections)],
+                [f"    - **{sidx+1}. {titles[sidx]}**: {self.memory.compress(s.overview)}" for sidx, s in enumerate(sections)],
+                section_index, self.memory.section_tokens, self.memory.full_window, "    - ({} sections omitted)")
+        return self.context.get('section_memory', (id(chapter), section_index), key, render)
 
     def _get_character_md(self):
-        return "\n".join([
-            f"- **{c.name}**: {c.description}" for c in self.state.characters
-        ])
+        characters = self.state.characters
+        return self.context.get('characters', None, tuple((c.name, c.description) for c in characters), lambda: "\n".join([
+            f"- **{c.name}**: {c.description}" for c in characters
+        ]))
 
     @persist_novel_state
     def export_markdown(self) -> str:
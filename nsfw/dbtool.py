@@ -0,0 +1,104 @@
+"""
+novel_state.db 的维护命令。
+
+用法：
+    python nsfw/dbtool.py compact [--keep 50] [--novel UUID] [--db novel_state.db]
+    python nsfw/dbtool.py migrate [--batch 200] [--sample 20] [--vacuum] [--db novel_state.db]
+"""
+import argparse
+import os
+import random
+import time
+
+import persist
+
+
+def compact(args):
+    removed = persist.compact_versions(args.keep, args.novel)
+    print(f"removed {removed} old versions, kept the latest {args.keep} per novel")
+
+
+def _file_size(path: str) -> int:
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+
+def _load_latency(novel_ids: list[str]) -> float:
+    # 每本读取一次的平均耗时（毫秒）
+    if not novel_ids:
+        return 0.0
+    start = time.perf_counter()
+    for novel_id in novel_ids:
+        persist.load_novel(novel_id)
+    return (time.perf_counter() - start) / len(novel_ids) * 1000
+
+
+def _save_latency(novel_ids: list[str]) -> float:
+    # 整体重写一次的平均耗时（毫秒），重写后内容不变，只增加一个版本
+    if not novel_ids:
+        return 0.0
+    novels = [persist.load_novel(novel_id) for novel_id in novel_ids]
+    for novel in novels:
+        novel._persisted = None
+    start = time.perf_counter()
+    for novel in novels:
+        persist.save(novel)
+    return (time.perf_counter() - start) / len(novels) * 1000
+
+
+def migrate(args):
+    with persist.get_pool().connection() as conn:
+        novel_ids = [row[0] for row in conn.execute('SELECT id FROM nsfw_novel')]
+    sample = random.Random(0).sample(novel_ids, min(args.sample, len(novel_ids)))
+    file_before = _file_size(args.db)
+    load_before = _load_latency(sample)
+
+    def progress(stage, done, total):
+        print(f"\r{stage}: {done}/{total}", end='' if done < total else '\n', flush=True)
+
+    start = time.perf_counter()
+    stats = persist.migrate_storage(args.batch, progress)
+    elapsed = time.perf_counter() - start
+    if args.vacuum:
+        with persist.get_pool().connection() as conn:
+            conn.execute('VACUUM')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    load_after = _load_latency(sample)
+    save_after = _save_latency(sample) if args.save else None
+
+    before, after = stats['before'], stats['after']
+    for key, label in (('head_bytes', 'state_json'), ('content_bytes', 'section content')):
+        ratio = after[key] / before[key] if before[key] else 1.0
+        print(f"{label:<16} {before[key]:>14,d} -> {after[key]:>14,d} bytes ({ratio:.1%})")
+    print(f"{'database file':<16} {file_before:>14,d} -> {_file_size(args.db):>14,d} bytes"
+          + ('' if args.vacuum else ' (run with --vacuum to release free pages)'))
+    print(f"converted {before['blob_rows']} whole-JSON rows, {before['plain_heads']} heads, "
+          f"{before['plain_sections']} sections in {elapsed:.1f}s")
+    print(f"load latency over {len(sample)} novels: {load_before:.2f} ms -> {load_after:.2f} ms")
+    if save_after is not None:
+        print(f"full save latency over {len(sample)} novels: {save_after:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=persist.DB_PATH, help='数据库文件路径')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_compact = sub.add_parser('compact', help='清理旧的历史版本')
+    p_compact.add_argument('--keep', type=int, default=50, help='每本小说保留的最近版本数')
+    p_compact.add_argument('--novel', default=None, help='只清理指定 uuid 的小说')
+    p_compact.set_defaults(func=compact)
+
+    p_migrate = sub.add_parser('migrate', help='把已有记录转换为压缩存储格式，并报告大小和读写耗时')
+    p_migrate.add_argument('--batch', type=int, default=200, help='每个事务转换的行数')
+    p_migrate.add_argument('--sample', type=int, default=20, help='测量读写耗时时抽样的小说数')
+    p_migrate.add_argument('--save', action='store_true', help='同时测量整体保存耗时（会为抽样的小说各增加一个版本）')
+    p_migrate.add_argument('--vacuum', action='store_true', help='转换后执行 VACUUM 回收空间')
+    p_migrate.set_defaults(func=migrate)
+
+    args = parser.parse_args()
+    persist.set_db_path(args.db)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
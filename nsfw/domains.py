@@ -1,7 +1,65 @@
-from pydantic import BaseModel, Field, RootModel
-from typing import TypedDict, Annotated
+from pydantic import BaseModel, Field, RootModel, PrivateAttr
+from typing import TypedDict, Annotated, Callable
 import uuid
 
+
+class TrackedModel(BaseModel):
+    """
+    记录自上次保存以来被修改过的字段，persist 据此只写入有变化的行和列。
+    字段被重新赋值（包括 paths.StatePath.set）时自动记录；列表的增删由 persist 通过行 id 比对发现。
+    """
+    _changed: set[str] = PrivateAttr(default_factory=set)
+    # 在数据库中对应行的 id，首次保存时由 persist 分配
+    _row_id: str | None = PrivateAttr(default=None)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in self.__class__.model_fields:
+            self.__pydantic_private__['_changed'].add(name)
+
+    # 以下访问器直接读写 __pydantic_private__，避开 pydantic __getattr__ 的开销（保存时会对每一节调用）
+    @property
+    def row_id(self) -> str | None:
+        return self.__pydantic_private__['_row_id']
+
+    @row_id.setter
+    def row_id(self, value: str | None):
+        self.__pydantic_private__['_row_id'] = value
+
+    @property
+    def changed_fields(self) -> frozenset[str]:
+        """
+        修改过但尚未保存的字段名（只读，不清空）。
+        """
+        return frozenset(self.__pydantic_private__['_changed'])
+
+    def take_changed(self) -> set[str]:
+        """
+        取出并清空修改过的字段名。
+        """
+        private = self.__pydantic_private__
+        changed = private['_changed']
+        if changed:
+            private['_changed'] = set()
+        return changed
+
+    def restore_changed(self, fields: set[str]):
+        self.__pydantic_private__['_changed'] |= fields
+
+    def ensure_loaded(self):
+        """
+        读取延迟加载的字段，见 NSFWSection。
+        """
+
+    # pydantic 序列化直接读取 __dict__，不会触发延迟加载，需要先补齐
+    def model_dump(self, **kwargs):
+        self.ensure_loaded()
+        return super().model_dump(**kwargs)
+
+    def model_dump_json(self, **kwargs):
+        self.ensure_loaded()
+        return super().model_dump_json(**kwargs)
+
 class NSFWCharacter(BaseModel):
     name: str = Field(..., description="角色名")
     description: str = Field(..., description="角色描述")
@@ -12,23 +70,51 @@ class NSFWPlot(BaseModel):
     overview: str | None = Field(default=None, description="A brief overview of the plot.")
 
 
-class NSFWCharacterState(BaseModel):
+class NSFWCharacterState(TrackedModel):
     clothing: str = Field(..., description="The clothing state of the character after this section.")
     psychological: str = Field(..., description="The psychological state of the character after this section.")
     physiological: str = Field(..., description="The physiological state of the character after this section.")
 
 
-class NSFWSection(BaseModel):
+# persist.load_novel(lazy=True) 只读取节的标题和概要，以下字段在首次访问时才从数据库读取
+LAZY_SECTION_FIELDS = ('content', 'after_state')
+
+
+class NSFWSection(TrackedModel):
     title: str | None = Field(default=None, description="The title of the NSFW section.")
     overview: str | None = Field(default=None, description="A brief description of the NSFW section's plot.")
     content: str | None = Field(default=None, description="The content of the NSFW section.")
     after_state: dict[str, NSFWCharacterState] = Field(default_factory=dict, description="The state for each character after this section. Format: {character_name: NSFWCharacterState}.")
-    
-class NSFWChapter(BaseModel):
+    # 延迟加载时由 persist 设置：调用后补齐 __dict__ 中缺少的 LAZY_SECTION_FIELDS，并把自身置为 None
+    _loader: Callable[[], None] | None = PrivateAttr(default=None)
+
+    def __getattr__(self, name):
+        # 只有 __dict__ 中没有该字段（尚未加载）时才会进入这里
+        if name in LAZY_SECTION_FIELDS:
+            self.ensure_loaded()
+            if name in self.__dict__:
+                return self.__dict__[name]
+        return super().__getattr__(name)
+
+    @property
+    def is_loaded(self) -> bool:
+        return all(name in self.__dict__ for name in LAZY_SECTION_FIELDS)
+
+    def ensure_loaded(self):
+        loader = self.__pydantic_private__['_loader']
+        if loader is not None:
+            loader()
+
+
+class NSFWChapter(TrackedModel):
     title: str | None = Field(default=None, description="The title of the NSFW chapter.")
     overview: str | None = Field(default=None, description="A brief overview of the NSFW chapter.")
     sections: list[NSFWSection] = Field(default_factory=list, description="A list of NSFW sections in the chapter.")
-    
+
+    def ensure_loaded(self):
+        for section in self.sections:
+            section.ensure_loaded()
+
     
 class NSFWSectionResponse(BaseModel):
      sections: list[NSFWPlot] = Field(default_factory=list, description="A list of NSFW sections.")
@@ -51,6 +137,27 @@ class NSFWNovel(BaseModel):
     characters: list[NSFWCharacter] = Field(default_factory=list, description="A list of NSFW characters in the novel.")
     chapters: list[NSFWChapter] = Field(default_factory=list, description="A list of NSFW chapters in the novel.")
     exported_markdown: str | None = Field(default=None, description="The exported markdown of the novel.")
+    # persist 内部使用：上次成功保存时的表头 JSON 和各章节的行 id/顺序，None 表示尚未与数据库同步
+    _persisted: dict | None = PrivateAttr(default=None)
+    # 内存中的对象所基于的数据库版本号，保存时据此比较并交换；None 表示不检查（新建或从 JSON 导入）
+    _version: int | None = PrivateAttr(default=None)
+    # 保存时检测到的版本冲突（persist.NovelConflictError），解决之前不再写库
+    _conflict: Exception | None = PrivateAttr(default=None)
+
+    def ensure_loaded(self):
+        for chapter in self.chapters:
+            chapter.ensure_loaded()
+
+    # 序列化章节前先读取延迟加载的正文和角色状态；排除 chapters 时（persist 保存表头）不需要
+    def model_dump(self, **kwargs):
+        if 'chapters' not in (kwargs.get('exclude') or ()):
+            self.ensure_loaded()
+        return super().model_dump(**kwargs)
+
+    def model_dump_json(self, **kwargs):
+        if 'chapters' not in (kwargs.get('exclude') or ()):
+            self.ensure_loaded()
+        return super().model_dump_json(**kwargs)
 
 class ListModel[T](RootModel[T]):
     root: list[T]
@@ -73,6 +180,18 @@ class SectionContentDict(TypedDict):
     content: Annotated[str, ..., Field(description="The generated content for the section.")]
     current_state: Annotated[dict[str, dict], ..., Field(description="The updated state for each character after this section.")]
 
+class NSFWChapterBoundary(BaseModel):
+    chapter: int = Field(..., description="The 1-based number of the chapter this boundary leads into.")
+    start_state: dict[str, NSFWCharacterState] = Field(default_factory=dict, description="The predicted state for each character at the beginning of the chapter.")
+    bridge: str = Field(..., description="A short summary of what has just happened at the end of the previous chapter.")
+
+class NSFWBoundaryPlanResponse(BaseModel):
+    chapters: list[NSFWChapterBoundary] = Field(default_factory=list, description="The predicted boundary for each requested chapter.")
+
+class NSFWBoundaryReconcileResponse(BaseModel):
+    consistent: bool = Field(..., description="Whether the opening of the section is consistent with the actual end of the previous chapter.")
+    content: str | None = Field(default=None, description="The revised content of the section, or null if it is consistent.")
+
 # 兼容旧NSFWNovel JSON数据，递归删除sections下的current_state字段（直接循环实现）
 def clean_legacy_nsfw_novel_json(data: dict) -> dict:
     """
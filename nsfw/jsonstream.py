@@ -0,0 +1,146 @@
+"""
+流式 JSON 的增量解析：模型以 json_mode 流式输出 {"content": "...", "current_state": {...}} 时，
+只扫描新到达的文本，产出 content 字段新增的字符；完整对象（current_state 等）在结束时解析一次。
+
+with_structured_output 的流式解析每收到一个片段都从头解析一遍已收到的全部文本，并产出完整的部分结果，
+一节正文的解析和渲染开销都随长度平方增长。
+"""
+import json
+import re
+
+from langchain_core.utils.json import parse_json_markdown
+
+_BAD_UNICODE_ESCAPE = re.compile(r'(?<!\\)((?:\\\\)*)\\u(?![0-9a-fA-F]{4})')
+_HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+def _hex4(s: str) -> int | None:
+    if len(s) != 4 or any(c not in _HEX_DIGITS for c in s):
+        return None
+    return int(s, 16)
+
+
+class ContentDeltaParser:
+    """
+    feed(text) 返回 field 字段（顶层对象中的字符串）新增的字符，finish() 返回完整解析结果。
+    字段之前的 ```json 等前缀会被跳过；转义序列（含代理对）跨片段时留到下一个片段再解码。
+    """
+
+    def __init__(self, field: str = 'content'):
+        self.field = field
+        self._raw: list[str] = []
+        self._pending = ''
+        # 容器栈（'{' / '['），以及当前是否在字符串内、该字符串是否为键
+        self._stack: list[str] = []
+        self._in_string = False
+        self._is_key = False
+        self._expect_key = False
+        self._key: list[str] = []
+        self._last_key: str | None = None
+        self._capturing = False
+
+    def feed(self, text: str) -> str:
+        self._raw.append(text)
+        text = self._pending + text
+        self._pending = ''
+        out: list[str] = []
+        i, n = 0, len(text)
+        while i < n:
+            if self._in_string:
+                # 字符串内部成段复制到下一个引号或反斜杠
+                j = i
+                while j < n and text[j] != '"' and text[j] != '\\':
+                    j += 1
+                self._collect(text[i:j], out)
+                if j == n:
+                    break
+                if text[j] == '"':
+                    self._end_string()
+                    i = j + 1
+                    continue
+                decoded, size = self._escape(text, j)
+                if size == 0:
+                    self._pending = text[j:]
+                    break
+                self._collect(decoded, out)
+                i = j + size
+                continue
+            c = text[i]
+            i += 1
+            if c == '"':
+                self._in_string = True
+                self._is_key = self._expect_key
+                top = len(self._stack) == 1
+                self._key = []
+                self._capturing = top and not self._is_key and self._last_key == self.field
+            elif c == '{' or c == '[':
+                self._stack.append(c)
+                self._expect_key = c == '{'
+            elif c == '}' or c == ']':
+                if self._stack:
+                    self._stack.pop()
+                self._expect_key = False
+            elif c == ':':
+                self._expect_key = False
+            elif c == ',':
+                self._expect_key = bool(self._stack) and self._stack[-1] == '{'
+        return ''.join(out)
+
+    def _collect(self, s: str, out: list[str]):
+        if not s:
+            return
+        if self._capturing:
+            out.append(s)
+        elif self._is_key and len(self._stack) == 1:
+            self._key.append(s)
+
+    def _end_string(self):
+        if self._is_key and len(self._stack) == 1:
+            self._last_key = ''.join(self._key)
+        self._in_string = False
+        self._is_key = False
+        self._capturing = False
+
+    @staticmethod
+    def _escape(text: str, i: int) -> tuple[str, int]:
+        """
+        解码 text[i] 处（反斜杠）的转义序列，返回 (字符, 长度)；序列不完整时长度为 0。
+        """
+        if i + 1 >= len(text):
+            return '', 0
+        kind = text[i + 1]
+        if kind != 'u':
+            return _ESCAPES.get(kind, kind), 2
+        if i + 6 > len(text):
+            return '', 0
+        code = _hex4(text[i + 2:i + 6])
+        if code is None:
+            # 不合法的 \u 转义原样输出，完整对象由 finish() 容错解析
+            return text[i:i + 2], 2
+        if 0xD800 <= code < 0xDC00:
+            if i + 12 > len(text) and '\\u'.startswith(text[i + 6:i + 8]):
+                return '', 0
+            low = _hex4(text[i + 8:i + 12]) if text[i + 6:i + 8] == '\\u' else None
+            if low is not None and 0xDC00 <= low < 0xE000:
+                return chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)), 12
+        return chr(code), 6
+
+    @property
+    def text(self) -> str:
+        return ''.join(self._raw)
+
+    def finish(self) -> dict:
+        """
+        解析收到的全部文本。模型在 JSON 外包了 markdown 代码块等时退回到 parse_json_markdown。
+        """
+        text = self.text
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            pass
+        try:
+            return parse_json_markdown(text)
+        except json.JSONDecodeError:
+            # 不合法的 \u 转义按原样保留（与 feed 产出的增量一致）后再解析
+            return parse_json_markdown(_BAD_UNICODE_ESCAPE.sub(r'\1\\\\u', text))
@@ -0,0 +1,129 @@
+"""
+正文提示词的滚动记忆：按 token 预算组织章概要、本章节概要和上一节正文，使每次生成正文的提示词大小不随小说长度增长。
+
+- 章概要：当前章前后 FULL_WINDOW 章保留完整概要，更远的章压缩为标题和概要的第一句，仍超出预算时从最远处起省略；
+- 本章节概要：同样以当前节为中心按距离压缩、省略；
+- 上一节正文：只保留末尾 PREV_TAIL_TOKENS 个 token（在段落边界截断）。
+
+token 数由 shared.tokens 按模型计算。
+"""
+import os
+import re
+import sys
+from typing import Callable
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.tokens import TokenCounter, token_counter
+
+# 以下预算均为 token 数，None 表示不限制（与引入滚动记忆之前相同）
+CHAPTER_SUMMARY_TOKENS = 3000
+SECTION_SUMMARY_TOKENS = 1500
+PREV_TAIL_TOKENS = 2500
+# 当前章（节）前后保留完整概要的章（节）数
+FULL_WINDOW = 2
+# 压缩后的单章（节）概要上限
+COMPRESSED_TOKENS = 60
+
+_SENTENCE_END = re.compile(r'(?<=[。！？!?])|(?<=\.)\s')
+
+
+class StoryMemory:
+    """
+    每个 NsfwNovelWriter 一个，随 set_model 切换计数用的模型。
+    """
+
+    def __init__(self, model_name: str | None = None, chapter_tokens: int | None = CHAPTER_SUMMARY_TOKENS,
+                 section_tokens: int | None = SECTION_SUMMARY_TOKENS, prev_tail_tokens: int | None = PREV_TAIL_TOKENS,
+                 full_window: int = FULL_WINDOW):
+        self.chapter_tokens = chapter_tokens
+        self.section_tokens = section_tokens
+        self.prev_tail_tokens = prev_tail_tokens
+        self.full_window = full_window
+        self.counter: TokenCounter | None = None
+        # 最近一次组装的提示词 token 数
+        self.last_prompt_tokens = 0
+        if model_name is not None:
+            self.set_model(model_name)
+
+    def set_model(self, model_name: str):
+        self.counter = token_counter(model_name)
+
+    @property
+    def settings(self) -> tuple:
+        return self.chapter_tokens, self.section_tokens, self.prev_tail_tokens, self.full_window
+
+    def count(self, text: str | None) -> int:
+        return self.counter.count(text) if text else 0
+
+    def head(self, text: str, max_tokens: int) -> str:
+        """
+        text 开头不超过 max_tokens 的部分，被截断时以省略号结尾。
+        """
+        if self.count(text) <= max_tokens:
+            return text
+        return text[:self._fit_length(text, max_tokens, lambda n: text[:n])] + '…'
+
+    def tail(self, text: str | None, max_tokens: int | None) -> str | None:
+        """
+        text 末尾不超过 max_tokens 的部分：尽量保留完整段落，最后一段本身超出预算时按字符截断。
+        """
+        if not text or max_tokens is None or self.count(text) <= max_tokens:
+            return text
+        paragraphs = text.split('\n\n')
+        kept: list[str] = []
+        used = 0
+        for paragraph in reversed(paragraphs):
+            tokens = self.count(paragraph)
+            if used + tokens > max_tokens:
+                break
+            kept.append(paragraph)
+            used += tokens
+        if not kept:
+            last = paragraphs[-1]
+            return '…' + last[len(last) - self._fit_length(last, max_tokens, lambda n: last[len(last) - n:]):]
+        return '…\n\n' + '\n\n'.join(reversed(kept))
+
+    def _fit_length(self, text: str, max_tokens: int, piece: Callable[[int], str]) -> int:
+        # piece(n) 的 token 数不超过 max_tokens 的最大字符数 n
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.counter.measure(piece(mid)) <= max_tokens:
+                low = mid
+            else:
+                high = mid - 1
+        return low
+
+    def compress(self, text: str | None) -> str:
+        """
+        概要的压缩形式：第一句，且不超过 COMPRESSED_TOKENS。
+        """
+        if not text:
+            return ''
+        first = _SENTENCE_END.split(text.strip(), maxsplit=1)[0].strip()
+        return self.head(first, COMPRESSED_TOKENS)
+
+    def fit_lines(self, full: list[str], compressed: list[str], focus: int, max_tokens: int | None,
+                  window: int, omitted: str) -> str:
+        """
+        full[i] / compressed[i] 为第 i 项的完整和压缩形式。距 focus 不超过 window 的项保留完整形式，其余使用压缩形式；
+        仍超出 max_tokens 时从离 focus 最远的项起省略，被省略的连续项合并为一行 omitted.format(count)。
+        """
+        if max_tokens is None or sum(map(self.count, full)) <= max_tokens:
+            return '\n'.join(full)
+        lines = [full[i] if abs(i - focus) <= window else compressed[i] for i in range(len(full))]
+        used = sum(map(self.count, lines))
+        dropped = set()
+        for i in sorted(range(len(lines)), key=lambda i: -abs(i - focus)):
+            if used <= max_tokens or i == focus:
+                break
+            used -= self.count(lines[i])
+            dropped.add(i)
+        result = []
+        for i, line in enumerate(lines):
+            if i not in dropped:
+                result.append(line)
+            elif i - 1 not in dropped:
+                run = next((j for j in range(i, len(lines)) if j not in dropped), len(lines)) - i
+                result.append(omitted.format(run))
+        return '\n'.join(result)
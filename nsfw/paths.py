@@ -0,0 +1,94 @@
+"""
+NSFWNovel 字段路径（如 chapters.0.sections.3.after_state.林晚.clothing）的编译访问器，代替 glom/assign。
+
+路径按模型的字段类型编译一次（属性 / 列表下标 / 字典键），之后每次读写只依次调用 attrgetter/itemgetter，
+不再解析字符串。写入时先比较新旧值，值未变化时不修改对象，也不会把字段标记为已修改。
+"""
+import typing
+from functools import lru_cache
+from operator import attrgetter, itemgetter
+
+from pydantic import BaseModel
+
+from domains import NSFWNovel, TrackedModel
+
+# 缓存的编译路径数上限，足够覆盖一本大型小说的全部控件
+PATH_CACHE_SIZE = 16384
+
+_MISSING = object()
+
+
+class StatePath:
+    """
+    get(root) 读取路径上的值，set(root, value) 写入并返回值是否有变化。
+    最后一步是列表下标或字典键时，路径上最近的 TrackedModel 字段被标记为已修改（对象本身察觉不到容器内部的修改）。
+    """
+    __slots__ = ('path', '_getters', '_last', '_owner')
+
+    def __init__(self, path: str, steps: list[tuple[str, object]], owner: tuple[int, str] | None):
+        self.path = path
+        self._getters = [attrgetter(key) if kind == 'attr' else itemgetter(key) for kind, key in steps]
+        self._last = steps[-1]
+        # (该模型在路径中的深度, 字段名)，仅最后一步为下标/键时使用
+        self._owner = owner
+
+    def get(self, root, default=None):
+        obj = root
+        try:
+            for getter in self._getters:
+                obj = getter(obj)
+        except (AttributeError, IndexError, KeyError):
+            return default
+        return obj
+
+    def set(self, root, value) -> bool:
+        objs = [root]
+        for getter in self._getters[:-1]:
+            objs.append(getter(objs[-1]))
+        parent = objs[-1]
+        kind, key = self._last
+        if kind == 'attr':
+            if getattr(parent, key, _MISSING) == value:
+                return False
+            setattr(parent, key, value)
+            return True
+        current = parent.get(key, _MISSING) if isinstance(parent, dict) else parent[key]
+        if current == value:
+            return False
+        parent[key] = value
+        if self._owner is not None:
+            depth, field = self._owner
+            objs[depth].restore_changed({field})
+        return True
+
+
+def _compile(model: type[BaseModel], path: str) -> StatePath:
+    steps: list[tuple[str, object]] = []
+    owner = None
+    tp = model
+    for part in path.split('.'):
+        origin = typing.get_origin(tp)
+        if isinstance(tp, type) and issubclass(tp, BaseModel):
+            if part not in tp.model_fields:
+                raise ValueError(f"{tp.__name__} has no field {part!r} (path {path!r})")
+            if issubclass(tp, TrackedModel):
+                owner = (len(steps), part)
+            steps.append(('attr', part))
+            tp = tp.model_fields[part].annotation
+        elif origin is list:
+            steps.append(('item', int(part)))
+            tp = typing.get_args(tp)[0]
+        elif origin is dict:
+            steps.append(('item', part))
+            tp = typing.get_args(tp)[1]
+        else:
+            raise ValueError(f"Cannot descend into {tp} at {part!r} (path {path!r})")
+    return StatePath(path, steps, owner if steps[-1][0] == 'item' else None)
+
+
+@lru_cache(maxsize=PATH_CACHE_SIZE)
+def compile_path(path: str, model: type[BaseModel] = NSFWNovel) -> StatePath:
+    """
+    编译（并缓存）model 上的点分路径。路径与模型字段不符时抛出 ValueError。
+    """
+    return _compile(model, path)
@@ -1,62 +1,1152 @@
 import sqlite3
 import json
 import functools
+import logging
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+import asyncio
+import atexit
+import zlib
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from datetime import datetime
-from domains import NSFWNovel
+from typing import Callable
+from domains import NSFWNovel, NSFWChapter, NSFWSection, NSFWCharacterState, TrackedModel, LAZY_SECTION_FIELDS
+import search
+import versions
+
+DB_PATH = 'novel_state.db'
+# 连接池中最多保留的空闲连接数，超出的连接用完即关闭
+POOL_SIZE = 8
+# 写锁被占用时的等待时间（毫秒），超时后才抛出 database is locked
+BUSY_TIMEOUT_MS = 5000
+# 获取写锁超时（database is locked）后的重试次数，每次重试前的等待时间按指数增长
+SAVE_RETRIES = 3
+SAVE_RETRY_BACKOFF = 0.05
+# 后台保存：同一本小说在该时间窗口（秒）内的多次保存请求合并为一次写库
+WRITE_BEHIND_DELAY = 0.5
+# 后台保存队列中最多排队的小说数，队列满时 submit 阻塞等待
+WRITE_BEHIND_MAX_PENDING = 64
+
+# 文本列（state_json、nsfw_section.content）的存储格式：未压缩的旧数据以 TEXT 存储；
+# 压缩数据以 BLOB 存储，首字节为格式版本，其后为 zlib 压缩的 UTF-8 文本
+STORAGE_FORMAT = 1
+# 短于该字节数的文本不压缩
+COMPRESS_MIN_BYTES = 256
+COMPRESS_LEVEL = 6
+# 不写入 state_json 的字段：chapters 分表存储；exported_markdown 由正文导出，可随时重新生成
+HEAD_EXCLUDE = {'chapters', 'exported_markdown'}
+
+# nsfw_novel.layout：LAYOUT_BLOB 的 state_json 是整本小说；
+# LAYOUT_NORMALIZED 的 state_json 只有小说表头，章、节、角色状态各自成行
+LAYOUT_BLOB = 0
+LAYOUT_NORMALIZED = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS nsfw_novel (
+    id TEXT PRIMARY KEY,
+    state_json TEXT,
+    create_time TEXT,
+    update_time TEXT,
+    version INTEGER
+);
+CREATE TABLE IF NOT EXISTS nsfw_chapter (
+    id TEXT PRIMARY KEY,
+    novel_id TEXT NOT NULL REFERENCES nsfw_novel(id) ON DELETE CASCADE,
+    ord INTEGER NOT NULL,
+    title TEXT,
+    overview TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_nsfw_chapter_novel ON nsfw_chapter(novel_id, ord);
+CREATE TABLE IF NOT EXISTS nsfw_section (
+    id TEXT PRIMARY KEY,
+    chapter_id TEXT NOT NULL REFERENCES nsfw_chapter(id) ON DELETE CASCADE,
+    ord INTEGER NOT NULL,
+    title TEXT,
+    overview TEXT,
+    content TEXT,
+    word_count INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_nsfw_section_chapter ON nsfw_section(chapter_id, ord);
+CREATE TABLE IF NOT EXISTS nsfw_character_state (
+    section_id TEXT NOT NULL REFERENCES nsfw_section(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    clothing TEXT,
+    psychological TEXT,
+    physiological TEXT,
+    PRIMARY KEY (section_id, name)
+);
+'''
+
+# 旧数据库缺少的列，建表后通过 ALTER TABLE 补齐
+UPGRADE_COLUMNS = {
+    'nsfw_novel': {
+        'layout': f'INTEGER NOT NULL DEFAULT {LAYOUT_BLOB}',
+        # 历史记录列表用的元数据，保存时更新，列表页不必读取 state_json
+        'title': 'TEXT',
+        'language': 'TEXT',
+        'chapter_count': 'INTEGER NOT NULL DEFAULT 0',
+        'section_count': 'INTEGER NOT NULL DEFAULT 0',
+        'word_count': 'INTEGER NOT NULL DEFAULT 0',
+    },
+    'nsfw_section': {
+        'word_count': 'INTEGER',
+    },
+}
+
+# 依赖补齐列的索引，在 _upgrade_schema 之后创建。
+# 历史记录索引覆盖列表页需要的所有列，按 update_time 键集分页时只扫描索引
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS idx_nsfw_novel_history ON nsfw_novel(
+    update_time DESC, id DESC, title, language, chapter_count, section_count, word_count, create_time, version
+);
+CREATE INDEX IF NOT EXISTS idx_nsfw_novel_title ON nsfw_novel(title);
+'''
+
+# 固定的 SQL 文本会被 sqlite3 按连接缓存为预编译语句。
+# 写小说行时比较并交换：最后一个参数是对象所基于的版本号，与数据库中的不一致时不更新、不返回行；为 None 时不检查
+UPSERT_NOVEL_SQL = f'''
+INSERT INTO nsfw_novel (id, state_json, create_time, update_time, version, layout, title, language, chapter_count, section_count)
+VALUES (?, ?, ?, ?, 1, {LAYOUT_NORMALIZED}, ?, ?, ?, ?)
+ON CONFLICT(id) DO UPDATE SET
+    state_json=excluded.state_json,
+    update_time=excluded.update_time,
+    version=nsfw_novel.version+1,
+    layout=excluded.layout,
+    title=excluded.title,
+    language=excluded.language,
+    chapter_count=excluded.chapter_count,
+    section_count=excluded.section_count
+WHERE ?9 IS NULL OR nsfw_novel.version = ?9
+RETURNING version
+'''
+TOUCH_NOVEL_SQL = '''
+UPDATE nsfw_novel SET update_time=?, version=version+1, chapter_count=?, section_count=?
+WHERE id=? AND (?5 IS NULL OR version = ?5) RETURNING version
+'''
+RECOUNT_WORDS_SQL = '''
+UPDATE nsfw_novel SET word_count=(
+    SELECT COALESCE(SUM(s.word_count), 0) FROM nsfw_section s JOIN nsfw_chapter c ON s.chapter_id = c.id WHERE c.novel_id=?
+) WHERE id=?
+'''
+UPSERT_CHAPTER_SQL = '''
+INSERT INTO nsfw_chapter (id, novel_id, ord, title, overview) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT(id) DO UPDATE SET
+    novel_id=excluded.novel_id, ord=excluded.ord, title=excluded.title, overview=excluded.overview
+'''
+UPSERT_SECTION_SQL = '''
+INSERT INTO nsfw_section (id, chapter_id, ord, title, overview, content, word_count) VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(id) DO UPDATE SET
+    chapter_id=excluded.chapter_id, ord=excluded.ord, title=excluded.title,
+    overview=excluded.overview, content=excluded.content, word_count=excluded.word_count
+'''
+INSERT_STATE_SQL = 'INSERT INTO nsfw_character_state (section_id, name, clothing, psychological, physiological) VALUES (?, ?, ?, ?, ?)'
+
+# 可按列单独更新的字段（after_state 另存于 nsfw_character_state）
+CHAPTER_COLUMNS = ('title', 'overview')
+SECTION_COLUMNS = ('title', 'overview', 'content')
+
+
+# 中日韩按字计数，其他文字按词计数
+_WORD_RE = re.compile(rf'[{search.CJK_CHARS}]|[^\W{search.CJK_CHARS}]+')
+
+
+def encode_text(text: str | None) -> str | bytes | None:
+    """
+    按 STORAGE_FORMAT 压缩较长的文本，较短的文本原样返回。
+    """
+    if text is None:
+        return None
+    raw = text.encode('utf-8')
+    if len(raw) < COMPRESS_MIN_BYTES:
+        return text
+    return bytes([STORAGE_FORMAT]) + zlib.compress(raw, COMPRESS_LEVEL)
+
+
+def decode_text(value: str | bytes | None) -> str | None:
+    """
+    读取 encode_text 写入的值，兼容未压缩的旧数据。
+    """
+    if value is None or isinstance(value, str):
+        return value
+    if value[0] != STORAGE_FORMAT:
+        raise ValueError(f"Unknown storage format: {value[0]}")
+    return zlib.decompress(value[1:]).decode('utf-8')
+
+
+def count_words(text: str | None) -> int:
+    """
+    统计正文字数：中日韩文字每字计一，其他文字每个单词计一。
+    """
+    return len(_WORD_RE.findall(text)) if text else 0
+
+
+def _upgrade_schema(conn: sqlite3.Connection):
+    added = set()
+    for table, columns in UPGRADE_COLUMNS.items():
+        existing = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+        for name, ddl in columns.items():
+            if name not in existing:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {ddl}')
+                added.add((table, name))
+    if ('nsfw_novel', 'word_count') in added or ('nsfw_section', 'word_count') in added:
+        _backfill_metadata(conn)
+
+
+def _backfill_metadata(conn: sqlite3.Connection):
+    """
+    为加列之前保存的记录补算历史记录元数据，逐行读取，不一次性载入所有小说。
+    """
+    section_ids = [row[0] for row in conn.execute('SELECT id FROM nsfw_section WHERE word_count IS NULL')]
+    for sid in section_ids:
+        content = decode_text(conn.execute('SELECT content FROM nsfw_section WHERE id=?', (sid,)).fetchone()[0])
+        conn.execute('UPDATE nsfw_section SET word_count=? WHERE id=?', (count_words(content), sid))
+    novel_ids = [row[0] for row in conn.execute('SELECT id FROM nsfw_novel')]
+    for novel_id in novel_ids:
+        state_json, layout = conn.execute('SELECT state_json, layout FROM nsfw_novel WHERE id=?', (novel_id,)).fetchone()
+        try:
+            state = json.loads(decode_text(state_json))
+        except (TypeError, ValueError):
+            continue
+        if layout == LAYOUT_BLOB:
+            chapters = state.get('chapters') or []
+            sections = [s for c in chapters for s in c.get('sections') or []]
+            conn.execute('UPDATE nsfw_novel SET title=?, language=?, chapter_count=?, section_count=?, word_count=? WHERE id=?',
+                         (state.get('title'), state.get('language'), len(chapters), len(sections),
+                          sum(count_words(s.get('content')) for s in sections), novel_id))
+        else:
+            chapter_count, section_count = conn.execute(
+                'SELECT COUNT(DISTINCT c.id), COUNT(s.id) FROM nsfw_chapter c LEFT JOIN nsfw_section s ON s.chapter_id = c.id '
+                'WHERE c.novel_id=?', (novel_id,)).fetchone()
+            conn.execute('UPDATE nsfw_novel SET title=?, language=?, chapter_count=?, section_count=? WHERE id=?',
+                         (state.get('title'), state.get('language'), chapter_count, section_count, novel_id))
+            conn.execute(RECOUNT_WORDS_SQL, (novel_id, novel_id))
+
+
+class ConnectionPool:
+    """
+    进程内共享的 SQLite 连接池，所有 Streamlit 会话（脚本线程）共用。
+    连接以 WAL 模式打开并设置 busy timeout，建表只在创建连接池时执行一次。
+    """
+
+    def __init__(self, db_path: str, size: int = POOL_SIZE):
+        self.db_path = db_path
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue(maxsize=size)
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+            search_created = search.ensure_schema(conn)
+            versions.ensure_schema(conn)
+            # 补列、补算元数据和重建索引放在一个事务里，避免逐行提交
+            conn.execute('BEGIN IMMEDIATE')
+            _upgrade_schema(conn)
+            if search_created:
+                _rebuild_search_index(conn)
+            conn.commit()
+            conn.executescript(INDEXES)
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None：由 transaction() 显式控制事务边界
+        conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                self._idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    @contextmanager
+    def transaction(self, immediate: bool = False):
+        """
+        在一个事务中执行，正常退出时提交，异常时回滚。
+        immediate=True 时一开始就获取写锁，避免读后写升级锁时的死锁。
+        """
+        with self.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pool: ConnectionPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """
+    获取进程级共享连接池，首次调用时创建。
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_PATH)
+    return _pool
+
+
+def set_db_path(db_path: str):
+    """
+    切换数据库文件（用于基准测试和维护脚本），先写完后台队列再关闭旧连接池。
+    """
+    global _pool, DB_PATH
+    if _persister is not None:
+        _persister.flush()
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        DB_PATH = db_path
+        _pool = None
+
 
 def persist_novel_state(method):
     @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
         result = method(self, *args, **kwargs)
         novel = self.state
-        save(novel)
+        save_async(novel)
         return result
     return wrapper
 
+
+class NovelConflictError(Exception):
+    """
+    保存时数据库中的小说已被其他会话修改（或删除）。本地修改仍保留在对象上，
+    可用 merge_novel 以节为粒度合并后重新保存。
+    """
+
+    def __init__(self, novel_id: str, expected: int | None, actual: int | None):
+        self.novel_id = novel_id
+        self.expected = expected
+        self.actual = actual
+        if actual is None:
+            super().__init__(f"Novel {novel_id} was deleted by another session")
+        else:
+            super().__init__(f"Novel {novel_id} is at version {actual}, expected {expected}")
+
+
+@dataclass
+class _NovelChanges:
+    """
+    一次保存需要写入的行，由 _collect_changes 在写库之前一次性收集。
+    """
+    novel_id: str
+    full_rewrite: bool
+    head_json: str | None = None
+    # 历史记录元数据：(title, language, chapter_count, section_count)
+    meta: tuple = ()
+    # 有正文写入或删除时重新汇总小说字数
+    recount_words: bool = False
+    # 需要重建的检索文档：小说文档 (title, body)，以及各节 section_id -> (title, body)
+    search_novel: tuple[str, str] | None = None
+    search_sections: dict[str, tuple[str, str]] = field(default_factory=dict)
+    # 相对上一版本的 JSON Patch（见 versions 模块），整体重写时为 None，改存关键帧
+    patch: list[dict] | None = None
+    # 本次保存时的章列表，需要存关键帧时使用
+    chapters: list[NSFWChapter] = field(default_factory=list)
+    chapter_upserts: list[tuple] = field(default_factory=list)
+    chapter_updates: list[tuple[str, dict]] = field(default_factory=list)
+    section_upserts: list[tuple] = field(default_factory=list)
+    section_updates: list[tuple[str, dict]] = field(default_factory=list)
+    # section_id -> 该节全部角色状态行（整体替换）
+    states: dict[str, list[tuple]] = field(default_factory=dict)
+    deleted_chapters: list[str] = field(default_factory=list)
+    deleted_sections: list[str] = field(default_factory=list)
+    # 已清除修改标记的对象及其字段，写库失败时恢复
+    touched: list[tuple[TrackedModel, set[str]]] = field(default_factory=list)
+    snapshot: dict = field(default_factory=dict)
+
+    def is_empty(self) -> bool:
+        return not (self.full_rewrite or self.head_json is not None or self.chapter_upserts or self.chapter_updates
+                    or self.section_upserts or self.section_updates or self.states
+                    or self.deleted_chapters or self.deleted_sections)
+
+
+def _take_changed(changes: _NovelChanges, obj: TrackedModel) -> set[str]:
+    # 先清除标记再读取字段：读取期间发生的修改会重新标记，下次保存时写入
+    fields = obj.take_changed()
+    if fields:
+        changes.touched.append((obj, fields))
+    return fields
+
+
+def _state_rows(section_id: str, after_state: dict[str, NSFWCharacterState]) -> list[tuple]:
+    return [(section_id, name, s.clothing, s.psychological, s.physiological) for name, s in after_state.items()]
+
+
+def _collect_changes(novel: NSFWNovel) -> _NovelChanges:
+    """
+    对比上次保存的快照和各对象的修改标记，找出需要写入的表头、章、节和角色状态。
+    开销只与有变化的行数成正比，未修改的正文不会被序列化。
+    """
+    prev = novel._persisted
+    changes = _NovelChanges(novel_id=novel.uuid, full_rewrite=prev is None)
+    if prev is None:
+        prev = {'head': None, 'chapters': {}, 'sections': {}}
+    head_json = novel.model_dump_json(exclude=HEAD_EXCLUDE)
+    if head_json != prev['head']:
+        changes.head_json = head_json
+    chapters_snapshot: dict[str, int] = {}
+    sections_snapshot: dict[str, tuple[str, int]] = {}
+    # 按章顺序记录各章的节 id，以及有变化的节对象，用于生成版本补丁
+    section_lists: dict[str, list[str]] = {}
+    changed_sections: dict[str, NSFWSection] = {}
+    changes.chapters = list(novel.chapters)
+    for cord, chapter in enumerate(changes.chapters):
+        cid = chapter.row_id
+        fields = _take_changed(changes, chapter)
+        if cid is None or cid not in prev['chapters']:
+            if cid is None:
+                cid = chapter.row_id = uuid.uuid4().hex
+            changes.chapter_upserts.append((cid, novel.uuid, cord, chapter.title, chapter.overview))
+        else:
+            values = {name: getattr(chapter, name) for name in CHAPTER_COLUMNS if name in fields}
+            if prev['chapters'][cid] != cord:
+                values['ord'] = cord
+            if values:
+                changes.chapter_updates.append((cid, values))
+        chapters_snapshot[cid] = cord
+        section_lists[cid] = []
+        for sord, section in enumerate(list(chapter.sections)):
+            sid = section.row_id
+            fields = _take_changed(changes, section)
+            states_changed = 'after_state' in fields
+            # 尚未延迟加载的角色状态不可能被修改，直接读 __dict__ 以免触发加载
+            for state in section.__dict__.get('after_state', {}).values():
+                states_changed = bool(_take_changed(changes, state)) or states_changed
+            if sid is None or sid not in prev['sections']:
+                if sid is None:
+                    sid = section.row_id = uuid.uuid4().hex
+                changes.section_upserts.append((sid, cid, sord, section.title, section.overview, section.content, count_words(section.content)))
+                changes.search_sections[sid] = search.section_doc(section)
+                changed_sections[sid] = section
+                states_changed = True
+            else:
+                values = {name: getattr(section, name) for name in SECTION_COLUMNS if name in fields}
+                if values:
+                    changes.search_sections[sid] = search.section_doc(section)
+                if 'content' in values:
+                    values['word_count'] = count_words(values['content'])
+                if prev['sections'][sid] != (cid, sord):
+                    values['chapter_id'] = cid
+                    values['ord'] = sord
+                if values:
+                    changes.section_updates.append((sid, values))
+                    changed_sections[sid] = section
+            if states_changed:
+                changes.states[sid] = _state_rows(sid, section.after_state)
+                changed_sections[sid] = section
+            sections_snapshot[sid] = (cid, sord)
+            section_lists[cid].append(sid)
+    changes.deleted_sections = [sid for sid in prev['sections'] if sid not in sections_snapshot]
+    changes.deleted_chapters = [cid for cid in prev['chapters'] if cid not in chapters_snapshot]
+    changes.meta = (novel.title, novel.language, len(chapters_snapshot), len(sections_snapshot))
+    changes.recount_words = bool(changes.section_upserts or changes.deleted_sections
+                                 or any('content' in values for _, values in changes.section_updates))
+    if (changes.full_rewrite or changes.head_json is not None or changes.chapter_upserts
+            or changes.chapter_updates or changes.deleted_chapters):
+        changes.search_novel = search.novel_doc(novel.title, novel.overview, [c.model_dump() for c in novel.characters],
+                                                [(c.title, c.overview) for c in novel.chapters])
+    changes.patch = _build_patch(changes, prev, section_lists, changed_sections)
+    changes.snapshot = {'head': head_json, 'chapters': chapters_snapshot, 'sections': sections_snapshot}
+    return changes
+
+
+def _build_patch(changes: _NovelChanges, prev: dict, section_lists: dict[str, list[str]],
+                 changed_sections: dict[str, NSFWSection]) -> list[dict] | None:
+    """
+    把收集到的行变化转换为 versions 文档上的 JSON Patch；整体重写时无法计算增量，返回 None。
+    """
+    if changes.full_rewrite:
+        return None
+    op = versions.op
+    ops = []
+    if changes.head_json is not None:
+        old, new = json.loads(prev['head']), json.loads(changes.head_json)
+        ops += [op('replace', 'head', k, value=v) for k, v in new.items() if k not in old or old[k] != v]
+        ops += [op('remove', 'head', k) for k in old if k not in new]
+    new_chapters = set()
+    for cid, _, _, title, overview in changes.chapter_upserts:
+        new_chapters.add(cid)
+        ops.append(op('add', 'chapters', cid, value={'title': title, 'overview': overview, 'sections': section_lists[cid]}))
+    for cid, values in changes.chapter_updates:
+        ops += [op('replace', 'chapters', cid, k, value=values[k]) for k in CHAPTER_COLUMNS if k in values]
+    if new_chapters or changes.deleted_chapters or any('ord' in values for _, values in changes.chapter_updates):
+        ops.append(op('replace', 'order', value=list(section_lists)))
+    # 节列表有变化的章：有节新增、移入移出、调整顺序或删除
+    affected = set()
+    for row in changes.section_upserts:
+        sid, cid = row[0], row[1]
+        affected.add(cid)
+        ops.append(op('add', 'sections', sid, value=versions.section_doc(changed_sections[sid])))
+    for sid, values in changes.section_updates:
+        ops += [op('replace', 'sections', sid, k, value=values[k]) for k in SECTION_COLUMNS if k in values]
+        if 'ord' in values:
+            affected.update((values['chapter_id'], prev['sections'][sid][0]))
+    for sid in changes.states:
+        if sid in prev['sections']:
+            ops.append(op('replace', 'sections', sid, 'after_state', value=versions.section_doc(changed_sections[sid])['after_state']))
+    for sid in changes.deleted_sections:
+        affected.add(prev['sections'][sid][0])
+        ops.append(op('remove', 'sections', sid))
+    for cid in affected - new_chapters:
+        if cid in section_lists:
+            ops.append(op('replace', 'chapters', cid, 'sections', value=section_lists[cid]))
+    ops += [op('remove', 'chapters', cid) for cid in changes.deleted_chapters]
+    return ops
+
+
+def _update_sql(table: str, columns) -> str:
+    return f"UPDATE {table} SET {', '.join(f'{c}=?' for c in columns)} WHERE id=?"
+
+
+def _write_changes(conn: sqlite3.Connection, changes: _NovelChanges, now: str, expected: int | None) -> int:
+    """
+    在事务中写入变化，返回新的版本号。小说行最先写入，版本号不符时抛出 NovelConflictError，事务回滚。
+    """
+    if changes.head_json is not None or changes.full_rewrite:
+        row = conn.execute(UPSERT_NOVEL_SQL, (changes.novel_id, encode_text(changes.snapshot['head']), now, now,
+                                              *changes.meta, expected)).fetchone()
+    else:
+        row = conn.execute(TOUCH_NOVEL_SQL, (now, *changes.meta[2:], changes.novel_id, expected)).fetchone()
+    if row is None:
+        actual = conn.execute('SELECT version FROM nsfw_novel WHERE id=?', (changes.novel_id,)).fetchone()
+        raise NovelConflictError(changes.novel_id, expected, actual and actual[0])
+    version = row[0]
+    if changes.full_rewrite:
+        # 未与数据库同步过的对象（新建、从 JSON 导入或恢复的历史版本）整体重写，先清掉旧的章节行和检索文档
+        conn.execute('DELETE FROM nsfw_chapter WHERE novel_id=?', (changes.novel_id,))
+        search.clear_novel(conn, changes.novel_id)
+    conn.executemany(UPSERT_CHAPTER_SQL, changes.chapter_upserts)
+    for cid, values in changes.chapter_updates:
+        conn.execute(_update_sql('nsfw_chapter', values), (*values.values(), cid))
+    conn.executemany(UPSERT_SECTION_SQL, [(*row[:5], encode_text(row[5]), row[6]) for row in changes.section_upserts])
+    for sid, values in changes.section_updates:
+        if 'content' in values:
+            values = {**values, 'content': encode_text(values['content'])}
+        conn.execute(_update_sql('nsfw_section', values), (*values.values(), sid))
+    for sid, rows in changes.states.items():
+        conn.execute('DELETE FROM nsfw_character_state WHERE section_id=?', (sid,))
+        conn.executemany(INSERT_STATE_SQL, rows)
+    # 节可能已移到新章下，所以先处理节再删除章
+    conn.executemany('DELETE FROM nsfw_section WHERE id=?', [(sid,) for sid in changes.deleted_sections])
+    conn.executemany('DELETE FROM nsfw_chapter WHERE id=?', [(cid,) for cid in changes.deleted_chapters])
+    if changes.recount_words or changes.full_rewrite:
+        conn.execute(RECOUNT_WORDS_SQL, (changes.novel_id, changes.novel_id))
+    # 被删除节的检索文档随外键级联删除
+    if changes.search_novel is not None:
+        search.index_novel_doc(conn, changes.novel_id, *changes.search_novel)
+    for sid, (title, body) in changes.search_sections.items():
+        search.index_section_doc(conn, changes.novel_id, sid, title, body)
+    versions.record(conn, changes.novel_id, version, changes.patch,
+                    lambda: versions.document(json.loads(changes.snapshot['head']), changes.chapters))
+    return version
+
+
+def _is_locked(error: sqlite3.OperationalError) -> bool:
+    return 'locked' in str(error) or 'busy' in str(error)
+
+
 def save(novel: NSFWNovel):
-    db_path = 'novel_state.db'
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS nsfw_novel (
-        id TEXT PRIMARY KEY,
-        state_json TEXT,
-        create_time TEXT,
-        update_time TEXT,
-        version INTEGER
-    )''')
+    """
+    增量保存小说：只写入自上次保存以来有变化的表头、章、节和角色状态行。
+    没有任何变化时不访问数据库。
+    数据库中的版本号与对象所基于的版本号不一致时抛出 NovelConflictError，并记录在 novel._conflict 上，
+    解决之前的保存都直接抛出该异常；等待写锁超时则退避重试 SAVE_RETRIES 次。
+    """
+    if novel._conflict is not None:
+        raise novel._conflict
+    changes = _collect_changes(novel)
+    if changes.is_empty():
+        return
     now = datetime.now().isoformat()
-    state_json = novel.model_dump_json()
-    c.execute('SELECT id FROM nsfw_novel WHERE id=?', (novel.uuid,))
-    row = c.fetchone()
-    if row:
-        c.execute('UPDATE nsfw_novel SET state_json=?, update_time=?, version=version+1 WHERE id=?',
-                    (state_json, now, novel.uuid))
-    else:
-        c.execute('INSERT INTO nsfw_novel (id, state_json, create_time, update_time, version) VALUES (?, ?, ?, ?, ?)',
-                    (novel.uuid, state_json, now, now, 1))
-    conn.commit()
-    conn.close()
-
-def get_history_page(page: int, page_size: int):
-    db_path = 'novel_state.db'
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS nsfw_novel (
-        id TEXT PRIMARY KEY,
-        state_json TEXT,
-        create_time TEXT,
-        update_time TEXT,
-        version INTEGER
-    )''')
-    total_count = c.execute('SELECT COUNT(*) FROM nsfw_novel').fetchone()[0]
-    rows = c.execute('SELECT id, state_json, create_time, update_time, version FROM nsfw_novel ORDER BY update_time DESC LIMIT ? OFFSET ?', (page_size, (page-1)*page_size)).fetchall()
-    conn.close()
-    return total_count, rows
+    try:
+        for attempt in range(SAVE_RETRIES + 1):
+            try:
+                with get_pool().transaction(immediate=True) as conn:
+                    version = _write_changes(conn, changes, now, novel._version)
+                break
+            except sqlite3.OperationalError as e:
+                if not _is_locked(e) or attempt == SAVE_RETRIES:
+                    raise
+                # 加随机抖动，避免多个写者同时醒来再次争抢
+                time.sleep(SAVE_RETRY_BACKOFF * 2 ** attempt * (1 + random.random()))
+    except BaseException as e:
+        if isinstance(e, NovelConflictError):
+            novel._conflict = e
+        for obj, fields in changes.touched:
+            obj.restore_changed(fields)
+        raise
+    novel._persisted = changes.snapshot
+    novel._version = version
+
+
+def _build_states(state_rows) -> dict[str, dict[str, NSFWCharacterState]]:
+    states: dict[str, dict[str, NSFWCharacterState]] = {}
+    for sid, name, clothing, psychological, physiological in state_rows:
+        states.setdefault(sid, {})[name] = NSFWCharacterState(clothing=clothing, psychological=psychological, physiological=physiological)
+    return states
+
+
+class _LazySectionLoader:
+    """
+    load_novel(lazy=True) 返回的小说共用一个加载器：某一节首次读取正文或角色状态时，
+    一次读取它加载时所在章的所有未加载节。读取的是数据库中的当前内容，若期间被其他会话修改，保存时会报告冲突。
+    """
+
+    def __init__(self):
+        self._groups: dict[str, list[NSFWSection]] = {}
+        # Streamlit 脚本线程和后台保存线程都可能触发加载
+        self._lock = threading.Lock()
+
+    def add(self, chapter_id: str, section: NSFWSection):
+        self._groups.setdefault(chapter_id, []).append(section)
+        section.__pydantic_private__['_loader'] = functools.partial(self.load, chapter_id)
+
+    def load(self, chapter_id: str):
+        with self._lock:
+            sections = self._groups.pop(chapter_id, None)
+            if not sections:
+                return
+            ids = [section.row_id for section in sections]
+            marks = ','.join('?' * len(ids))
+            with get_pool().connection() as conn:
+                contents = dict(conn.execute(f'SELECT id, content FROM nsfw_section WHERE id IN ({marks})', ids).fetchall())
+                states = _build_states(conn.execute(
+                    f'SELECT section_id, name, clothing, psychological, physiological FROM nsfw_character_state '
+                    f'WHERE section_id IN ({marks}) ORDER BY rowid', ids))
+            for section in sections:
+                # 已在本地赋值的字段保留本地值；其他会话删除的节按空内容处理
+                section.__dict__.setdefault('content', decode_text(contents.get(section.row_id)))
+                section.__dict__.setdefault('after_state', states.get(section.row_id, {}))
+                section.__pydantic_private__['_loader'] = None
+
+
+def load_novel(uuid: str, lazy: bool = False) -> NSFWNovel | None:
+    """
+    从数据库读取小说，兼容整本 JSON 存储的旧记录。
+    lazy=True 时只读取表头、章和节的标题与概要，节正文和角色状态在首次访问时按章读取，
+    适合只浏览部分章节的场景（例如从历史记录导入）。
+    """
+    if _persister is not None:
+        _persister.flush(uuid)
+    with get_pool().connection() as conn:
+        row = conn.execute('SELECT state_json, layout, version FROM nsfw_novel WHERE id=?', (uuid,)).fetchone()
+        if row is None:
+            return None
+        state_json, layout, version = decode_text(row[0]), row[1], row[2]
+        if layout == LAYOUT_BLOB:
+            # 旧记录：下次保存时会整体重写为分表存储
+            novel = NSFWNovel.model_validate_json(state_json)
+            novel._version = version
+            return novel
+        chapter_rows = conn.execute(
+            'SELECT id, title, overview FROM nsfw_chapter WHERE novel_id=? ORDER BY ord', (uuid,)).fetchall()
+        section_rows = conn.execute(
+            f"SELECT s.id, s.chapter_id, s.title, s.overview, {'NULL' if lazy else 's.content'} FROM nsfw_section s "
+            'JOIN nsfw_chapter c ON s.chapter_id = c.id WHERE c.novel_id=? ORDER BY c.ord, s.ord', (uuid,)).fetchall()
+        states = {} if lazy else _build_states(conn.execute(
+            'SELECT cs.section_id, cs.name, cs.clothing, cs.psychological, cs.physiological FROM nsfw_character_state cs '
+            'JOIN nsfw_section s ON cs.section_id = s.id JOIN nsfw_chapter c ON s.chapter_id = c.id '
+            'WHERE c.novel_id=? ORDER BY cs.rowid', (uuid,)))
+    chapters: dict[str, NSFWChapter] = {}
+    for cid, title, overview in chapter_rows:
+        chapters[cid] = NSFWChapter(title=title, overview=overview)
+        chapters[cid].row_id = cid
+    sections_snapshot = {}
+    loader = _LazySectionLoader() if lazy else None
+    for sid, cid, title, overview, content in section_rows:
+        section = NSFWSection(title=title, overview=overview, content=decode_text(content), after_state=states.get(sid, {}))
+        section.row_id = sid
+        if loader is not None:
+            # 去掉未读取的字段，访问时由 NSFWSection.__getattr__ 触发加载
+            for name in LAZY_SECTION_FIELDS:
+                del section.__dict__[name]
+            loader.add(cid, section)
+        chapter = chapters[cid]
+        sections_snapshot[sid] = (cid, len(chapter.sections))
+        chapter.sections.append(section)
+    # 通过构造函数创建的对象没有修改标记，加载后即为“已同步”状态
+    novel = NSFWNovel.model_validate_json(state_json)
+    novel.chapters = list(chapters.values())
+    novel._persisted = {
+        'head': novel.model_dump_json(exclude=HEAD_EXCLUDE),
+        'chapters': {cid: cord for cord, cid in enumerate(chapters)},
+        'sections': sections_snapshot,
+    }
+    novel._version = version
+    return novel
+
+
+HISTORY_COLUMNS = 'id, title, language, chapter_count, section_count, word_count, create_time, update_time, version'
+
+
+def get_history_page(cursor: tuple[str, str] | None, page_size: int):
+    """
+    按更新时间倒序的键集分页，只读取元数据列（走覆盖索引，不读取小说正文）。
+    cursor 为上一页最后一行的 (update_time, id)，None 表示第一页。
+    返回 (rows, next_cursor)，没有下一页时 next_cursor 为 None。
+    """
+    with get_pool().connection() as conn:
+        if cursor is None:
+            rows = conn.execute(f'SELECT {HISTORY_COLUMNS} FROM nsfw_novel ORDER BY update_time DESC, id DESC LIMIT ?',
+                                (page_size + 1,)).fetchall()
+        else:
+            rows = conn.execute(f'SELECT {HISTORY_COLUMNS} FROM nsfw_novel WHERE (update_time, id) < (?, ?) '
+                                'ORDER BY update_time DESC, id DESC LIMIT ?', (*cursor, page_size + 1)).fetchall()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = (rows[-1][7], rows[-1][0])
+    return rows, next_cursor
+
+def search_novels(query: str, page: int, page_size: int):
+    """
+    按相关度分页检索小说标题、概要、角色、章节概要和正文。
+    返回 (rows, has_next)，每行为 HISTORY_COLUMNS 各列加上命中片段 snippet。
+    """
+    with get_pool().connection() as conn:
+        hits = search.search(conn, query, HISTORY_COLUMNS, page_size + 1, (page - 1) * page_size)
+        rows = []
+        for hit in hits[:page_size]:
+            *columns, section_id, _ = hit
+            if section_id is not None:
+                title, overview, content = conn.execute(
+                    'SELECT title, overview, content FROM nsfw_section WHERE id=?', (section_id,)).fetchone()
+                text = '\n'.join(filter(None, [title, overview, decode_text(content)]))
+            else:
+                state = json.loads(decode_text(conn.execute('SELECT state_json FROM nsfw_novel WHERE id=?', (columns[0],)).fetchone()[0]))
+                text = search.novel_doc(state.get('title'), state.get('overview'), state.get('characters') or [], [])[1]
+            rows.append((*columns, search.make_snippet(text, query)))
+    return rows, len(hits) > page_size
+
+
+def _rebuild_search_index(conn: sqlite3.Connection):
+    """
+    为检索表创建之前保存的记录建立索引，逐本读取。
+    整本 JSON 存储的旧记录作为一个小说文档索引，重新保存为分表存储后再按节索引。
+    """
+    novel_ids = [row[0] for row in conn.execute('SELECT id FROM nsfw_novel')]
+    for novel_id in novel_ids:
+        state_json, layout = conn.execute('SELECT state_json, layout FROM nsfw_novel WHERE id=?', (novel_id,)).fetchone()
+        try:
+            state = json.loads(decode_text(state_json))
+        except (TypeError, ValueError):
+            continue
+        if layout == LAYOUT_BLOB:
+            chapters = state.get('chapters') or []
+            title, body = search.novel_doc(state.get('title'), state.get('overview'), state.get('characters') or [],
+                                           [(c.get('title'), c.get('overview')) for c in chapters])
+            sections = [s for c in chapters for s in c.get('sections') or []]
+            body = '\n'.join([body] + ['\n'.join(filter(None, [s.get('title'), s.get('overview'), s.get('content')])) for s in sections])
+            search.index_novel_doc(conn, novel_id, title, body)
+            continue
+        chapters = conn.execute('SELECT title, overview FROM nsfw_chapter WHERE novel_id=? ORDER BY ord', (novel_id,)).fetchall()
+        search.index_novel_doc(conn, novel_id, *search.novel_doc(state.get('title'), state.get('overview'), state.get('characters') or [], chapters))
+        section_rows = conn.execute(
+            'SELECT s.id, s.title, s.overview, s.content FROM nsfw_section s JOIN nsfw_chapter c ON s.chapter_id = c.id '
+            'WHERE c.novel_id=?', (novel_id,)).fetchall()
+        for sid, title, overview, content in section_rows:
+            search.index_section_doc(conn, novel_id, sid, title or '', '\n'.join(filter(None, [overview, decode_text(content)])))
+
+
+def list_versions(uuid: str) -> list[tuple]:
+    """
+    返回小说的历史版本 (version, keyframe, 压缩后字节数, create_time)，新版本在前。
+    """
+    if _persister is not None:
+        _persister.flush(uuid)
+    with get_pool().connection() as conn:
+        return versions.list_versions(conn, uuid)
+
+
+def restore_version(uuid: str, version: int) -> NSFWNovel | None:
+    """
+    还原小说的指定历史版本。返回的对象未与数据库同步，保存时会整体重写为一个新版本；
+    期间小说若被其他会话修改，保存时报告冲突。
+    """
+    with get_pool().connection() as conn:
+        doc = versions.restore(conn, uuid, version)
+        current = conn.execute('SELECT version FROM nsfw_novel WHERE id=?', (uuid,)).fetchone()
+    if doc is None:
+        return None
+    novel = NSFWNovel.model_validate(versions.to_novel_dict(doc))
+    novel._version = current and current[0]
+    return novel
+
+
+def _section_dirty(section: NSFWSection) -> set[str]:
+    fields = set(section.changed_fields)
+    if any(state.changed_fields for state in section.__dict__.get('after_state', {}).values()):
+        fields.add('after_state')
+    return fields
+
+
+def merge_novel(local: NSFWNovel) -> tuple[NSFWNovel, list[str]]:
+    """
+    以节为粒度把本地未保存的修改合并到数据库中的最新版本，用于解决 NovelConflictError：
+    本地修改过的表头字段、章标题/概要、节字段和角色状态覆盖数据库中的值，本地新增的章、节插入到相同位置，
+    本地删除的章、节被删除，其余内容以数据库为准。
+    返回合并后的小说（保存后即写入合并结果）以及两边都修改过、以本地为准的节 id。
+    """
+    theirs = load_novel(local.uuid, lazy=True)
+    if theirs is None:
+        # 已被其他会话删除：按本地内容重新创建
+        local._persisted, local._version, local._conflict = None, None, None
+        return local, []
+    prev = local._persisted or {'head': None, 'chapters': {}, 'sections': {}}
+    base = None
+    if local._version is not None:
+        with get_pool().connection() as conn:
+            base = versions.restore(conn, local.uuid, local._version)
+
+    base_head = json.loads(prev['head']) if prev['head'] else {}
+    for name, value in json.loads(local.model_dump_json(exclude=HEAD_EXCLUDE)).items():
+        if base_head.get(name) != value:
+            setattr(theirs, name, getattr(local, name))
+
+    their_chapters = {c.row_id: c for c in theirs.chapters}
+    their_sections = {s.row_id: s for c in theirs.chapters for s in c.sections}
+    local_chapters = {c.row_id for c in local.chapters}
+    local_sections = {s.row_id for c in local.chapters for s in c.sections}
+    # 本地删除的章、节
+    for cid in prev['chapters']:
+        if cid not in local_chapters and cid in their_chapters:
+            theirs.chapters.remove(their_chapters.pop(cid))
+    for sid in prev['sections']:
+        if sid not in local_sections and sid in their_sections:
+            section = their_sections.pop(sid)
+            for chapter in theirs.chapters:
+                if section in chapter.sections:
+                    chapter.sections.remove(section)
+
+    conflicts = []
+    for cord, chapter in enumerate(local.chapters):
+        target = their_chapters.get(chapter.row_id)
+        if target is None:
+            # 本地新增，或已被其他会话删除但本地还有修改
+            if chapter.row_id not in prev['chapters'] or chapter.changed_fields or any(map(_section_dirty, chapter.sections)):
+                theirs.chapters.insert(min(cord, len(theirs.chapters)), chapter)
+            continue
+        for name in chapter.changed_fields & {'title', 'overview'}:
+            setattr(target, name, getattr(chapter, name))
+        for sord, section in enumerate(chapter.sections):
+            fields = _section_dirty(section)
+            existing = their_sections.get(section.row_id)
+            if existing is None:
+                if section.row_id not in prev['sections'] or fields:
+                    target.sections.insert(min(sord, len(target.sections)), section)
+                continue
+            if not fields:
+                continue
+            # 只有本地修改的字段在数据库中也被改过才算冲突；缺少基准版本时与本地值比较
+            their_doc = versions.section_doc(existing)
+            base_section = (base and base['sections'].get(section.row_id)) or versions.section_doc(section)
+            if any(their_doc[k] != base_section[k] for k in fields):
+                conflicts.append(section.row_id)
+            for name in fields:
+                setattr(existing, name, getattr(section, name))
+    return theirs, conflicts
+
+
+def compact_versions(keep: int, uuid: str | None = None) -> int:
+    """
+    每本小说（或指定小说）只保留最近 keep 个版本，返回删除的版本数。
+    """
+    with get_pool().connection() as conn:
+        novel_ids = [uuid] if uuid else [row[0] for row in conn.execute('SELECT DISTINCT novel_id FROM nsfw_novel_version')]
+    removed = 0
+    for novel_id in novel_ids:
+        # 逐本提交，避免长时间占用写锁
+        with get_pool().transaction(immediate=True) as conn:
+            removed += versions.compact(conn, novel_id, keep)
+    return removed
+
+
+def storage_stats() -> dict:
+    """
+    统计小说表头和正文占用的字节数，以及仍为旧格式（未压缩或整本 JSON）的行数。
+    """
+    with get_pool().connection() as conn:
+        head_bytes, blob_rows, plain_heads = conn.execute(
+            'SELECT COALESCE(SUM(length(CAST(state_json AS BLOB))), 0), '
+            'COALESCE(SUM(layout = ?), 0), COALESCE(SUM(typeof(state_json) = \'text\'), 0) FROM nsfw_novel',
+            (LAYOUT_BLOB,)).fetchone()
+        content_bytes, plain_sections = conn.execute(
+            'SELECT COALESCE(SUM(length(CAST(content AS BLOB))), 0), '
+            'COALESCE(SUM(typeof(content) = \'text\'), 0) FROM nsfw_section').fetchone()
+    return {'head_bytes': head_bytes, 'content_bytes': content_bytes, 'blob_rows': blob_rows,
+            'plain_heads': plain_heads, 'plain_sections': plain_sections}
+
+
+def migrate_storage(batch_size: int = 200, progress=None) -> dict:
+    """
+    把已有数据原地转换为当前存储格式：整本 JSON 的旧记录拆分为分表存储，表头去掉 exported_markdown
+    并按 STORAGE_FORMAT 编码，节正文逐批压缩。每批单独提交，可以中断后重新运行。
+    progress(stage, done, total) 用于报告进度。返回转换前后的 storage_stats()。
+    """
+    if _persister is not None:
+        _persister.flush()
+    before = storage_stats()
+    with get_pool().connection() as conn:
+        blob_ids = [row[0] for row in conn.execute('SELECT id FROM nsfw_novel WHERE layout=?', (LAYOUT_BLOB,))]
+    for done, novel_id in enumerate(blob_ids, 1):
+        with get_pool().connection() as conn:
+            update_time = conn.execute('SELECT update_time FROM nsfw_novel WHERE id=?', (novel_id,)).fetchone()[0]
+        save(load_novel(novel_id))
+        # 迁移不算一次修改，保持历史列表中的顺序
+        with get_pool().transaction(immediate=True) as conn:
+            conn.execute('UPDATE nsfw_novel SET update_time=? WHERE id=?', (update_time, novel_id))
+        if progress:
+            progress('novels', done, len(blob_ids))
+
+    stages = (
+        ('heads', 'nsfw_novel', 'state_json', lambda text: json.dumps(
+            {k: v for k, v in json.loads(text).items() if k not in HEAD_EXCLUDE}, ensure_ascii=False, separators=(',', ':'))),
+        ('sections', 'nsfw_section', 'content', lambda text: text),
+    )
+    for stage, table, column, transform in stages:
+        with get_pool().connection() as conn:
+            total = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE typeof({column})='text'").fetchone()[0]
+        done, last_rowid = 0, 0
+        while True:
+            # 按 rowid 分批，避免一次读入整张表或长时间占用写锁
+            with get_pool().transaction(immediate=True) as conn:
+                rows = conn.execute(
+                    f"SELECT rowid, {column} FROM {table} WHERE rowid>? AND typeof({column})='text' ORDER BY rowid LIMIT ?",
+                    (last_rowid, batch_size)).fetchall()
+                for rowid, text in rows:
+                    conn.execute(f'UPDATE {table} SET {column}=? WHERE rowid=?', (encode_text(transform(text)), rowid))
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+            done += len(rows)
+            if progress:
+                progress(stage, done, total)
+    return {'before': before, 'after': storage_stats()}
+
 
 def delete_novel(uuid: str):
-    db_path = 'novel_state.db'
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute('DELETE FROM nsfw_novel WHERE id=?', (uuid,))
-    conn.commit()
-    conn.close()
+    # 丢弃排队中的保存，避免删除后又被后台线程写回
+    if _persister is not None:
+        _persister.discard(uuid)
+        _persister.flush(uuid)
+    # 章、节、角色状态通过外键级联删除
+    with get_pool().transaction(immediate=True) as conn:
+        conn.execute('DELETE FROM nsfw_novel WHERE id=?', (uuid,))
+
+
+@dataclass
+class FlushEvent:
+    """
+    后台线程完成一次写库后通知监听者的信息。
+    """
+    novel_id: str
+    latency: float          # 写库耗时（秒）
+    waited: float           # 从首次入队到开始写库的时间（秒）
+    merged: int             # 被合并掉的保存请求数
+    queue_depth: int        # 写库完成时仍在排队的小说数
+    error: BaseException | None = None
+
+
+@dataclass
+class _PendingSave:
+    novel: NSFWNovel
+    enqueued: float
+    deadline: float
+    merged: int = 0
+
+
+class WriteBehindPersister:
+    """
+    后台线程异步保存小说，让 Streamlit 脚本线程不必等待磁盘 I/O。
+    同一本小说在 delay 秒内的多次保存请求合并为一次写库（按 uuid 合并，总是写入最新对象）；
+    排队的小说数达到 max_pending 时 submit 阻塞，形成背压。
+    """
+
+    def __init__(self, save_fn: Callable[[NSFWNovel], None] = save, delay: float = WRITE_BEHIND_DELAY, max_pending: int = WRITE_BEHIND_MAX_PENDING):
+        self.save_fn = save_fn
+        self.delay = delay
+        self.max_pending = max_pending
+        # 每次写库后调用，参数为 FlushEvent；在后台线程中执行，不要在其中调用 streamlit
+        self.listeners: list[Callable[[FlushEvent], None]] = []
+        self.stats = {'submitted': 0, 'merged': 0, 'flushed': 0, 'errors': 0, 'total_latency': 0.0, 'max_latency': 0.0}
+        self._pending: dict[str, _PendingSave] = {}
+        self._inflight: str | None = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='novel-write-behind', daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    def submit(self, novel: NSFWNovel):
+        """
+        把小说加入保存队列后立即返回。
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("WriteBehindPersister is closed")
+            self.stats['submitted'] += 1
+            pending = self._pending.get(novel.uuid)
+            if pending is not None:
+                pending.novel = novel
+                pending.merged += 1
+                self.stats['merged'] += 1
+                return
+            self._cond.wait_for(lambda: len(self._pending) < self.max_pending)
+            now = time.monotonic()
+            self._pending[novel.uuid] = _PendingSave(novel, now, now + self.delay)
+            self._cond.notify_all()
+
+    def discard(self, novel_id: str):
+        with self._cond:
+            self._pending.pop(novel_id, None)
+            self._cond.notify_all()
+
+    def flush(self, novel_id: str | None = None, timeout: float | None = None) -> bool:
+        """
+        立即写入排队中的保存（指定小说或全部），并等待写完。超时返回 False。
+        """
+        with self._cond:
+            for key, pending in self._pending.items():
+                if novel_id is None or key == novel_id:
+                    pending.deadline = 0
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._is_busy(novel_id), timeout)
+
+    def close(self, timeout: float | None = None):
+        """
+        写完队列中的所有保存后停止后台线程。
+        """
+        self.flush(timeout=timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def _is_busy(self, novel_id: str | None) -> bool:
+        if novel_id is None:
+            return bool(self._pending) or self._inflight is not None
+        return novel_id in self._pending or self._inflight == novel_id
+
+    def _next_due(self) -> tuple[str, _PendingSave] | float | None:
+        # 返回到期的保存；没有到期的则返回最近的等待时间，队列为空时返回 None
+        now = time.monotonic()
+        nearest = None
+        for key, pending in self._pending.items():
+            if pending.deadline <= now:
+                return key, pending
+            if nearest is None or pending.deadline < nearest:
+                nearest = pending.deadline
+        return None if nearest is None else nearest - now
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    due = self._next_due()
+                    if isinstance(due, tuple):
+                        break
+                    if due is None and self._closed:
+                        return
+                    self._cond.wait(due)
+                novel_id, pending = due
+                del self._pending[novel_id]
+                self._inflight = novel_id
+                self._cond.notify_all()
+            start = time.monotonic()
+            error = None
+            try:
+                self.save_fn(pending.novel)
+            except NovelConflictError as e:
+                # 冲突记录在小说对象上，由持有它的会话决定如何解决
+                error = e
+                logging.warning(f"Write-behind save skipped: {e}")
+            except Exception as e:
+                error = e
+                logging.exception(f"Write-behind save failed for novel {novel_id}")
+            latency = time.monotonic() - start
+            with self._cond:
+                self._inflight = None
+                self.stats['flushed'] += 1
+                self.stats['errors'] += error is not None
+                self.stats['total_latency'] += latency
+                self.stats['max_latency'] = max(self.stats['max_latency'], latency)
+                event = FlushEvent(novel_id, latency, start - pending.enqueued, pending.merged, len(self._pending), error)
+                self._cond.notify_all()
+            for listener in list(self.listeners):
+                try:
+                    listener(event)
+                except Exception:
+                    logging.exception("Write-behind listener failed")
+
+
+_persister: WriteBehindPersister | None = None
+
+
+def get_persister() -> WriteBehindPersister:
+    """
+    获取进程级共享的后台保存器，首次调用时启动后台线程，并在进程退出时写完队列。
+    """
+    global _persister
+    if _persister is None:
+        with _pool_lock:
+            if _persister is None:
+                _persister = WriteBehindPersister()
+                atexit.register(_persister.close)
+    return _persister
+
+
+def save_async(novel: NSFWNovel):
+    """
+    把小说交给后台线程保存，立即返回。
+    """
+    get_persister().submit(novel)
+
+
+async def asave(novel: NSFWNovel, wait: bool = False):
+    """
+    save_async 的协程版本：在线程池中提交，队列满时不阻塞事件循环。
+    wait=True 时等待这本小说写入数据库后返回（冲突等错误仍记录在 novel._conflict 上）。
+    """
+    persister = get_persister()
+    await asyncio.to_thread(persister.submit, novel)
+    if wait:
+        await asyncio.to_thread(persister.flush, novel.uuid)
+
+
+async def aload_novel(uuid: str, lazy: bool = False) -> NSFWNovel | None:
+    """
+    load_novel 的协程版本，在线程池中读取。
+    """
+    return await asyncio.to_thread(load_novel, uuid, lazy)
@@ -0,0 +1,152 @@
+"""
+下一节正文的推测式预取：某一节生成完成后，在后台按当前内容生成下一节，用户点击生成下一节时直接使用。
+
+预取结果以生成时的模型和完整提示词为指纹：切换了模型，或上一节的正文、角色状态、本节概要、章节摘要等任何输入被修改，
+指纹就会变化，结果作废（计为 stale），不会把过期的内容写入小说。预取只在后台保存结果，不修改 state。
+
+所有会话共用一个线程池（会话被替换后不会留下空闲线程），每个会话同时进行的预取数仍由 budget 限制。
+"""
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+
+# 每个会话（writer）同时进行的预取数上限
+PREFETCH_BUDGET = 1
+# 所有会话共用的预取线程数
+PREFETCH_WORKERS = 4
+
+_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='section-prefetch')
+
+
+def fingerprint(messages: list, model: str = '') -> str:
+    digest = hashlib.sha1(model.encode('utf-8'))
+    for message in messages:
+        digest.update(type(message).__name__.encode())
+        digest.update(str(message.content).encode('utf-8'))
+    return digest.hexdigest()
+
+
+@dataclass
+class _Prefetch:
+    section: object
+    fingerprint: str
+    future: Future
+    started: float
+    # 线程池中的任务，丢弃时尚未开始的可以取消
+    task: Future | None = None
+    finished: float | None = None
+
+
+@dataclass
+class PrefetchStats:
+    started: int = 0
+    # 预算已满而没有启动的预取
+    skipped: int = 0
+    # 使用时已完成 / 仍在生成（等待其完成）
+    hits: int = 0
+    waited_hits: int = 0
+    # 没有对应预取 / 输入已被修改 / 预取失败
+    misses: int = 0
+    stale: int = 0
+    failed: int = 0
+    # 命中时省下的等待时间（秒）：预取的生成耗时减去用户点击后实际等待的时间
+    saved_seconds: float = 0.0
+    waited_seconds: float = 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        used = self.hits + self.waited_hits + self.misses + self.stale + self.failed
+        return (self.hits + self.waited_hits) / used if used else 0.0
+
+
+class SectionPrefetcher:
+    """
+    每个 NsfwNovelWriter 一个。start 在后台生成，take 在真正生成之前取用。
+    """
+
+    def __init__(self, budget: int = PREFETCH_BUDGET):
+        self.budget = budget
+        self.enabled = budget > 0
+        self.stats = PrefetchStats()
+        self._entries: dict[int, _Prefetch] = {}
+        self._lock = threading.Lock()
+
+    def _inflight(self) -> int:
+        return sum(1 for entry in self._entries.values() if not entry.future.done())
+
+    def start(self, section, messages: list, generate, model: str = '') -> bool:
+        """
+        为 section 在后台调用 generate(messages)，model 为生成所用的模型名。已有相同输入的预取或预算已满时不启动，返回是否启动。
+        """
+        if not self.enabled:
+            return False
+        key = fingerprint(messages, model)
+        with self._lock:
+            entry = self._entries.get(id(section))
+            if entry is not None and entry.section is section and entry.fingerprint == key:
+                return False
+            if self._inflight() >= self.budget:
+                self.stats.skipped += 1
+                return False
+            prefetch = _Prefetch(section, key, Future(), time.monotonic())
+
+            def run():
+                try:
+                    result = generate(messages)
+                except Exception as e:
+                    logging.warning(f"Section prefetch failed: {e}")
+                    prefetch.future.set_exception(e)
+                else:
+                    prefetch.future.set_result(result)
+                finally:
+                    prefetch.finished = time.monotonic()
+
+            self._entries[id(section)] = prefetch
+            self.stats.started += 1
+            prefetch.task = _executor.submit(run)
+            return True
+
+    def take(self, section, messages: list, model: str = ''):
+        """
+        取出 section 的预取结果：模型和输入与预取时一致则返回结果（仍在生成则等待），否则返回 None。
+        """
+        with self._lock:
+            entry = self._entries.pop(id(section), None)
+        if entry is None or entry.section is not section:
+            self.stats.misses += 1
+            return None
+        if entry.fingerprint != fingerprint(messages, model):
+            self.stats.stale += 1
+            return None
+        waiting = not entry.future.done()
+        start = time.monotonic()
+        try:
+            result = entry.future.result()
+        except Exception:
+            self.stats.failed += 1
+            return None
+        waited = time.monotonic() - start
+        if waiting:
+            self.stats.waited_hits += 1
+        else:
+            self.stats.hits += 1
+        self.stats.waited_seconds += waited
+        self.stats.saved_seconds += max(0.0, (entry.finished or time.monotonic()) - entry.started - waited)
+        return result
+
+    def discard(self, section=None):
+        """
+        丢弃 section（或全部）的预取结果；尚未开始的预取被取消，已在生成的请求继续运行，但结果不会被使用。
+        """
+        with self._lock:
+            if section is None:
+                entries = list(self._entries.values())
+                self._entries.clear()
+            else:
+                entries = [entry for entry in [self._entries.pop(id(section), None)] if entry is not None]
+        for entry in entries:
+            if entry.task is not None:
+                entry.task.cancel()
@@ -0,0 +1,150 @@
+"""
+基于 SQLite FTS5 的小说全文检索。
+
+FTS5 自带的分词器不切分中日韩文字，这里在写入和查询前把连续的中日韩文字切成重叠的二元组
+（"林晚走进" -> "林晚 晚走 走进 进"），再交给 unicode61 分词器，这样两个字的人名也能走索引。
+每本小说一个文档（标题、概要、角色、章标题和章概要），每节一个文档（节标题、概要、正文）。
+"""
+import re
+import sqlite3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS nsfw_search_doc (
+    doc_id INTEGER PRIMARY KEY,
+    novel_id TEXT NOT NULL REFERENCES nsfw_novel(id) ON DELETE CASCADE,
+    section_id TEXT UNIQUE REFERENCES nsfw_section(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS idx_nsfw_search_doc_novel ON nsfw_search_doc(novel_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS nsfw_search USING fts5(title, body, tokenize='unicode61');
+CREATE TRIGGER IF NOT EXISTS nsfw_search_doc_delete AFTER DELETE ON nsfw_search_doc BEGIN
+    DELETE FROM nsfw_search WHERE rowid = old.doc_id;
+END;
+'''
+
+# bm25 中标题列的权重
+TITLE_WEIGHT = 10.0
+SNIPPET_WIDTH = 40
+
+# 中日韩文字（假名、汉字、谚文、兼容汉字）的字符范围，供正则字符类使用
+CJK_CHARS = r'\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+_TOKEN_RE = re.compile(rf'[{CJK_CHARS}]+|[^\W{CJK_CHARS}]+')
+_CJK_RE = re.compile(rf'[{CJK_CHARS}]')
+
+
+def _bigrams(run: str) -> list[str]:
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def index_text(text: str | None) -> str:
+    """
+    把文本转换为写入 FTS 的形式：中日韩文字切成二元组并补上末字，其他单词原样保留。
+    """
+    if not text:
+        return ''
+    tokens = []
+    for run in _TOKEN_RE.findall(text):
+        if _CJK_RE.match(run):
+            tokens.extend(_bigrams(run))
+            tokens.append(run[-1])
+        else:
+            tokens.append(run)
+    return ' '.join(tokens)
+
+
+def match_query(query: str) -> str | None:
+    """
+    把用户输入转换为 FTS5 MATCH 表达式，各词之间为 AND。
+    多字的中日韩词转为二元组短语；单字转为前缀查询。没有可检索的词时返回 None。
+    """
+    parts = []
+    for run in _TOKEN_RE.findall(query):
+        if _CJK_RE.match(run):
+            if len(run) == 1:
+                parts.append(f'"{run}" *')
+            else:
+                parts.append('"' + ' '.join(_bigrams(run)) + '"')
+        else:
+            parts.append('"' + run.replace('"', '""') + '"')
+    return ' AND '.join(parts) if parts else None
+
+
+def section_doc(section) -> tuple[str, str]:
+    return section.title or '', '\n'.join(filter(None, [section.overview, section.content]))
+
+
+def novel_doc(title: str | None, overview: str | None, characters: list[dict], chapters: list[tuple]) -> tuple[str, str]:
+    """
+    小说文档：characters 为 {name, description} 字典列表，chapters 为 (title, overview) 列表。
+    """
+    lines = [overview or '']
+    lines += [f"{c.get('name', '')}: {c.get('description', '')}" for c in characters]
+    lines += [f"{t or ''}: {o or ''}" for t, o in chapters]
+    return title or '', '\n'.join(lines)
+
+
+def ensure_schema(conn: sqlite3.Connection) -> bool:
+    """
+    创建检索表，返回是否为新建（新建时需要为已有记录建立索引）。
+    """
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name='nsfw_search'").fetchone()
+    conn.executescript(SCHEMA)
+    return exists is None
+
+
+def _write_doc(conn: sqlite3.Connection, doc_id: int, title: str, body: str):
+    conn.execute('DELETE FROM nsfw_search WHERE rowid=?', (doc_id,))
+    conn.execute('INSERT INTO nsfw_search (rowid, title, body) VALUES (?, ?, ?)', (doc_id, index_text(title), index_text(body)))
+
+
+def index_novel_doc(conn: sqlite3.Connection, novel_id: str, title: str, body: str):
+    row = conn.execute('SELECT doc_id FROM nsfw_search_doc WHERE novel_id=? AND section_id IS NULL', (novel_id,)).fetchone()
+    if row is None:
+        row = conn.execute('INSERT INTO nsfw_search_doc (novel_id) VALUES (?) RETURNING doc_id', (novel_id,)).fetchone()
+    _write_doc(conn, row[0], title, body)
+
+
+def index_section_doc(conn: sqlite3.Connection, novel_id: str, section_id: str, title: str, body: str):
+    doc_id = conn.execute(
+        'INSERT INTO nsfw_search_doc (novel_id, section_id) VALUES (?, ?) '
+        'ON CONFLICT(section_id) DO UPDATE SET novel_id=excluded.novel_id RETURNING doc_id', (novel_id, section_id)).fetchone()[0]
+    _write_doc(conn, doc_id, title, body)
+
+
+def clear_novel(conn: sqlite3.Connection, novel_id: str):
+    conn.execute('DELETE FROM nsfw_search_doc WHERE novel_id=?', (novel_id,))
+
+
+def search(conn: sqlite3.Connection, query: str, columns: str, limit: int, offset: int) -> list[tuple]:
+    """
+    按相关度返回匹配的小说，每本小说一行：columns 指定的 nsfw_novel 列，加上最佳匹配的 section_id。
+    """
+    expr = match_query(query)
+    if expr is None:
+        return []
+    select = ', '.join(f'n.{c.strip()}' for c in columns.split(','))
+    return conn.execute(f'''
+        WITH hits AS MATERIALIZED (
+            SELECT d.novel_id, d.section_id, bm25(nsfw_search, {TITLE_WEIGHT}, 1.0) AS score
+            FROM nsfw_search JOIN nsfw_search_doc d ON d.doc_id = nsfw_search.rowid
+            WHERE nsfw_search MATCH ?
+        )
+        SELECT {select}, h.section_id, MIN(h.score) AS best
+        FROM hits h JOIN nsfw_novel n ON n.id = h.novel_id
+        GROUP BY h.novel_id ORDER BY best LIMIT ? OFFSET ?
+    ''', (expr, limit, offset)).fetchall()
+
+
+def make_snippet(text: str | None, query: str, width: int = SNIPPET_WIDTH) -> str:
+    """
+    截取 text 中第一个命中词前后的片段用于展示。
+    """
+    if not text:
+        return ''
+    lowered = text.lower()
+    positions = [p for p in (lowered.find(t.lower()) for t in _TOKEN_RE.findall(query)) if p >= 0]
+    if not positions:
+        return text[:width * 2]
+    pos = min(positions)
+    start = max(0, pos - width)
+    end = min(len(text), pos + width)
+    return ('…' if start > 0 else '') + text[start:end].replace('\n', ' ') + ('…' if end < len(text) else '')
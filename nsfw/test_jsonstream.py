@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+from jsonstream import ContentDeltaParser
+
+
+def feed_all(pieces: list[str], field: str = 'content') -> tuple[str, ContentDeltaParser]:
+    parser = ContentDeltaParser(field)
+    return ''.join(parser.feed(piece) for piece in pieces), parser
+
+
+def split_every(text: str, size: int) -> list[str]:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+SAMPLE = json.dumps({
+    'title': 'x "content" y',
+    'content': '第一段\n\n"引号" \\ 反斜杠 \t 😀 and é',
+    'current_state': {'content': 'nested, not captured'},
+})
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 7, len(SAMPLE)])
+def test_deltas_match_decoded_field_at_any_split(size):
+    deltas, parser = feed_all(split_every(SAMPLE, size))
+    assert deltas == json.loads(SAMPLE)['content']
+    assert parser.finish() == json.loads(SAMPLE)
+
+
+@pytest.mark.parametrize('pieces', [
+    ['{"content": "a\\ud83d', '\\ude00b"}'],
+    ['{"content": "a\\ud83d\\', 'ude00b"}'],
+    ['{"content": "a\\ud8', '3d\\ude00b"}'],
+    ['{"content": "a\\', 'u', 'd83d', '\\u', 'de00', 'b"}'],
+])
+def test_surrogate_pair_split_across_pieces(pieces):
+    assert feed_all(pieces)[0] == 'a😀b'
+
+
+def test_escapes():
+    text = r'{"content": "\"\\\/\b\f\n\r\t中"}'
+    assert feed_all(split_every(text, 1))[0] == '"\\/\b\f\n\r\t中'
+
+
+def test_markdown_fence_prefix_is_skipped():
+    text = '```json\n{"content": "abc"}\n```'
+    deltas, parser = feed_all(split_every(text, 4))
+    assert deltas == 'abc'
+    assert parser.finish() == {'content': 'abc'}
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('{"content": "ab\\uZZZZcd"}', 'ab\\uZZZZcd'),
+    ('{"content": "ab\\u12"}', 'ab\\u12'),
+    ('{"content": "a\\ud83d\\uZZZZb"}', 'a\ud83d\\uZZZZb'),
+    ('{"content": "a\\ud83db"}', 'a\ud83db'),
+])
+def test_malformed_unicode_escape_does_not_raise(text, expected):
+    for size in (1, 3, len(text)):
+        assert feed_all(split_every(text, size))[0] == expected
+    assert feed_all([text])[1].finish()['content'] == expected
@@ -1,16 +1,22 @@
 import streamlit as st
 import os
+import sys
 import json
-from glom import glom, assign
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.render import StreamRenderer
 from core import NsfwNovelWriter, MODEL_OPTIONS
 from domains import *
-from persist import get_history_page, save, delete_novel
+from paths import compile_path
+from persist import get_history_page, search_novels, save_async, delete_novel, load_novel, list_versions, restore_version
 
 if not os.environ["OPENAI_API_KEY"]:
     os.environ["OPENAI_API_KEY"] = st.secrets["OPENAI_API_KEY"]
 
 st.title("NSFW 小说生成器")
 
+# 章节编辑区每页显示的节数
+SECTIONS_PER_PAGE = 5
+
 # 注入自适应高度的CSS
 st.markdown("""
     <style>
@@ -25,38 +31,77 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # 公用的章节一键生成函数
-def oneclick_generate_chapter(writer: NsfwNovelWriter, idx, section_count=None, progress_placeholder=None, chapters_progress=""):
-    progress_placeholder.info(f"正在生成第{idx+1}章{chapters_progress}各节概要...")
-    writer.design_sections(idx, section_count=section_count)
+def oneclick_generate_chapter(writer: NsfwNovelWriter, idx, section_count=None, progress_placeholder=None, chapters_progress="", design_sections=True):
+    if design_sections:
+        progress_placeholder.info(f"正在生成第{idx+1}章{chapters_progress}各节概要...")
+        writer.design_sections(idx, section_count=section_count)
     total = len(writer.state.chapters[idx].sections)
     for sidx in range(total):
         if progress_placeholder:
             progress_placeholder.info(f"正在生成第{idx+1}章{chapters_progress}第{sidx+1}节正文（{sidx+1}/{total}）...")
-        for _ in writer.write_content(idx, sidx):
+        for _ in writer.write_content_deltas(idx, sidx, prefetch=False):
             pass
 
+def new_writer() -> NsfwNovelWriter:
+    """
+    替换当前会话的 writer（重置、导入），被替换的 writer 尚未开始的预取一并取消。
+    """
+    if 'writer' in st.session_state:
+        st.session_state['writer'].prefetcher.discard()
+    st.session_state['writer'] = NsfwNovelWriter(st.session_state.get('model_select', MODEL_OPTIONS[0]))
+    return st.session_state['writer']
+
 # 初始化/恢复 writer
 if 'writer' not in st.session_state:
-    st.session_state['writer'] = NsfwNovelWriter()
+    new_writer()
 writer: NsfwNovelWriter = st.session_state['writer']
+
+# 其他会话已修改了同一本小说：本会话的修改暂不保存，由用户选择如何处理
+if writer.conflict is not None:
+    st.warning(f"该小说已在其他会话中被修改（{writer.conflict}），本会话的修改尚未保存。")
+    col_merge, col_theirs, col_mine = st.columns(3)
+    resolution = None
+    with col_merge:
+        if st.button("按节合并", key="conflict_merge"):
+            resolution = 'merge'
+    with col_theirs:
+        if st.button("放弃本会话修改", key="conflict_theirs"):
+            resolution = 'theirs'
+    with col_mine:
+        if st.button("覆盖为本会话内容", key="conflict_mine"):
+            resolution = 'mine'
+    if resolution:
+        overridden = writer.resolve_conflict(resolution)
+        if overridden:
+            st.session_state['conflict_overridden'] = len(overridden)
+        st.rerun()
+if st.session_state.get('conflict_overridden'):
+    st.info(f"已合并，{st.session_state.pop('conflict_overridden')} 个两边都修改过的节保留了本会话的内容。")
+
 state = writer.state
 
 def bind_state(path: str):
     key = f'state#{path}'
+    accessor = compile_path(path)
+
+    def on_change():
+        # 值未变化（例如只是失去焦点）时不标记修改，也不保存
+        if accessor.set(state, st.session_state[key]):
+            save_async(state)
     return {
-        'value': glom(state, path, default=None),
+        'value': accessor.get(state),
         'key': key,
-        'on_change': lambda: assign(state, path, st.session_state[key]),
+        'on_change': on_change,
     }
 
 def rerun(partial: bool = False):
     if state.plot_requirements or state.title or state.overview or state.language or state.characters:
-        save(state)
+        save_async(state)
     st.rerun(scope="app" if not partial else "fragment")
 
 # 导出/导入/导出Markdown同一行
 model_choice = st.selectbox("选择模型", options=MODEL_OPTIONS, index=0, key="model_select")
-if getattr(writer.model, 'model', None) != model_choice:
+if writer.model.model_name != model_choice:
     writer.set_model(model_choice)
     
 col_export, col_import, col_md, col_history = st.columns(4)
@@ -80,8 +125,7 @@ with col_import:
     if 'import_json_data' in st.session_state:
         if st.button("应用导入内容"):
             try:
-                st.session_state['writer'] = NsfwNovelWriter()
-                st.session_state['writer'].state = NSFWNovel.model_validate(st.session_state['import_json_data'], strict=False)
+                new_writer().state = NSFWNovel.model_validate(st.session_state['import_json_data'], strict=False)
                 st.success("导入成功！")
                 st.session_state.pop("import_json_uploader", None)
                 st.session_state.pop("import_json_data", None)
@@ -109,53 +153,111 @@ with col_md:
         st.button("预览Markdown", on_click=preview_markdown_dialog)
         st.download_button('下载Markdown', data=state.exported_markdown, file_name=f"{state.title or 'NSFW小说'}.md", mime='text/markdown')
 
+def history_row(row, snippet: str | None = None):
+    rid, title, language, chapter_count, section_count, word_count, create_time, update_time, version = row
+    col1, col2, col3, col4, col5, col6 = st.columns([3,3,3,2,2,2])
+    with col1:
+        st.markdown(f"**标题：** {title or ''}")
+        st.caption(f"{chapter_count} 章 · {section_count} 节 · {word_count} 字")
+    with col2:
+        st.markdown(f"**语言：** {language or ''}")
+    with col3:
+        st.markdown(f"**更新时间：** {update_time[:19]}")
+    with col4:
+        st.markdown(f"**版本：** {version}")
+    with col5:
+        if st.button("导入", key=f"import_history_{rid}"):
+            # 只读取章节骨架，节正文和角色状态在打开对应章时再读取
+            novel = load_novel(rid, lazy=True)
+            if novel is None:
+                # 列出之后已被其他会话删除
+                st.error("记录已不存在")
+            else:
+                new_writer().state = novel
+                st.success("历史记录已导入！")
+                rerun()
+    with col6:
+        if st.button("删除", key=f"delete_history_{rid}"):
+            st.session_state['delete_confirm_id'] = rid
+            st.session_state['show_delete_confirm'] = True
+            rerun()
+    if snippet:
+        st.caption(snippet)
+
 @st.dialog("历史记录", width="large")
 def history_dialog():
     PAGE_SIZE = 10
-    page = st.session_state.get('history_page', 1)
-    total_count, rows = get_history_page(page, PAGE_SIZE)
-    for row in rows:
-        rid, state_json, create_time, update_time, version = row
-        try:
-            state_obj = json.loads(state_json)
-        except Exception:
-            state_obj = {}
-        col1, col2, col3, col4, col5, col6 = st.columns([3,3,3,2,2,2])
-        with col1:
-            st.markdown(f"**标题：** {state_obj.get('title', '')}")
-        with col2:
-            st.markdown(f"**语言：** {state_obj.get('language', '')}")
-        with col3:
-            st.markdown(f"**更新时间：** {update_time[:19]}")
-        with col4:
-            st.markdown(f"**版本：** {version}")
-        with col5:
-            if st.button("导入", key=f"import_history_{rid}"):
-                st.session_state['writer'] = NsfwNovelWriter()
-                st.session_state['writer'].state = NSFWNovel.model_validate(state_obj)
-                st.success("历史记录已导入！")
+    query = st.text_input("搜索标题、概要、角色或正文", key="history_query").strip()
+    if query:
+        # 检索结果按相关度排序，使用页码分页
+        if st.session_state.get('history_search_for') != query:
+            st.session_state['history_search_for'] = query
+            st.session_state['history_search_page'] = 1
+        page = st.session_state['history_search_page']
+        rows, has_next = search_novels(query, page, PAGE_SIZE)
+        if not rows:
+            st.info("没有找到匹配的小说。")
+        for *row, snippet in rows:
+            history_row(row, snippet)
+        col_prev, col_page, col_next = st.columns([2,2,2])
+        with col_prev:
+            if page > 1 and st.button("上一页", key="history_search_prev"):
+                st.session_state['history_search_page'] = page - 1
                 rerun()
-        with col6:
-            if st.button("删除", key=f"delete_history_{rid}"):
-                st.session_state['delete_confirm_id'] = rid
-                st.session_state['show_delete_confirm'] = True
+        with col_page:
+            st.markdown(f"第 {page} 页")
+        with col_next:
+            if has_next and st.button("下一页", key="history_search_next"):
+                st.session_state['history_search_page'] = page + 1
                 rerun()
+        return
+    # 键集分页：记录每一页起点的游标，上一页时出栈
+    cursors = st.session_state.setdefault('history_cursors', [None])
+    rows, next_cursor = get_history_page(cursors[-1], PAGE_SIZE)
+    for row in rows:
+        history_row(row)
     # 分页控件
-    total_pages = (total_count + PAGE_SIZE - 1) // PAGE_SIZE
     col_prev, col_page, col_next = st.columns([2,2,2])
     with col_prev:
-        if page > 1 and st.button("上一页", key="history_prev"):
-            st.session_state['history_page'] = page - 1
+        if len(cursors) > 1 and st.button("上一页", key="history_prev"):
+            cursors.pop()
             rerun()
     with col_page:
-        st.markdown(f"第 {page} / {total_pages} 页")
+        st.markdown(f"第 {len(cursors)} 页")
     with col_next:
-        if page < total_pages and st.button("下一页", key="history_next"):
-            st.session_state['history_page'] = page + 1
+        if next_cursor is not None and st.button("下一页", key="history_next"):
+            cursors.append(next_cursor)
             rerun()
+
+@st.dialog("版本历史", width="large")
+def versions_dialog():
+    rows = list_versions(state.uuid)
+    if not rows:
+        st.info("当前小说还没有保存过的版本。")
+    for version, keyframe, size, create_time in rows:
+        col1, col2, col3, col4 = st.columns([2,4,4,2])
+        with col1:
+            st.markdown(f"**版本：** {version}")
+        with col2:
+            st.markdown(f"**保存时间：** {create_time[:19]}")
+        with col3:
+            st.caption(f"{'完整快照' if keyframe else '增量'} · {size} 字节")
+        with col4:
+            if st.button("恢复", key=f"restore_version_{version}"):
+                restored = restore_version(state.uuid, version)
+                if restored is None:
+                    st.error("该版本已无法恢复。")
+                else:
+                    # 恢复的内容保存为一个新版本，之后的版本仍然保留
+                    writer.state = restored
+                    save_async(restored)
+                    st.success(f"已恢复到版本 {version}！")
+                    st.rerun()
 with col_history:
     if st.button("历史记录"):
         history_dialog()
+    if state.title and st.button("版本历史"):
+        versions_dialog()
 
 if st.session_state.get('show_delete_confirm', False):
     @st.dialog("确认删除", width="small")
@@ -198,11 +300,32 @@ with col_gen:
             st.warning("请输入情节要求后再生成。")
 with col_reset:
     if st.button("重置"):
-        st.session_state['writer'] = NsfwNovelWriter()
+        new_writer()
         st.success("已重置所有内容！")
         rerun()
 with col_edit_content:
     edit_content = st.checkbox("编辑正文", value=False, key="edit_content_checkbox")
+    writer.prefetcher.enabled = st.checkbox("预取下一节", value=True, key="prefetch_checkbox",
+                                            help="某节正文生成后在后台提前生成下一节；修改上一节或本节概要后预取结果作废")
+    writer.use_response_cache = st.checkbox("复用相同请求的结果", value=True, key="response_cache_checkbox",
+                                            help="概要、章和节的设计请求与之前完全相同时直接使用缓存的结果；需要重新生成不同结果时取消勾选")
+    response_cache = writer.cached_model.cache
+    if response_cache.hits or response_cache.misses:
+        st.caption(f"响应缓存命中 {response_cache.hits} 次，未命中 {response_cache.misses} 次，"
+                   f"节省 {response_cache.bytes_saved / 1024:.1f} KB / {response_cache.tokens_saved} tokens，"
+                   f"缓存共 {response_cache.total_bytes / 1024 / 1024:.1f} MB")
+    prefetch_stats = writer.prefetcher.stats
+    if prefetch_stats.started:
+        st.caption(f"预取命中率 {prefetch_stats.hit_rate:.0%}（命中 {prefetch_stats.hits}，等待后命中 {prefetch_stats.waited_hits}，"
+                   f"作废 {prefetch_stats.stale}，未命中 {prefetch_stats.misses}），节省约 {prefetch_stats.saved_seconds:.0f} 秒")
+    if writer.context.prompts:
+        st.caption(f"提示词组装平均 {writer.context.average_assembly_ms:.2f} ms，上下文缓存命中率 {writer.context.hit_rate:.0%}，"
+                   f"上次正文提示词约 {writer.memory.last_prompt_tokens} tokens")
+    if writer.usage.calls:
+        cached_ttft, uncached_ttft = writer.usage.first_token_seconds(True), writer.usage.first_token_seconds(False)
+        st.caption(f"输入 {writer.usage.input_tokens} tokens，其中命中提示词缓存 {writer.usage.cached_tokens}（{writer.usage.cached_ratio:.0%}）；"
+                   f"首 token 平均等待：命中 {'-' if cached_ttft is None else f'{cached_ttft:.1f} 秒'}，"
+                   f"未命中 {'-' if uncached_ttft is None else f'{uncached_ttft:.1f} 秒'}")
 
 # 标题和概要编辑
 if state.title is not None:
@@ -240,6 +363,21 @@ if state.title is not None:
         st.button("添加角色", key="add_character_btn", on_click=_add_character_inputs)
 
     # 章节编辑区域
+def section_page(idx: int, total: int) -> range:
+    """
+    本章要渲染的节：每页 sections_per_page 节，节数超过一页时显示分页选择。每次重新运行只创建一页节的控件。
+    """
+    per_page = st.session_state.get('sections_per_page', SECTIONS_PER_PAGE)
+    if per_page == "全部" or total <= per_page:
+        return range(total)
+    pages = [range(start, min(start + per_page, total)) for start in range(0, total, per_page)]
+    page_key = f'section_page_{idx}'
+    if st.session_state.get(page_key, 0) >= len(pages):
+        st.session_state[page_key] = len(pages) - 1
+    page = st.radio("节", options=range(len(pages)), format_func=lambda p: f"第{pages[p][0]+1}-{pages[p][-1]+1}节",
+                    horizontal=True, key=page_key, label_visibility="collapsed")
+    return pages[page]
+
 @st.fragment
 def single_chapter_area(idx: int, chapter: NSFWChapter):
     col_ch_add, col_ch_del = st.columns([2,2])
@@ -254,9 +392,12 @@ def single_chapter_area(idx: int, chapter: NSFWChapter):
             rerun()
     st.text_input(f"第{idx+1}章标题", **bind_state(f"chapters.{idx}.title"))
     st.text_area(f"第{idx+1}章概要", **bind_state(f"chapters.{idx}.overview"), height=200)
-    col_sec1, col_sec2, col_sec3 = st.columns([2,2,2])
+    col_sec1, col_sec_page, col_sec2, col_sec3 = st.columns([2,2,2,2])
     with col_sec1:
         section_count = st.selectbox(f"节数量", options=["AUTO"] + [str(i) for i in range(1, 21)], index=0, key=f"section_count_{idx}")
+    with col_sec_page:
+        page_sizes = [3, 5, 10, "全部"]
+        st.selectbox("每页节数", options=page_sizes, index=page_sizes.index(SECTIONS_PER_PAGE), key="sections_per_page")
     with col_sec2:
         if st.button(f"生成节概要", key=f"gen_sections_{idx}"):
             writer.design_sections(idx, section_count=None if section_count=="AUTO" else int(section_count))
@@ -276,7 +417,8 @@ def single_chapter_area(idx: int, chapter: NSFWChapter):
             if st.button('提交反馈', key=f'feedback_button_{idx}'):
                 writer.design_sections(idx, user_feedback=feedback)
                 #rerun()
-    for sidx, section in enumerate(chapter.sections):
+    for sidx in section_page(idx, len(chapter.sections)):
+        section = chapter.sections[sidx]
         col_secA, col_secB = st.columns([4, 8])
         with col_secA:
             st.text_input(f"第{idx+1}章第{sidx+1}节标题", **bind_state(f"chapters.{idx}.sections.{sidx}.title"))
@@ -297,10 +439,10 @@ def single_chapter_area(idx: int, chapter: NSFWChapter):
                     user_feedback = feedback
                     
         if to_generate:
-            with st.empty():
-                for partial in writer.write_content(idx, sidx, user_feedback=user_feedback):
-                    st.write(partial)
-                rerun(partial=True)
+            with StreamRenderer(label=f"section {idx+1}.{sidx+1}") as renderer:
+                for delta in writer.write_content_deltas(idx, sidx, user_feedback=user_feedback):
+                    renderer.append(delta)
+            rerun(partial=True)
             
         if section.content:
             if st.session_state.get("edit_content_checkbox", True):
@@ -320,8 +462,9 @@ def single_chapter_area(idx: int, chapter: NSFWChapter):
             if st.button(f"删除本节", key=f"delete_section_{idx}_{sidx}"):
                 del chapter.sections[sidx]
                 rerun(partial=True)
-        if section.after_state:
-            with st.expander("本节后角色状态", expanded=False):
+        # 折叠的 expander 也会创建其中的全部控件，改为打开开关后才创建
+        if section.after_state and st.toggle("本节后角色状态", key=f"show_after_state_{idx}_{sidx}"):
+            with st.container(border=True):
                 for cname in section.after_state:
                     st.markdown(f"**{cname}**")
                     st.text_area(f"衣着状态", **bind_state(f"chapters.{idx}.sections.{sidx}.after_state.{cname}.clothing"))
@@ -343,12 +486,33 @@ def chapter_area():
             else:
                 st.warning('请先生成小说概要后再生成章概要。')
     with col_ch3:
+        st.checkbox("按章并行生成正文", key='parallel_chapters', help="先规划各章衔接，再同时生成各章，最后校正衔接处")
         if st.button('一键生成全文', key='oneclick_gen_all'):
             progress_placeholder = st.empty()
             progress_placeholder.info("正在生成所有章概要...")
             writer.design_chapters(chapter_count=None if chapter_count=="AUTO" else int(chapter_count))
-            for idx, chapter in enumerate(state.chapters):
-                oneclick_generate_chapter(writer, idx, progress_placeholder=progress_placeholder, chapters_progress=f"（{idx + 1}/{len(state.chapters)}）")
+            # 各章节概要互不依赖，并发生成
+            progress_placeholder.info(f"正在生成各章节概要（0/{len(state.chapters)}）...")
+            def sections_progress(idx, done, total, error):
+                if error is not None:
+                    st.warning(f"第{idx+1}章节概要生成失败：{error}")
+                progress_placeholder.info(f"正在生成各章节概要（{done}/{total}）...")
+            failed = writer.design_sections_batch(progress_callback=sections_progress)
+            if st.session_state.get('parallel_chapters'):
+                for idx in failed:
+                    progress_placeholder.info(f"正在重新生成第{idx+1}章各节概要...")
+                    writer.design_sections(idx)
+                stage_labels = {'plan': '规划各章衔接', 'content': '并行生成正文', 'reconcile': '校正章节衔接'}
+                def chapters_progress(stage, idx, done, total):
+                    progress_placeholder.info(f"{stage_labels[stage]}（{done}/{total}）...")
+                progress_placeholder.info("正在规划各章衔接...")
+                for idx, error in writer.write_chapters_parallel(progress_callback=chapters_progress).items():
+                    st.warning(f"第{idx+1}章正文生成失败：{error}")
+            else:
+                for idx, chapter in enumerate(state.chapters):
+                    # 失败的章回退为单独生成节概要
+                    oneclick_generate_chapter(writer, idx, progress_placeholder=progress_placeholder, chapters_progress=f"（{idx + 1}/{len(state.chapters)}）",
+                                              design_sections=idx in failed)
             progress_placeholder.success("已为所有章节一键生成概要和正文！")
             rerun()
     if state.chapters:
@@ -360,11 +524,13 @@ def chapter_area():
             if st.button('提交章概要反馈', key='chapter_feedback_button'):
                 writer.design_chapters(user_feedback=chapter_feedback)
                 rerun()
+        # st.tabs 会渲染所有标签页的内容，这里只渲染选中的一章，未打开的章不读取正文
         tab_titles = [chapter.title or f"第{idx+1}章" for idx, chapter in enumerate(state.chapters)]
-        tabs = st.tabs(tab_titles)
-        for idx, (chapter, tab) in enumerate(zip(state.chapters, tabs)):
-            with tab:
-                single_chapter_area(idx, chapter)
+        if st.session_state.get('active_chapter', 0) >= len(tab_titles):
+            st.session_state['active_chapter'] = 0
+        idx = st.radio("章节", options=range(len(tab_titles)), format_func=lambda i: tab_titles[i],
+                       horizontal=True, key='active_chapter', label_visibility="collapsed")
+        single_chapter_area(idx, state.chapters[idx])
                 
 if state.overview:
     chapter_area()
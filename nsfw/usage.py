@@ -0,0 +1,108 @@
+"""
+记录每次模型调用返回的 token 用量，重点是命中服务端提示词缓存的输入 token（OpenRouter 返回的
+usage.prompt_tokens_details.cached_tokens，langchain 中为 usage_metadata.input_token_details.cache_read），
+以及首个 token 的等待时间，用于比较命中和未命中缓存时的延迟与费用。
+"""
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+# 保留的最近调用记录数
+USAGE_HISTORY = 200
+
+
+@dataclass
+class CallUsage:
+    input_tokens: int
+    cached_tokens: int
+    output_tokens: int
+    # 流式调用收到第一个 token 的时间（秒），非流式调用为 None
+    first_token_seconds: float | None
+    seconds: float
+
+    @property
+    def uncached_tokens(self) -> int:
+        return self.input_tokens - self.cached_tokens
+
+
+class PromptCacheStats(BaseCallbackHandler):
+    """
+    作为 ChatOpenAI 的回调使用，汇总所有调用的用量；records 保存最近 USAGE_HISTORY 次调用。
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.output_tokens = 0
+        self.records: deque[CallUsage] = deque(maxlen=USAGE_HISTORY)
+        self._started: dict[UUID, float] = {}
+        self._first_token: dict[UUID, float] = {}
+        self._lock = threading.Lock()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_new_token(self, token, *, run_id: UUID, **kwargs):
+        if run_id not in self._first_token:
+            self._first_token[run_id] = time.perf_counter()
+
+    def on_llm_error(self, error, *, run_id: UUID, **kwargs):
+        self._started.pop(run_id, None)
+        self._first_token.pop(run_id, None)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs):
+        started = self._started.pop(run_id, None)
+        first_token = self._first_token.pop(run_id, None)
+        usage = _usage(response)
+        if usage is None or started is None:
+            return
+        input_tokens, cached_tokens, output_tokens = usage
+        now = time.perf_counter()
+        record = CallUsage(input_tokens, cached_tokens, output_tokens,
+                           None if first_token is None else first_token - started, now - started)
+        with self._lock:
+            self.calls += 1
+            self.input_tokens += input_tokens
+            self.cached_tokens += cached_tokens
+            self.output_tokens += output_tokens
+            self.records.append(record)
+        logging.info(f"LLM usage: input {input_tokens} tokens ({cached_tokens} cached), output {output_tokens} tokens, "
+                     f"first token {'-' if record.first_token_seconds is None else f'{record.first_token_seconds:.2f}s'}, "
+                     f"total {record.seconds:.2f}s")
+
+    @property
+    def cached_ratio(self) -> float:
+        return self.cached_tokens / self.input_tokens if self.input_tokens else 0.0
+
+    def first_token_seconds(self, cached: bool) -> float | None:
+        """
+        最近的流式调用中，命中（cached=True）或未命中缓存的调用的平均首 token 时间。
+        """
+        times = [r.first_token_seconds for r in list(self.records)
+                 if r.first_token_seconds is not None and (r.cached_tokens > 0) == cached]
+        return sum(times) / len(times) if times else None
+
+
+def _usage(response: LLMResult) -> tuple[int, int, int] | None:
+    for generations in response.generations:
+        for generation in generations:
+            metadata = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+            if metadata:
+                details = metadata.get('input_token_details') or {}
+                return metadata['input_tokens'], details.get('cache_read') or 0, metadata['output_tokens']
+    token_usage = (response.llm_output or {}).get('token_usage')
+    if token_usage:
+        details = token_usage.get('prompt_tokens_details') or {}
+        return (token_usage.get('prompt_tokens') or 0, details.get('cached_tokens') or 0,
+                token_usage.get('completion_tokens') or 0)
+    return None
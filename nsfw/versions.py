@@ -0,0 +1,174 @@
+"""
+小说的版本历史：每次保存记录一个经 zlib 压缩的 JSON Patch（RFC 6902 的 add/replace/remove 子集），
+每隔 KEYFRAME_INTERVAL 个版本记录一次完整快照（关键帧）。恢复某个版本时从不晚于它的最近关键帧开始依次应用补丁。
+
+补丁作用的文档以行 id 为键，章节的插入、删除和移动只需替换顺序列表：
+{
+    "head": {小说表头字段},
+    "order": [chapter_id, ...],
+    "chapters": {chapter_id: {"title", "overview", "sections": [section_id, ...]}},
+    "sections": {section_id: {"title", "overview", "content", "after_state"}}
+}
+"""
+import json
+import sqlite3
+import zlib
+from datetime import datetime
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS nsfw_novel_version (
+    novel_id TEXT NOT NULL REFERENCES nsfw_novel(id) ON DELETE CASCADE,
+    version INTEGER NOT NULL,
+    keyframe INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    create_time TEXT,
+    PRIMARY KEY (novel_id, version)
+);
+'''
+
+# 每隔多少个版本存一次完整快照，决定恢复时最多需要应用的补丁数
+KEYFRAME_INTERVAL = 20
+# 压缩级别，版本数据写入后很少读取
+COMPRESS_LEVEL = 9
+
+
+def _pack(obj) -> bytes:
+    return zlib.compress(json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), COMPRESS_LEVEL)
+
+
+def _unpack(data: bytes):
+    return json.loads(zlib.decompress(data))
+
+
+def section_doc(section) -> dict:
+    return {
+        'title': section.title,
+        'overview': section.overview,
+        'content': section.content,
+        'after_state': {name: state.model_dump() for name, state in section.after_state.items()},
+    }
+
+
+def document(head: dict, chapters) -> dict:
+    """
+    由小说表头和已分配行 id 的章对象生成完整文档（关键帧）。
+    """
+    doc = {'head': head, 'order': [], 'chapters': {}, 'sections': {}}
+    for chapter in chapters:
+        doc['order'].append(chapter.row_id)
+        doc['chapters'][chapter.row_id] = {
+            'title': chapter.title,
+            'overview': chapter.overview,
+            'sections': [s.row_id for s in chapter.sections],
+        }
+        for section in chapter.sections:
+            doc['sections'][section.row_id] = section_doc(section)
+    return doc
+
+
+def to_novel_dict(doc: dict) -> dict:
+    """
+    把文档还原为 NSFWNovel.model_validate 可接受的字典。
+    """
+    chapters = []
+    for cid in doc['order']:
+        chapter = doc['chapters'][cid]
+        chapters.append({
+            'title': chapter['title'],
+            'overview': chapter['overview'],
+            'sections': [doc['sections'][sid] for sid in chapter['sections']],
+        })
+    return {**doc['head'], 'chapters': chapters}
+
+
+def _escape(key: str) -> str:
+    return key.replace('~', '~0').replace('/', '~1')
+
+
+def _unescape(key: str) -> str:
+    return key.replace('~1', '/').replace('~0', '~')
+
+
+def op(kind: str, *path, value=None) -> dict:
+    result = {'op': kind, 'path': '/' + '/'.join(_escape(str(p)) for p in path)}
+    if kind != 'remove':
+        result['value'] = value
+    return result
+
+
+def apply_patch(doc: dict, ops: list[dict]) -> dict:
+    """
+    原地应用补丁。文档中所有按路径寻址的容器都是字典，列表只会被整体替换。
+    """
+    for patch in ops:
+        keys = [_unescape(k) for k in patch['path'][1:].split('/')]
+        parent = doc
+        for key in keys[:-1]:
+            parent = parent[key]
+        if patch['op'] == 'remove':
+            del parent[keys[-1]]
+        else:
+            parent[keys[-1]] = patch['value']
+    return doc
+
+
+def ensure_schema(conn: sqlite3.Connection):
+    conn.executescript(SCHEMA)
+
+
+def record(conn: sqlite3.Connection, novel_id: str, version: int, ops: list[dict] | None, make_keyframe):
+    """
+    记录新版本。ops 为 None（无法计算增量，例如整体重写）、上一版本缺失或距上一个关键帧已满
+    KEYFRAME_INTERVAL 个版本时，调用 make_keyframe() 存完整快照，否则只存补丁。
+    """
+    last_version, last_keyframe = conn.execute(
+        'SELECT MAX(version), MAX(CASE WHEN keyframe THEN version END) FROM nsfw_novel_version WHERE novel_id=?',
+        (novel_id,)).fetchone()
+    keyframe = (ops is None or last_version != version - 1 or last_keyframe is None
+                or version - last_keyframe >= KEYFRAME_INTERVAL)
+    data = _pack(make_keyframe() if keyframe else ops)
+    conn.execute('INSERT OR REPLACE INTO nsfw_novel_version (novel_id, version, keyframe, data, create_time) VALUES (?, ?, ?, ?, ?)',
+                 (novel_id, version, int(keyframe), data, datetime.now().isoformat()))
+
+
+def list_versions(conn: sqlite3.Connection, novel_id: str) -> list[tuple]:
+    """
+    返回 (version, keyframe, 压缩后字节数, create_time)，新版本在前。
+    """
+    return conn.execute('SELECT version, keyframe, length(data), create_time FROM nsfw_novel_version WHERE novel_id=? '
+                        'ORDER BY version DESC', (novel_id,)).fetchall()
+
+
+def restore(conn: sqlite3.Connection, novel_id: str, version: int) -> dict | None:
+    """
+    还原指定版本的文档，版本不存在（或已被压缩清理）时返回 None。
+    """
+    row = conn.execute('SELECT MAX(version) FROM nsfw_novel_version WHERE novel_id=? AND keyframe AND version<=?',
+                       (novel_id, version)).fetchone()
+    if row[0] is None:
+        return None
+    rows = conn.execute('SELECT version, data FROM nsfw_novel_version WHERE novel_id=? AND version BETWEEN ? AND ? ORDER BY version',
+                        (novel_id, row[0], version)).fetchall()
+    if not rows or rows[-1][0] != version or len(rows) != version - row[0] + 1:
+        return None
+    doc = _unpack(rows[0][1])
+    for _, data in rows[1:]:
+        apply_patch(doc, _unpack(data))
+    return doc
+
+
+def compact(conn: sqlite3.Connection, novel_id: str, keep: int) -> int:
+    """
+    只保留最近 keep 个版本：把保留范围内最早的版本转存为关键帧，再删除更早的版本。返回删除的行数。
+    """
+    latest = conn.execute('SELECT MAX(version) FROM nsfw_novel_version WHERE novel_id=?', (novel_id,)).fetchone()[0]
+    if latest is None:
+        return 0
+    cutoff = latest - keep + 1
+    if conn.execute('SELECT COUNT(*) FROM nsfw_novel_version WHERE novel_id=? AND version<?', (novel_id, cutoff)).fetchone()[0] == 0:
+        return 0
+    doc = restore(conn, novel_id, cutoff)
+    if doc is None:
+        return 0
+    conn.execute('UPDATE nsfw_novel_version SET keyframe=1, data=? WHERE novel_id=? AND version=?', (_pack(doc), novel_id, cutoff))
+    return conn.execute('DELETE FROM nsfw_novel_version WHERE novel_id=? AND version<?', (novel_id, cutoff)).rowcount
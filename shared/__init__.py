@@ -0,0 +1,4 @@
+"""
+nsfw 和 translator 两个应用共用的模块。两个应用以各自目录为脚本目录运行（模块名 core 等会冲突），
+因此在 ui.py 中把仓库根目录追加到 sys.path 后以 shared.xxx 导入。
+"""
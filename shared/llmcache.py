@@ -0,0 +1,210 @@
+"""
+本地的模型响应缓存，nsfw 和 translator 共用一个 SQLite 文件。
+
+实现为 langchain 的 BaseCache：把它传给 ChatOpenAI(cache=...) 后，invoke/ainvoke（包括 with_structured_output）
+会先按 (模型参数, 消息) 查缓存，命中时不发送请求。键是 langchain 生成的 llm_string（模型名、温度、
+response_format 等调用参数）与序列化后的消息拼接后的 sha256；json_mode 的输出格式写在提示词里，因此也包含在键中。
+
+langchain 的 stream() 不查缓存，流式调用改用 cached_stream：命中时把缓存的回复切成片段重放，
+未命中时正常流式请求，完整结束后写入缓存（中途停止或出错的流不写入）。
+
+淘汰：超过 CACHE_TTL 秒的条目视为不存在；总大小超过 CACHE_MAX_BYTES 时按最近访问时间从旧到新删除。
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Iterator, Sequence
+
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, Generation
+
+# 放在仓库根目录，两个应用无论从哪个工作目录启动都使用同一个文件
+CACHE_DB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'llm_cache.db')
+# 条目有效期（秒）
+CACHE_TTL = 30 * 24 * 3600
+# 缓存总大小上限（压缩后的字节数）
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+# 重放命中的流式响应时每个片段的字符数
+REPLAY_CHUNK_CHARS = 64
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS llm_cache (
+    key TEXT PRIMARY KEY,
+    llm TEXT,
+    value BLOB NOT NULL,
+    bytes INTEGER NOT NULL,
+    create_time REAL NOT NULL,
+    access_time REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_llm_cache_access ON llm_cache(access_time);
+'''
+
+
+def cache_key(prompt: str, llm_string: str) -> str:
+    return hashlib.sha256(f'{llm_string}\0{prompt}'.encode('utf-8')).hexdigest()
+
+
+class SQLiteLLMCache(BaseCache):
+    """
+    进程内共享一个连接（WAL 模式），读写都很短，用锁串行化。
+    hits / misses / bytes_saved（命中时未经网络传输的响应文本字节数）/ tokens_saved 为本进程的统计。
+    """
+
+    def __init__(self, db_path: str = CACHE_DB_PATH, ttl: float | None = CACHE_TTL, max_bytes: int = CACHE_MAX_BYTES):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.tokens_saved = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+        self._total = self._conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM llm_cache').fetchone()[0]
+
+    def lookup(self, prompt: str, llm_string: str) -> Sequence[Generation] | None:
+        key = cache_key(prompt, llm_string)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT value, create_time FROM llm_cache WHERE key=?', (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self._delete('key=?', (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE llm_cache SET access_time=?, hits=hits+1 WHERE key=?', (now, key))
+        try:
+            generations = loads(zlib.decompress(row[0]).decode('utf-8'))
+        except Exception as e:
+            logging.warning(f"Dropping unreadable LLM cache entry {key}: {e}")
+            with self._lock:
+                self._delete('key=?', (key,))
+                self.misses += 1
+            return None
+        saved_bytes = saved_tokens = 0
+        for generation in generations:
+            saved_bytes += len(generation.text.encode('utf-8'))
+            message = getattr(generation, 'message', None)
+            usage = getattr(message, 'usage_metadata', None)
+            if usage:
+                saved_tokens += usage.get('total_tokens') or 0
+                # 命中缓存没有产生新的用量，不让用量统计（usage.PromptCacheStats 等回调）重复计算
+                message.usage_metadata = None
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += saved_bytes
+            self.tokens_saved += saved_tokens
+        return generations
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Generation]) -> None:
+        key = cache_key(prompt, llm_string)
+        value = zlib.compress(dumps(list(return_val)).encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute('SELECT bytes FROM llm_cache WHERE key=?', (key,)).fetchone()
+            self._conn.execute('INSERT OR REPLACE INTO llm_cache (key, llm, value, bytes, create_time, access_time) '
+                               'VALUES (?, ?, ?, ?, ?, ?)', (key, llm_string[:200], value, len(value), now, now))
+            self._total += len(value) - (old[0] if old else 0)
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # 按最近访问时间删除，直到总大小降到上限的 90% 以下，避免每次写入都触发淘汰
+        target = self.max_bytes * 0.9
+        rows = self._conn.execute('SELECT key, bytes FROM llm_cache ORDER BY access_time').fetchall()
+        doomed = []
+        for key, size in rows:
+            if self._total <= target:
+                break
+            doomed.append((key,))
+            self._total -= size
+        self._conn.executemany('DELETE FROM llm_cache WHERE key=?', doomed)
+
+    def _delete(self, where: str, args: tuple):
+        removed = self._conn.execute(f'SELECT COALESCE(SUM(bytes), 0) FROM llm_cache WHERE {where}', args).fetchone()[0]
+        self._conn.execute(f'DELETE FROM llm_cache WHERE {where}', args)
+        self._total -= removed
+
+    def purge_expired(self) -> int:
+        """
+        删除所有过期条目，返回删除数。查找时过期条目也会被顺便删除，这里用于维护。
+        """
+        if self.ttl is None:
+            return 0
+        with self._lock:
+            count = self._conn.execute('SELECT COUNT(*) FROM llm_cache WHERE create_time<?', (time.time() - self.ttl,)).fetchone()[0]
+            self._delete('create_time<?', (time.time() - self.ttl,))
+        return count
+
+    def clear(self, **kwargs) -> None:
+        with self._lock:
+            self._conn.execute('DELETE FROM llm_cache')
+            self._total = 0
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0
+
+
+_cache: SQLiteLLMCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> SQLiteLLMCache:
+    """
+    获取进程级共享的响应缓存，首次调用时打开数据库。
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SQLiteLLMCache()
+    return _cache
+
+
+def replay(message: BaseMessage, chunk_chars: int = REPLAY_CHUNK_CHARS) -> Iterator[AIMessageChunk]:
+    text = message.content if isinstance(message.content, str) else str(message.content)
+    for start in range(0, len(text), chunk_chars):
+        yield AIMessageChunk(content=text[start:start + chunk_chars])
+    if not text:
+        yield AIMessageChunk(content='')
+
+
+def cached_stream(llm, messages: list[BaseMessage], **kwargs) -> Iterator[AIMessageChunk]:
+    """
+    llm.stream(messages, **kwargs) 的缓存版本，与 llm.invoke(messages, **kwargs) 使用相同的键，
+    因此 invoke 写入的结果也能被流式重放。llm.cache 不是 BaseCache 时直接流式请求。
+    """
+    cache = llm.cache if isinstance(llm.cache, BaseCache) else None
+    if cache is None:
+        yield from llm.stream(messages, **kwargs)
+        return
+    llm_string = llm._get_llm_string(**kwargs)
+    prompt = dumps(messages)
+    cached = cache.lookup(prompt, llm_string)
+    if cached:
+        yield from replay(cached[0].message)
+        return
+    merged: AIMessageChunk | None = None
+    for chunk in llm.stream(messages, **kwargs):
+        merged = chunk if merged is None else merged + chunk
+        yield chunk
+    if merged is not None:
+        message = AIMessage(content=merged.content, response_metadata=merged.response_metadata,
+                            usage_metadata=merged.usage_metadata)
+        cache.update(prompt, llm_string, [ChatGeneration(message=message)])
@@ -0,0 +1,111 @@
+"""
+流式输出的节流渲染：模型逐 token 产出文本时，按固定刷新率批量更新页面，而不是每个 token 都把全文重新发给浏览器。
+
+已完成的段落（以空行结尾）追加为独立的 markdown 元素，之后不再发送；每次刷新只重绘最后一个未完成的段落。
+用 set 整体替换文本时，新文本以已渲染的文本开头则按追加处理，否则清空后重绘。
+"""
+import logging
+import threading
+import time
+
+import streamlit as st
+
+# 默认每秒最多刷新次数
+STREAM_FPS = 10
+
+
+class StreamRenderer:
+    """
+    用法：
+        with StreamRenderer() as renderer:
+            for delta in stream:
+                renderer.append(delta)
+    退出时（流结束或出错）立即渲染剩余内容。刷新只在收到新内容时发生，流暂停期间最后一批内容会等到下次 append 或 close。
+    append / set 可以在附加了 ScriptRunContext 的工作线程中调用。
+    """
+
+    def __init__(self, placeholder=None, fps: float = STREAM_FPS, label: str = 'stream'):
+        self.placeholder = placeholder if placeholder is not None else st.empty()
+        self.interval = 1 / fps if fps > 0 else 0
+        self.label = label
+        self.text = ''
+        self.renders = 0
+        self.bytes_pushed = 0
+        self._lock = threading.Lock()
+        self._started: float | None = None
+        self._last_render = 0.0
+        self._dirty = False
+        self._reset()
+
+    def _reset(self):
+        # 已追加为独立元素的文本长度，以及显示未完成段落的元素
+        self._container = self.placeholder.container()
+        self._tail = self._container.empty()
+        self._committed = 0
+        self._rendered = ''
+
+    def append(self, delta: str):
+        if not delta:
+            return
+        with self._lock:
+            self.text += delta
+            self._changed()
+
+    def set(self, text: str):
+        with self._lock:
+            if not text.startswith(self._rendered):
+                self._reset()
+            self.text = text
+            self._changed()
+
+    def _changed(self):
+        now = time.monotonic()
+        if self._started is None:
+            self._started = now
+        self._dirty = True
+        if now - self._last_render >= self.interval:
+            self._render(now)
+
+    def _render(self, now: float):
+        text = self.text
+        if not text.startswith(self._rendered):
+            self._reset()
+        cut = text.rfind('\n\n', self._committed)
+        if cut > self._committed:
+            # 当前末尾元素固定为已完成的段落，之后的内容放到新的末尾元素
+            self._push(self._tail, text[self._committed:cut])
+            self._tail = self._container.empty()
+            self._committed = cut + 2
+        self._push(self._tail, text[self._committed:])
+        self._rendered = text
+        self._last_render = now
+        self._dirty = False
+        self.renders += 1
+
+    def _push(self, element, markdown: str):
+        element.markdown(markdown)
+        self.bytes_pushed += len(markdown.encode('utf-8'))
+
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                self._render(time.monotonic())
+
+    @property
+    def renders_per_second(self) -> float:
+        if self._started is None:
+            return 0.0
+        elapsed = self._last_render - self._started
+        return self.renders / elapsed if elapsed > 0 else float(self.renders)
+
+    def close(self):
+        self.flush()
+        logging.info(f"{self.label}: {len(self.text)} chars, {self.renders} renders "
+                     f"({self.renders_per_second:.1f}/s), {self.bytes_pushed} bytes pushed")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
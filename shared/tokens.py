@@ -0,0 +1,70 @@
+"""
+按模型计算文本的 token 数，nsfw 的滚动记忆和 translator 的分块共用。
+
+token 数按模型所用的 tiktoken 编码计算；非 OpenAI 模型没有公开的分词器，用 o200k_base 近似。
+编码文件无法下载时退回按字符估算（中日韩字符每字一个 token，其余每 4 个字符一个 token）。
+"""
+import logging
+import re
+import threading
+from functools import lru_cache
+from typing import Callable
+
+# 每个模型缓存计数结果的文本数
+COUNT_CACHE_SIZE = 8192
+
+_CJK = re.compile(r'[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]')
+
+
+def estimate_tokens(text: str) -> int:
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def encoding_name_for(model_name: str) -> str:
+    import tiktoken.model
+    try:
+        return tiktoken.model.encoding_name_for_model(model_name.split('/')[-1])
+    except KeyError:
+        return 'o200k_base'
+
+
+class TokenCounter:
+    """
+    count(text) 返回 text 在该模型下的 token 数，结果按文本缓存（提示词中的概要等大多在多次调用间不变）。
+    """
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.encoding_name = encoding_name_for(model_name)
+        self.estimated = False
+        self._encoding = None
+        self._lock = threading.Lock()
+        self.count: Callable[[str], int] = lru_cache(maxsize=COUNT_CACHE_SIZE)(self.measure)
+
+    def _load(self):
+        with self._lock:
+            if self._encoding is None and not self.estimated:
+                try:
+                    import tiktoken
+                    self._encoding = tiktoken.get_encoding(self.encoding_name)
+                except Exception as e:
+                    logging.warning(f"tiktoken encoding {self.encoding_name} unavailable, estimating token counts: {e}")
+                    self.estimated = True
+        return self._encoding
+
+    def measure(self, text: str) -> int:
+        """
+        不经缓存计数，用于只出现一次的文本（完整提示词、截断时的候选片段）。
+        """
+        if not text:
+            return 0
+        encoding = self._encoding or self._load()
+        if encoding is None:
+            return estimate_tokens(text)
+        return len(encoding.encode(text, disallowed_special=()))
+
+
+@lru_cache(maxsize=32)
+def token_counter(model_name: str) -> TokenCounter:
+    return TokenCounter(model_name)
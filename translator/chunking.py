@@ -0,0 +1,92 @@
+"""
+按 token 分块：每块的大小按翻译所用模型的分词器计算，而不是字符数（同样 1500 个字符，中文的 token 数是英文的数倍）。
+
+依次在空行（段落）、换行、句末处切分，只有单个段落（句子）超出预算时才继续细分，最后按 token 硬切。
+切分处的分隔符记录在块上，译文按 译文 + 分隔符 依次拼接即可还原原文的段落排版。
+切出的片段按顺序尽量装满一块，零碎的短段落（对话、分隔线等）合并到同一次请求；末尾过短的块并入前一块。
+"""
+import os
+import re
+import sys
+from dataclasses import dataclass
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.tokens import token_counter
+
+# 末尾块不足此 token 数时并入前一块
+MIN_CHUNK_TOKENS = 200
+
+# 由粗到细的切分位置，分组内为保留下来的分隔符
+_SEPARATORS = [
+    re.compile(r'(\n[ \t]*\n(?:[ \t]*\n)*)'),
+    re.compile(r'(\n)'),
+    re.compile(r'((?<=[。！？!?…；;])[ \t]*|(?<=\.)[ \t]+)'),
+]
+
+
+@dataclass
+class Chunk:
+    text: str
+    # 原文中紧跟在这一块之后的分隔符
+    sep: str = ''
+
+
+class TokenChunker:
+    def __init__(self, model_name: str, max_tokens: int, min_tokens: int = MIN_CHUNK_TOKENS):
+        self.counter = token_counter(model_name)
+        self.max_tokens = max_tokens
+        self.min_tokens = min_tokens
+
+    def split(self, text: str) -> list[Chunk]:
+        """
+        切分 text，''.join(c.text + c.sep for c in chunks) == text。
+        """
+        chunks: list[Chunk] = []
+        current: list[str] = []
+        used = 0
+        for piece, sep in self._pieces(text, 0):
+            # 分隔符也计入这一块（块末尾的分隔符不发送，略偏保守）
+            tokens = self.counter.count(piece) + self.counter.count(sep)
+            if current and used + tokens > self.max_tokens:
+                chunks.append(Chunk(''.join(current[:-1]), current[-1]))
+                current, used = [], 0
+            current += [piece, sep]
+            used += tokens
+        if current:
+            chunks.append(Chunk(''.join(current[:-1]), current[-1]))
+        if len(chunks) > 1 and self.counter.count(chunks[-1].text) < self.min_tokens:
+            last = chunks.pop()
+            chunks[-1] = Chunk(chunks[-1].text + chunks[-1].sep + last.text, last.sep)
+        return chunks
+
+    def _pieces(self, text: str, level: int) -> list[tuple[str, str]]:
+        # (片段, 其后的分隔符)，每个片段都不超过 max_tokens
+        if level == len(_SEPARATORS):
+            return self._hard_cut(text)
+        parts = _SEPARATORS[level].split(text)
+        pieces = []
+        for k in range(0, len(parts), 2):
+            piece, sep = parts[k], parts[k + 1] if k + 1 < len(parts) else ''
+            if self.counter.count(piece) <= self.max_tokens:
+                pieces.append((piece, sep))
+            else:
+                finer = self._pieces(piece, level + 1)
+                finer[-1] = (finer[-1][0], finer[-1][1] + sep)
+                pieces += finer
+        return pieces
+
+    def _hard_cut(self, text: str) -> list[tuple[str, str]]:
+        pieces = []
+        while self.counter.measure(text) > self.max_tokens:
+            # 不超过 max_tokens 的最长前缀（至少一个字符）
+            low, high = 1, len(text)
+            while low < high:
+                mid = (low + high + 1) // 2
+                if self.counter.measure(text[:mid]) <= self.max_tokens:
+                    low = mid
+                else:
+                    high = mid - 1
+            pieces.append((text[:low], ''))
+            text = text[low:]
+        pieces.append((text, ''))
+        return pieces
@@ -2,13 +2,20 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from langchain_openai import ChatOpenAI
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_core.prompts import ChatPromptTemplate
 from langchain.globals import set_debug, set_verbose
+import logging
 import os
+import sys
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Generator, Optional, Callable
-from threading import Thread
+from threading import Thread, Event, current_thread
+import queue
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.llmcache import get_response_cache, cached_stream
+from memory import CONTEXT_MARK, ChunkMatch, TranslationMemory, TranslationRun, get_translation_memory, normalize
+from chunking import Chunk, TokenChunker
 
 MODEL_OPTIONS = [
     "deepseek/deepseek-chat-v3-0324",
@@ -24,15 +31,49 @@ MODEL_OPTIONS = [
     # More models can be added as needed
 ]
 
+# Source tokens per request for each model, leaving room in the output limit for the translation
+# (reasoning models also spend output tokens on thinking, so they get smaller chunks)
+MODEL_CHUNK_TOKENS = {
+    "deepseek/deepseek-chat-v3-0324": 2000,
+    "deepseek/deepseek-chat-v3-0324:free": 2000,
+    "deepseek/deepseek-r1-0528": 1500,
+    "deepseek/deepseek-r1-0528:free": 1500,
+    "google/gemini-2.5-flash-preview-05-20": 4000,
+    "google/gemini-2.5-pro-preview": 4000,
+    "google/gemini-2.0-flash-001": 2500,
+    "x-ai/grok-3-mini-beta": 2000,
+    "x-ai/grok-3-beta": 3000,
+    "openai/gpt-4.1-mini-2025-04-14": 4000,
+}
+DEFAULT_CHUNK_TOKENS = 1500
+
 LANG_OPTIONS = ["Chinese (Simp.)", "English", "Japanese", "Korean", "French", "German", "Spanish"]
 
 set_debug(True)
 set_verbose(True)
 
+# Number of chunks translate_stream requests ahead of the chunk being streamed
+STREAM_LOOKAHEAD = 2
+
+# End-of-chunk marker in the per-chunk output queues of translate_parallel_stream
+_DONE = object()
+
+
+def _thread_initializer(worker_thread_initializer: Optional[Callable[[Thread], None]]) -> Optional[Callable[[], None]]:
+    # Runs the caller's initializer (e.g. attaching the Streamlit script context) inside each worker thread
+    if worker_thread_initializer is None:
+        return None
+    return lambda: worker_thread_initializer(current_thread())
+
 class LLMTranslator:
-    def __init__(self, model_name: str = MODEL_OPTIONS[0], chunk_size: int = 1500) -> None:
-        self.llm: ChatOpenAI = ChatOpenAI(model_name=model_name, base_url="https://openrouter.ai/api/v1")
-        self.text_splitter: RecursiveCharacterTextSplitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=0)
+    def __init__(self, model_name: str = MODEL_OPTIONS[0], chunk_tokens: Optional[int] = None, use_cache: bool = True,
+                 use_memory: bool = True) -> None:
+        self.model_name = model_name
+        # Identical chunks (same model, language and text) are served from the shared local response cache
+        self.llm: ChatOpenAI = ChatOpenAI(model_name=model_name, base_url="https://openrouter.ai/api/v1",
+                                          cache=get_response_cache() if use_cache else False)
+        # Chunks are measured with the model's tokenizer and split at paragraph boundaries
+        self.chunker: TokenChunker = TokenChunker(model_name, chunk_tokens or MODEL_CHUNK_TOKENS.get(model_name, DEFAULT_CHUNK_TOKENS))
         self.prompt: ChatPromptTemplate = ChatPromptTemplate.from_messages([
             ('system',
                 "You are a professional translation assistant. Please translate the user's input into {tgt_lang}, keeping the original tone and formatting. Only return the translated text, without any explanation or additional information."
@@ -40,6 +81,134 @@ class LLMTranslator:
             ("human", "{text}")
         ])
         self.chain = self.prompt | self.llm
+        # Numbered line-by-line requests, whose answers can be checked line for line (see memory.ChunkMatch)
+        self.lines_prompt: ChatPromptTemplate = ChatPromptTemplate.from_messages([
+            ('system',
+                "You are a professional translation assistant. Translate lines of a document into {tgt_lang}, keeping the original tone. "
+                "Lines starting with a number in square brackets, like [1], must be translated. "
+                "Lines starting with {context_mark} are the surrounding text, given only as context: do not translate or return them. "
+                "Return exactly one line for each numbered line, in the same order, starting with the same number in square brackets "
+                "followed by the translation. Do not merge or split lines, and do not add any explanation or additional information."
+            ),
+            ("human", "{text}")
+        ])
+        self.lines_chain = self.lines_prompt | self.llm
+        # Previously translated chunks and lines are reused, only the rest is sent to the model
+        self.memory: Optional[TranslationMemory] = get_translation_memory() if use_memory else None
+        # Reuse statistics of the latest translate_parallel / translate_stream call
+        self.last_run: TranslationRun = TranslationRun()
+
+    def _invoke(self, text: str, tgt_lang: str) -> str:
+        return self.chain.invoke({"tgt_lang": tgt_lang, "text": text}).content
+
+    def _translate_chunk(self, chunk: str, tgt_lang: str, run: TranslationRun) -> str:
+        if not normalize(chunk):
+            return chunk
+        if self.memory is None:
+            run.add(len(chunk), 0, 1)
+            return self._invoke(chunk, tgt_lang)
+        match = self.memory.lookup(chunk, tgt_lang, self.model_name)
+        if match.complete:
+            run.add(len(chunk), match.reused_chars, 0)
+            return match.text()
+        if match.translated:
+            # Only the missing lines, with the remembered ones as context
+            return self._translate_lines(match, tgt_lang, run)
+        result = self._invoke(chunk, tgt_lang)
+        self.memory.store(chunk, result, tgt_lang, self.model_name)
+        run.add(len(chunk), 0, 1)
+        return result
+
+    def _translate_lines(self, match: ChunkMatch, tgt_lang: str, run: TranslationRun) -> str:
+        """
+        Translates the lines missing from the memory in one numbered request, with the remembered lines of the chunk
+        as untranslated context. Falls back to translating the whole chunk when the numbers in the answer don't match.
+        """
+        reused = match.reused_chars
+        answer = self.lines_chain.invoke({"tgt_lang": tgt_lang, "context_mark": CONTEXT_MARK, "text": match.request()}).content
+        lines = match.fill(answer)
+        if lines is None:
+            result = self._invoke(match.source, tgt_lang)
+            self.memory.store(match.source, result, tgt_lang, self.model_name)
+            run.add(len(match.source), 0, 2)
+            return result
+        self.memory.store(match.source, match.text(), tgt_lang, self.model_name, lines)
+        run.add(len(match.source), reused, 1)
+        return match.text()
+
+    def _chunk_parts(self, chunk: str, tgt_lang: str, run: TranslationRun) -> Generator[str, None, None]:
+        if not normalize(chunk):
+            yield chunk
+            return
+        if self.memory is not None:
+            match = self.memory.lookup(chunk, tgt_lang, self.model_name)
+            if match.complete:
+                run.add(len(chunk), match.reused_chars, 0)
+                yield match.text()
+                return
+            if match.translated:
+                # Partly remembered chunks are completed without streaming
+                yield self._translate_lines(match, tgt_lang, run)
+                return
+        # Replays a cached translation instead of calling the model when the chunk was translated before
+        stream = cached_stream(self.llm, self.prompt.invoke({"tgt_lang": tgt_lang, "text": chunk}).to_messages())
+        chunk_result = ""
+        for part in stream:
+            chunk_result += part.content
+            yield part.content
+        run.add(len(chunk), 0, 1)
+        if self.memory is not None:
+            self.memory.store(chunk, chunk_result, tgt_lang, self.model_name)
+
+    def _ordered_stream(
+        self,
+        chunks: list[Chunk],
+        tgt_lang: str,
+        max_workers: int,
+        window: Optional[int],
+        worker_thread_initializer: Optional[Callable[[Thread], None]],
+        progress_callback: Optional[Callable[[int, int, str], None]]
+    ) -> Generator[str, None, None]:
+        # Chunks are translated by max_workers threads and yielded in order; with a window only chunks up to
+        # `window` positions after the one being yielded are started, otherwise all chunks are queued at once
+        self.last_run = run = TranslationRun()
+        outputs: list[queue.Queue] = [queue.Queue() for _ in chunks]
+        stop = Event()
+        def stream_chunk(idx: int) -> None:
+            try:
+                for part in self._chunk_parts(chunks[idx].text, tgt_lang, run):
+                    if stop.is_set():
+                        return
+                    outputs[idx].put(part)
+            except Exception as e:
+                outputs[idx].put(e)
+            finally:
+                outputs[idx].put(_DONE)
+        executor = ThreadPoolExecutor(max_workers=max_workers, initializer=_thread_initializer(worker_thread_initializer))
+        submitted = 0
+        def submit_until(end: int) -> None:
+            # Workers take chunks in submission order, so the head of the document is always in flight
+            nonlocal submitted
+            while submitted < min(end, len(chunks)):
+                executor.submit(stream_chunk, submitted)
+                submitted += 1
+        try:
+            for idx, output in enumerate(outputs):
+                submit_until(len(chunks) if window is None else idx + window + 1)
+                chunk_result = ""
+                while (part := output.get()) is not _DONE:
+                    if isinstance(part, Exception):
+                        raise part
+                    chunk_result += part
+                    yield part
+                if chunks[idx].sep:
+                    yield chunks[idx].sep
+                if progress_callback:
+                    progress_callback(idx + 1, len(chunks), chunk_result)
+        finally:
+            # Stopped early (or failed): drop the chunks that have not started and end the running streams
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
 
     def translate_parallel(
         self, 
@@ -49,38 +218,59 @@ class LLMTranslator:
         worker_thread_initializer: Optional[Callable[[Thread], None]] = None,
         progress_callback: Optional[Callable[[int, int, list[Optional[str]]], None]] = None
     ) -> str:
-        chunks: list[str] = self.text_splitter.split_text(text)
+        chunks: list[Chunk] = self.chunker.split(text)
+        # Translations followed by the source separators, so joining them restores the layout
         results: list[Optional[str]] = [None] * len(chunks)
-        def translate_chunk(i: int, chunk: str) -> None:
-            result = self.chain.invoke({"tgt_lang": tgt_lang, "text": chunk})
-            results[i] = result.content
-            if progress_callback:
-                progress_callback(i + 1, len(chunks), results)
-        with ThreadPoolExecutor(max_workers=max_workers, initargs=worker_thread_initializer) as executor:
-            futures = [executor.submit(translate_chunk, i, chunk) for i, chunk in enumerate(chunks)]
-            if worker_thread_initializer:
-                for thread in executor._threads:
-                    worker_thread_initializer(thread)
-        for future in as_completed(futures):
+        self.last_run = run = TranslationRun()
+        # Chunks repeated within the document are translated once
+        duplicates: dict[str, list[int]] = {}
+        for i, chunk in enumerate(chunks):
+            duplicates.setdefault(chunk.text, []).append(i)
+        def translate_chunk(indexes: list[int]) -> None:
             try:
+                result = self._translate_chunk(chunks[indexes[0]].text, tgt_lang, run)
+                repeated = sum(len(chunks[i].text) for i in indexes[1:])
+                run.add(repeated, repeated, 0)
+            except Exception:
+                # Keeps the source text in place of the failed chunk instead of dropping it; the caller reports run.failed_chunks
+                logging.exception(f"Error translating chunk {indexes[0] + 1}/{len(chunks)}")
+                result = chunks[indexes[0]].text
+                run.add_failure(sum(len(chunks[i].text) for i in indexes), len(indexes))
+            for i in indexes:
+                results[i] = result + chunks[i].sep
+            if progress_callback:
+                progress_callback(sum(part is not None for part in results), len(chunks), results)
+        with ThreadPoolExecutor(max_workers=max_workers, initializer=_thread_initializer(worker_thread_initializer)) as executor:
+            futures = [executor.submit(translate_chunk, indexes) for indexes in duplicates.values()]
+            for future in as_completed(futures):
                 future.result()  # Ensure any exceptions are raised
-            except Exception as e:
-                print(f"Error translating chunk: {e}")
-        return "".join(results)  # type: ignore
+        return "".join(part or "" for part in results)
+
+    def translate_parallel_stream(
+        self,
+        text: str,
+        tgt_lang: str,
+        max_workers: int = 6,
+        worker_thread_initializer: Optional[Callable[[Thread], None]] = None,
+        progress_callback: Optional[Callable[[int, int, str], None]] = None
+    ) -> Generator[str, None, None]:
+        """
+        Translates up to max_workers chunks at the same time but yields the output in document order:
+        the first unfinished chunk streams token by token, later chunks are buffered until it is done.
+        """
+        chunks: list[Chunk] = self.chunker.split(text)
+        yield from self._ordered_stream(chunks, tgt_lang, max_workers, None, worker_thread_initializer, progress_callback)
 
     def translate_stream(
         self, 
         text: str, 
         tgt_lang: str, 
-        progress_callback: Optional[Callable[[int, int, str], None]] = None
+        progress_callback: Optional[Callable[[int, int, str], None]] = None,
+        lookahead: int = STREAM_LOOKAHEAD
     ) -> Generator[str, None, None]:
-        chunks: list[str] = self.text_splitter.split_text(text)
-        total_chunks = len(chunks)
-        for idx, chunk in enumerate(chunks):
-            stream = self.chain.stream({"tgt_lang": tgt_lang, "text": chunk})
-            chunk_result = ""
-            for part in stream:
-                chunk_result += part.content
-                yield part.content
-            if progress_callback:
-                progress_callback(idx + 1, total_chunks, chunk_result)
+        """
+        Streams the translation chunk by chunk. While a chunk is streaming, the next `lookahead` chunks are
+        already requested and buffered, so the next chunk usually starts without waiting for its first token.
+        """
+        chunks: list[Chunk] = self.chunker.split(text)
+        yield from self._ordered_stream(chunks, tgt_lang, lookahead + 1, lookahead, None, progress_callback)
@@ -0,0 +1,223 @@
+"""
+翻译记忆：持久保存 (原文, 目标语言, 模型) -> 译文，修改后重新上传的文档只需翻译改动过的部分。
+
+原文先规范化（NFKC、去除零宽字符、合并空白）再作为键，因此只在全角/半角、缩进、空白上不同的文本视为相同。
+记忆分两级：
+- 整块：一次请求的原文和译文；
+- 行：只保存确认对齐的行——块只有一行，或者请求按编号逐行翻译（request()）且返回的编号与请求完全一致。
+  只比较行数不可靠：模型合并一行、拆开另一行时行数不变，之后的每一行都会错位。
+文档修改后分块的边界会移动，整块通常无法命中，此时逐行查找：全部命中则直接拼出译文，
+部分命中则按编号只翻译缺失的行，块中其余的行作为不翻译的上下文一起发送；返回的编号对不上时退回翻译整块。
+同一文档中重复出现的块或行（分隔符、反复出现的台词等）也会命中。
+
+只复用规范化后完全相同的文本：相似但不同的文本（哪怕只改了一个字）正是用户修改过、需要重新翻译的部分。
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from dataclasses import dataclass, field
+
+TM_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'translation_memory.db')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS segments (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    target TEXT NOT NULL,
+    create_time REAL NOT NULL,
+    use_time REAL NOT NULL,
+    uses INTEGER NOT NULL DEFAULT 0
+);
+'''
+
+_INVISIBLE = re.compile('[\u200b-\u200f\u2060\ufeff]')
+_LINE_BREAKS = re.compile(r'(\n+)')
+_NUMBERED_LINE = re.compile(r'\s*\[(\d+)\]\s?(.*)')
+# request() 中作为上下文、不需要翻译的行的前缀
+CONTEXT_MARK = '(context)'
+
+
+def normalize(text: str) -> str:
+    text = _INVISIBLE.sub('', unicodedata.normalize('NFKC', text))
+    return ' '.join(text.split())
+
+
+def split_lines(text: str) -> list[str]:
+    """
+    按换行拆分并保留换行：偶数下标为行，奇数下标为行之间的换行符。
+    """
+    return _LINE_BREAKS.split(text)
+
+
+def text_lines(text: str) -> list[str]:
+    return [line for line in split_lines(text)[::2] if normalize(line)]
+
+
+@dataclass
+class ChunkMatch:
+    """
+    一个块在翻译记忆中的查找结果。complete 为真时 text() 即为译文；
+    否则把 request() 按编号逐行翻译，fill(译文) 成功后 text() 拼出整块译文。
+    """
+    source: str
+    parts: list[str]
+    translated: dict[int, str] = field(default_factory=dict)
+    missing: list[int] = field(default_factory=list)
+    whole: str | None = None
+
+    @property
+    def complete(self) -> bool:
+        return self.whole is not None or not self.missing
+
+    @property
+    def reused_chars(self) -> int:
+        if self.whole is not None:
+            return len(self.source)
+        return sum(len(self.parts[i]) for i in self.translated)
+
+    def request(self) -> str:
+        """
+        整块的每个非空行占一行：缺失的行以 [序号] 开头，需要翻译；其余的行以 CONTEXT_MARK 开头，只作为上下文。
+        """
+        missing = {i: n for n, i in enumerate(self.missing, 1)}
+        return '\n'.join(f'[{missing[i]}] {self.parts[i].strip()}' if i in missing else f'{CONTEXT_MARK} {self.parts[i].strip()}'
+                         for i in range(0, len(self.parts), 2) if normalize(self.parts[i]))
+
+    def fill(self, translation: str) -> dict[str, str] | None:
+        """
+        解析按 request() 翻译的结果：每个非空行都必须是 [序号] 译文，且序号依次为 1..缺失行数。
+        成功时补全缺失的行并返回 {原文行: 译文行}，否则不修改并返回 None。
+        """
+        lines = [_NUMBERED_LINE.fullmatch(line) for line in text_lines(translation)]
+        if len(lines) != len(self.missing) or any(m is None or int(m[1]) != n for n, m in enumerate(lines, 1)):
+            return None
+        targets = [m[2].strip() for m in lines]
+        if not all(targets):
+            return None
+        filled = {self.parts[i]: target for i, target in zip(self.missing, targets)}
+        self.translated.update(zip(self.missing, targets))
+        self.missing = []
+        return filled
+
+    def text(self) -> str:
+        if self.whole is not None:
+            return self.whole
+        # 行的译文不含首尾空白，沿用原文行的缩进和行尾空白
+        return ''.join(_padded(part, self.translated[i]) if i in self.translated else part
+                       for i, part in enumerate(self.parts))
+
+
+def _padded(source: str, target: str) -> str:
+    core = source.strip()
+    start = source.index(core)
+    return source[:start] + target + source[start + len(core):]
+
+
+class TranslationMemory:
+    """
+    进程内共享一个 SQLite 连接，用锁串行化。条目不过期：译文是用户的成果，不是可以随时重建的缓存。
+    """
+
+    def __init__(self, db_path: str = TM_DB_PATH):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+
+    @staticmethod
+    def _key(kind: str, source: str, tgt_lang: str, model: str) -> str:
+        return hashlib.sha256(f'{kind}\0{model}\0{tgt_lang}\0{source}'.encode('utf-8')).hexdigest()
+
+    def _chunk_key(self, source: str, tgt_lang: str, model: str) -> str:
+        # 换行原样保留：整块命中时直接使用保存的译文，行的排版必须与原文一致
+        parts = split_lines(source)
+        return self._key('chunk', ''.join(normalize(part) if i % 2 == 0 else part for i, part in enumerate(parts)),
+                         tgt_lang, model)
+
+    def lookup(self, source: str, tgt_lang: str, model: str) -> ChunkMatch:
+        parts = split_lines(source)
+        match = ChunkMatch(source, parts)
+        chunk_key = self._chunk_key(source, tgt_lang, model)
+        line_keys = {i: self._key('line', normalize(parts[i]), tgt_lang, model)
+                     for i in range(0, len(parts), 2) if normalize(parts[i])}
+        keys = [chunk_key, *set(line_keys.values())]
+        with self._lock:
+            found = dict(self._conn.execute(
+                f'SELECT key, target FROM segments WHERE key IN ({",".join("?" * len(keys))})', keys).fetchall())
+            if found:
+                self._conn.executemany('UPDATE segments SET use_time=?, uses=uses+1 WHERE key=?',
+                                       [(time.time(), key) for key in found])
+        if chunk_key in found:
+            match.whole = found[chunk_key]
+            return match
+        for i, key in line_keys.items():
+            if key in found:
+                match.translated[i] = found[key]
+            else:
+                match.missing.append(i)
+        return match
+
+    def store(self, source: str, translation: str, tgt_lang: str, model: str, lines: dict[str, str] | None = None):
+        """
+        保存一个块的原文和译文。lines 为已确认对齐的 {原文行: 译文行}；块只有一行时整块译文即为该行的译文。
+        """
+        now = time.time()
+        rows = [(self._chunk_key(source, tgt_lang, model), 'chunk', translation, now, now)]
+        source_lines = text_lines(source)
+        if lines is None and len(source_lines) == 1 and translation.strip():
+            lines = {source_lines[0]: translation.strip()}
+        rows += [(self._key('line', normalize(s), tgt_lang, model), 'line', t, now, now) for s, t in (lines or {}).items()]
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO segments (key, kind, target, create_time, use_time) '
+                                   'VALUES (?, ?, ?, ?, ?)', rows)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM segments')
+
+
+@dataclass
+class TranslationRun:
+    """
+    一次翻译的复用统计（按原文字符数）。
+    """
+    total_chars: int = 0
+    reused_chars: int = 0
+    requests: int = 0
+    # 翻译失败、以原文代替的块数
+    failed_chunks: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, chars: int, reused_chars: int, requests: int):
+        with self._lock:
+            self.total_chars += chars
+            self.reused_chars += reused_chars
+            self.requests += requests
+
+    def add_failure(self, chars: int, chunks: int = 1):
+        with self._lock:
+            self.total_chars += chars
+            self.failed_chunks += chunks
+
+    @property
+    def reuse_ratio(self) -> float:
+        return self.reused_chars / self.total_chars if self.total_chars else 0.0
+
+
+_memory: TranslationMemory | None = None
+_memory_lock = threading.Lock()
+
+
+def get_translation_memory() -> TranslationMemory:
+    global _memory
+    if _memory is None:
+        with _memory_lock:
+            if _memory is None:
+                _memory = TranslationMemory()
+    return _memory
@@ -1,8 +1,11 @@
 import streamlit as st
 import datetime
 import os
-from core import LLMTranslator, MODEL_OPTIONS, LANG_OPTIONS
+import sys
+from core import LLMTranslator, MODEL_OPTIONS, LANG_OPTIONS, STREAM_LOOKAHEAD
 from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.render import StreamRenderer
 
 st.set_page_config(page_title="LLM翻译器", layout="wide")
 st.title("LLM翻译器")
@@ -23,7 +26,11 @@ input_text = st.text_area("或在此输入要翻译的文本", height=200)
 # 翻译模式选择和翻译按钮同一行
 mode_col, btn_col = st.columns([3, 1])
 with mode_col:
-    mode = st.radio("选择翻译模式", ["流式翻译", "并行翻译"], horizontal=True)
+    mode = st.radio("选择翻译模式", ["流式翻译", "并行流式翻译", "并行翻译"], horizontal=True,
+                    help="并行流式翻译同时翻译多个分块，并按原文顺序边翻译边显示")
+    if mode == "流式翻译":
+        lookahead = st.slider("提前请求的分块数", min_value=0, max_value=8, value=STREAM_LOOKAHEAD,
+                              help="显示当前分块时，后续分块已在后台翻译；为 0 时逐块翻译")
 with btn_col:
     translate_clicked = st.button(
         label="🚀 **开始翻译**",
@@ -50,32 +57,45 @@ if text:
     if translate_clicked:
         translator = LLMTranslator(model_name=model_name)
         progress_bar = st.progress(0, text="翻译进度：0%")
-        output_placeholder = st.empty()
-        with st.spinner("正在翻译中..."):
-            translated = []
+        renderer = StreamRenderer(label="translation")
+        with st.spinner("正在翻译中..."), renderer:
             def progress_callback(idx, total, data):
                 percent = int(idx / total * 100)
                 progress_bar.progress(percent, text=f"翻译进度：{percent}%")
-                if mode == "流式翻译":
-                    output_placeholder.markdown("".join(translated))
-                else:
-                    output_placeholder.markdown("".join(data) if isinstance(data, list) else data)
+                if mode == "并行翻译":
+                    renderer.set("".join(part or "" for part in data))
             if mode == "流式翻译":
-                for chunk in translator.translate_stream(text, tgt_lang, progress_callback=progress_callback):
-                    translated.append(chunk)
-                st.session_state["translated"] = "".join(translated)
+                for chunk in translator.translate_stream(text, tgt_lang, progress_callback=progress_callback, lookahead=lookahead):
+                    renderer.append(chunk)
+                st.session_state["translated"] = renderer.text
+            elif mode == "并行流式翻译":
+                for chunk in translator.translate_parallel_stream(text, tgt_lang, progress_callback=progress_callback):
+                    renderer.append(chunk)
+                st.session_state["translated"] = renderer.text
             else:
                 ctx = get_script_run_ctx()
                 def initializer(thread):
                     add_script_run_ctx(thread=thread, ctx=ctx)
                 result = translator.translate_parallel(text, tgt_lang, progress_callback=progress_callback, worker_thread_initializer=initializer)
-                output_placeholder.markdown(result)
+                renderer.set(result)
                 st.session_state["translated"] = result
+        cache = translator.llm.cache
+        st.session_state["render_stats"] = (f"{renderer.renders} 次刷新（{renderer.renders_per_second:.1f}/秒），推送 {renderer.bytes_pushed / 1024:.0f} KB；"
+                                            f"响应缓存累计命中 {cache.hits} 次，未命中 {cache.misses} 次，节省 {cache.bytes_saved / 1024:.0f} KB；"
+                                            f"翻译记忆复用 {translator.last_run.reuse_ratio:.0%} 的原文，发送 {translator.last_run.requests} 次请求")
+        if translator.last_run.failed_chunks:
+            st.session_state["translate_warning"] = f"{translator.last_run.failed_chunks} 个分块翻译失败，结果中保留了这些分块的原文"
+        else:
+            st.session_state.pop("translate_warning", None)
         st.success("翻译完成！")
         st.rerun()
         
     if "translated" in st.session_state:
         st.subheader("翻译结果")
+        if "render_stats" in st.session_state:
+            st.caption(st.session_state["render_stats"])
+        if "translate_warning" in st.session_state:
+            st.warning(st.session_state["translate_warning"])
         with st.expander("显示翻译结果"):
             st.write(st.session_state["translated"])
         st.download_button(